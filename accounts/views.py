@@ -10,6 +10,8 @@ from django.contrib.auth.hashers import make_password, check_password
 from django.contrib.auth import update_session_auth_hash
 from django.contrib.auth.forms import PasswordChangeForm
 
+from django.db.models import F
+
 from carts.models import Cart, CartItem
 from carts.views import _cart_id
 from orders.models import Order
@@ -81,27 +83,18 @@ def login(request):
             auth_login(request, user)
             
             # STEP 3: PERFORM THE MERGE
+            # Lines are unique per (owner, variant): add guest quantities onto the user's
+            # matching line with one UPDATE, otherwise hand the guest line over to the user.
             if is_cart_item_exists and cart:
                 guest_cart_items = CartItem.objects.filter(cart=cart)
                 for item in guest_cart_items:
-                    existing_user_item = CartItem.objects.filter(product=item.product, user=user)
-                    guest_variations = list(item.variations.all())
-                    guest_variations.sort(key=lambda x: x.id)
-                    
-                    match_found = False
-                    if existing_user_item.exists():
-                        for usr_item in existing_user_item:
-                            user_variations = list(usr_item.variations.all())
-                            user_variations.sort(key=lambda x: x.id)
-                            
-                            if guest_variations == user_variations:
-                                usr_item.quantity += item.quantity
-                                usr_item.save()
-                                item.delete()
-                                match_found = True
-                                break
+                    is_merged = CartItem.objects.filter(user=user, product_id=item.product_id, variant_id=item.variant_id).update(
+                        quantity=F('quantity') + item.quantity
+                    )
                     
-                    if not match_found:
+                    if is_merged:
+                        item.delete()
+                    else:
                         item.user = user
                         item.cart = None 
                         item.save()
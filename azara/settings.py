@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'store.profiling.ProfilingMiddleware',  # no-op unless PROFILING_ENABLED
     'django.middleware.security.SecurityMiddleware',
     "whitenoise.middleware.WhiteNoiseMiddleware", # REQUIRED for serving static files
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -65,6 +66,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'store.context_processors.menu_links',
+                'store.context_processors.catalogue_cache',
                 'carts.context_processors.counter',
             ],
         },
@@ -88,6 +90,55 @@ else:
         }
     }
 
+# --- CACHE ---
+# The category tree / catalogue version stamps, cached pages and the M-Pesa token must be
+# seen by every process (web workers, stk worker, callbacks, reconcile, reservations).
+# In production that is the database cache (tables created by build.sh: createcachetable);
+# locally a per-process LocMemCache is enough.
+#   - 'pages':  whole anonymous pages (store/page_cache.py), bounded and culled on its own
+#   - 'stamps': version stamps (store/version_stamps.py), never culled: an evicted stamp
+#               would silently re-key everything under it
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '20000'))
+STAMP_CACHE_MAX_ENTRIES = 10 ** 9
+if 'DATABASE_URL' in os.environ:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'azara_cache',
+            'OPTIONS': {'MAX_ENTRIES': CACHE_MAX_ENTRIES},
+        },
+        'pages': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'azara_cache_pages',
+            'OPTIONS': {'MAX_ENTRIES': CACHE_MAX_ENTRIES},
+        },
+        'stamps': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'azara_cache_stamps',
+            'OPTIONS': {'MAX_ENTRIES': STAMP_CACHE_MAX_ENTRIES},
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'pages': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'pages',
+            'OPTIONS': {'MAX_ENTRIES': CACHE_MAX_ENTRIES},
+        },
+        'stamps': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'stamps',
+            'OPTIONS': {'MAX_ENTRIES': STAMP_CACHE_MAX_ENTRIES},
+        },
+    }
+
+# A process re-reads a version stamp at most this often (store/version_stamps.py), so a
+# change made by another process shows up within this many seconds.
+VERSION_STAMP_SECONDS = float(os.environ.get('VERSION_STAMP_SECONDS', '2'))
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -138,6 +189,35 @@ MPESA_CONSUMER_KEY = os.environ.get('MPESA_CONSUMER_KEY')
 MPESA_CONSUMER_SECRET = os.environ.get('MPESA_CONSUMER_SECRET')
 MPESA_PASSKEY = os.environ.get('MPESA_PASSKEY')
 MPESA_SHORTCODE = os.environ.get('MPESA_SHORTCODE')
+MPESA_API_URL = os.environ.get('MPESA_API_URL', 'https://sandbox.safaricom.co.ke')
+
+# --- REQUEST PROFILING (store/profiling.py) ---
+# Per-view query counts, DB/template/HTTP time at /staff/profiling/ and as JSON log lines
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'False') == 'True'
+# Share of requests that also get duplicate-query (N+1) detection, which walks the stack per query
+PROFILING_DUPLICATE_SAMPLE_RATE = float(os.environ.get('PROFILING_DUPLICATE_SAMPLE_RATE', '0.05'))
+
+# --- IN-MEMORY CATALOGUE SNAPSHOT (store/catalogue_snapshot.py) ---
+# Store listing filters evaluated in process memory instead of SQL; each worker holds its own copy
+CATALOGUE_SNAPSHOT_ENABLED = os.environ.get('CATALOGUE_SNAPSHOT_ENABLED', 'False') == 'True'
+# Above this many products the listing stays on SQL
+CATALOGUE_SNAPSHOT_MAX_PRODUCTS = int(os.environ.get('CATALOGUE_SNAPSHOT_MAX_PRODUCTS', '20000'))
+
+# --- STOCK RESERVATIONS (store/stock.py) ---
+# How long an unpaid order holds its units before release_expired_reservations puts them back
+STOCK_RESERVATION_MINUTES = int(os.environ.get('STOCK_RESERVATION_MINUTES', '15'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # One JSON line per profiled request
+        'store.profiling': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
 
 # --- SESSION SETTINGS ---
 
@@ -9,4 +9,10 @@ pip install -r requirements.txt
 python manage.py collectstatic --no-input
 
 # Run database migrations
-python manage.py migrate
\ No newline at end of file
+python manage.py migrate
+
+# Shared cache tables (settings.CACHES)
+python manage.py createcachetable
+
+# Refresh denormalized product price/size columns
+python manage.py backfill_variant_summary
@@ -1,22 +1,20 @@
-from .models import Cart, CartItem
-from .views import _cart_id
+from django.db.models import Sum
+
+from .models import CartItem
 
 def counter(request):
-    cart_count = 0
     if 'admin' in request.path:
         return {}
+
+    # ONE aggregate query for the badge; never creates a session or a Cart
+    if request.user.is_authenticated:
+        cart_items = CartItem.objects.filter(user=request.user)
     else:
-        try:
-            cart = Cart.objects.filter(cart_id=_cart_id(request))
-            
-            # NOW THIS WILL WORK:
-            if request.user.is_authenticated:
-                cart_items = CartItem.objects.all().filter(user=request.user)
-            else:
-                cart_items = CartItem.objects.all().filter(cart=cart[:1])
-            
-            for cart_item in cart_items:
-                cart_count += cart_item.quantity
-        except Cart.DoesNotExist:
-            cart_count = 0
-    return dict(cart_count=cart_count)
\ No newline at end of file
+        session_key = request.session.session_key
+        if not session_key:
+            # Guest who never added anything: no session, so no cart
+            return dict(cart_count=0)
+        cart_items = CartItem.objects.filter(cart__cart_id=session_key)
+
+    cart_count = cart_items.aggregate(total=Sum('quantity'))['total'] or 0
+    return dict(cart_count=cart_count)
@@ -0,0 +1,76 @@
+# Generated by Django 4.2 on 2026-10-17 20:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_variations_to_variant(apps, schema_editor):
+    """
+    Moves each line's (single) M2M variation into the new variant FK, then merges
+    lines that end up with the same owner + variant so the unique constraints can be added.
+    """
+    CartItem = apps.get_model('carts', 'CartItem')
+
+    kept = {}
+    for item in CartItem.objects.order_by('id').prefetch_related('variations'):
+        variations = sorted(item.variations.all(), key=lambda v: v.id)
+        item.variant = variations[0] if variations else None
+
+        # A logged-in user's lines are owned by the user only (the login merge already clears 'cart')
+        if item.user_id:
+            item.cart_id = None
+            owner = ('user', item.user_id)
+        else:
+            owner = ('cart', item.cart_id)
+
+        key = (owner, item.product_id, item.variant.id if item.variant else None)
+        if key in kept:
+            kept[key].quantity += item.quantity
+            kept[key].save(update_fields=['quantity'])
+            item.delete()
+        else:
+            item.save(update_fields=['variant', 'cart'])
+            kept[key] = item
+
+
+def copy_variant_to_variations(apps, schema_editor):
+    CartItem = apps.get_model('carts', 'CartItem')
+    for item in CartItem.objects.exclude(variant=None):
+        item.variations.add(item.variant)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_product_search_index'),
+        ('carts', '0002_cartitem_user_alter_cartitem_cart'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='variant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='store.productvariant'),
+        ),
+        migrations.RunPython(copy_variations_to_variant, copy_variant_to_variations),
+        migrations.RemoveField(
+            model_name='cartitem',
+            name='variations',
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('user__isnull', False), ('variant__isnull', False)), fields=('user', 'variant'), name='unique_user_variant_line'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('cart__isnull', False), ('variant__isnull', False)), fields=('cart', 'variant'), name='unique_cart_variant_line'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('user__isnull', False), ('variant__isnull', True)), fields=('user', 'product'), name='unique_user_product_line'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('cart__isnull', False), ('variant__isnull', True)), fields=('cart', 'product'), name='unique_cart_product_line'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Q
 from store.models import Product, ProductVariant
 from accounts.models import Account # <--- Import your custom User model
 
@@ -11,28 +12,39 @@ class Cart(models.Model):
         return self.cart_id
 
 # 2. THE CART ITEM
-# 2. CartItem Model
+# A cart line is keyed by (owner, variant): owner is the user when logged in, else the guest cart.
 class CartItem(models.Model):
     user = models.ForeignKey(Account, on_delete=models.CASCADE, null=True)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
-    # The variations field is a ManyToMany relationship to hold selected variants (like size/color).
-    variations = models.ManyToManyField(ProductVariant, blank=True) 
+    # The ONE size/price this line is for (null only for products sold without variants)
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, null=True, blank=True)
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, null=True)
     quantity = models.IntegerField()
     is_active = models.BooleanField(default=True)
 
-    # Helper method to calculate the subtotal for this specific cart item (qty * price)
-    def sub_total(self):
-        # We assume the CartItem holds only ONE variant (size/price) in its variations field.
-        # We fetch the first variant to get its price.
-        variant = self.variations.first()
-        
-        # Use the price from the ProductVariant object
-        if variant:
-            return variant.price * self.quantity
-        else:
-            # Fallback if no variant is selected/found (should not happen in a complete flow)
-            return self.product.get_display_price * self.quantity 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'variant'],
+                condition=Q(user__isnull=False, variant__isnull=False),
+                name='unique_user_variant_line',
+            ),
+            models.UniqueConstraint(
+                fields=['cart', 'variant'],
+                condition=Q(cart__isnull=False, variant__isnull=False),
+                name='unique_cart_variant_line',
+            ),
+            models.UniqueConstraint(
+                fields=['user', 'product'],
+                condition=Q(user__isnull=False, variant__isnull=True),
+                name='unique_user_product_line',
+            ),
+            models.UniqueConstraint(
+                fields=['cart', 'product'],
+                condition=Q(cart__isnull=False, variant__isnull=True),
+                name='unique_cart_product_line',
+            ),
+        ]
 
     def __unicode__(self):
         return self.product
\ No newline at end of file
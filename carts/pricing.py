@@ -0,0 +1,91 @@
+# carts/pricing.py
+"""
+Cart pricing service.
+
+price_cart() loads a whole cart (items + products + their variants) in a single
+query and returns an immutable CartSummary. The cart page, checkout and
+place_order all read their numbers from it, so totals are computed in one place.
+"""
+from dataclasses import dataclass, replace
+from decimal import Decimal
+
+TWO_PLACES = Decimal('0.01')
+
+# Flat courier fee within Nairobi (pickup orders are free)
+DELIVERY_FEE = Decimal('100.00')
+
+
+def delivery_fee_for(estate, city):
+    """Courier delivery is charged when an address was given; pickup is free."""
+    return DELIVERY_FEE if estate and city else Decimal('0.00')
+
+
+@dataclass(frozen=True)
+class CartLine:
+    item: object            # the CartItem row (for ids / links in templates)
+    product: object
+    variant: object         # ProductVariant or None
+    quantity: int
+    unit_price: Decimal
+    line_total: Decimal
+
+
+@dataclass(frozen=True)
+class CartSummary:
+    lines: tuple
+    quantity: int
+    sub_total: Decimal
+    delivery_fee: Decimal
+    grand_total: Decimal
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def with_delivery_fee(self, delivery_fee):
+        delivery_fee = Decimal(delivery_fee).quantize(TWO_PLACES)
+        return replace(self, delivery_fee=delivery_fee, grand_total=self.sub_total + delivery_fee)
+
+
+def price_cart(cart_items, delivery_fee=Decimal('0.00')):
+    """
+    Prices a CartItem queryset in ONE query (items joined to product/brand/category
+    and variant), whatever the number of lines.
+    """
+    cart_items = cart_items.select_related('product', 'product__brand', 'product__category', 'variant').order_by('id')
+
+    lines = []
+    quantity = 0
+    sub_total = Decimal('0.00')
+
+    for item in cart_items:
+        # A line holds ONE variant; fall back to the product's display price if it has none
+        variant = item.variant
+        unit_price = Decimal(variant.price if variant else item.product.get_display_price)
+        line_total = (unit_price * item.quantity).quantize(TWO_PLACES)
+
+        lines.append(CartLine(
+            item=item,
+            product=item.product,
+            variant=variant,
+            quantity=item.quantity,
+            unit_price=unit_price.quantize(TWO_PLACES),
+            line_total=line_total,
+        ))
+        quantity += item.quantity
+        sub_total += line_total
+
+    sub_total = sub_total.quantize(TWO_PLACES)
+
+    return CartSummary(
+        lines=tuple(lines),
+        quantity=quantity,
+        sub_total=sub_total,
+        delivery_fee=Decimal('0.00'),
+        grand_total=sub_total,
+    ).with_delivery_fee(delivery_fee)
@@ -1,3 +1,103 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-# Create your tests here.
+from decimal import Decimal
+
+from accounts.models import Account
+from store.tests import make_catalogue
+from store.models import ProductVariant
+from .models import Cart, CartItem
+from .pricing import price_cart
+
+
+class CartCounterTests(TestCase):
+
+    def setUp(self):
+        make_catalogue(2)
+
+    def test_anonymous_browsing_creates_no_session_or_cart(self):
+        response = self.client.get(reverse('store:store'))
+        self.assertEqual(response.context['cart_count'], 0)
+        self.assertNotIn('sessionid', response.cookies)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_badge_is_one_aggregate_query(self):
+        variant = ProductVariant.objects.first()
+        add_url = reverse('carts:add_cart', args=[variant.product_id])
+        self.client.post(add_url, {'variant_id': variant.id, 'quantity': 2})
+        self.client.post(add_url, {'variant_id': variant.id, 'quantity': 1})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('store:store'))
+        self.assertEqual(response.context['cart_count'], 3)
+        cart_queries = [q['sql'] for q in queries if 'carts_cartitem' in q['sql']]
+        self.assertEqual(len(cart_queries), 1)
+
+
+class CartPricingTests(TestCase):
+
+    def setUp(self):
+        make_catalogue(6)
+        self.user = Account.objects.create_user('Jane', 'Doe', 'jane', 'jane@example.com', 'pass12345')
+
+    def fill_cart(self, line_count):
+        for variant in ProductVariant.objects.order_by('id')[:line_count]:
+            CartItem.objects.get_or_create(user=self.user, product=variant.product, variant=variant, defaults={'quantity': 2})
+
+    def test_query_count_does_not_grow_with_lines(self):
+        self.fill_cart(1)
+        with CaptureQueriesContext(connection) as one_line:
+            price_cart(CartItem.objects.filter(user=self.user))
+
+        self.fill_cart(8)
+        with CaptureQueriesContext(connection) as many_lines:
+            summary = price_cart(CartItem.objects.filter(user=self.user))
+
+        self.assertEqual(len(summary.lines), 8)
+        self.assertEqual(len(one_line), len(many_lines))
+
+    def test_totals(self):
+        self.fill_cart(2)
+        summary = price_cart(CartItem.objects.filter(user=self.user), delivery_fee=Decimal('100'))
+        expected_sub_total = sum(variant.price * 2 for variant in ProductVariant.objects.order_by('id')[:2])
+
+        self.assertEqual(summary.quantity, 4)
+        self.assertEqual(summary.sub_total, expected_sub_total)
+        self.assertEqual(summary.grand_total, expected_sub_total + Decimal('100.00'))
+        self.assertEqual(summary.with_delivery_fee(0).grand_total, expected_sub_total)
+
+
+class AddToCartTests(TestCase):
+
+    def setUp(self):
+        make_catalogue(1)
+        self.variant = ProductVariant.objects.get(size_ml_g='250ml')
+        self.add_url = reverse('carts:add_cart', args=[self.variant.product_id])
+        self.user = Account.objects.create_user('Jane', 'Doe', 'jane', 'jane@example.com', 'pass12345')
+        self.user.is_active = True
+        self.user.save()
+
+    def add(self, quantity):
+        return self.client.post(self.add_url, {'variant_id': self.variant.id, 'quantity': quantity})
+
+    def test_repeat_adds_increment_one_line(self):
+        self.add(1)
+        self.add(2)
+        line = CartItem.objects.get()
+        self.assertEqual((line.variant, line.quantity), (self.variant, 3))
+
+    def test_hoarding_limit_is_enforced(self):
+        # make_catalogue stocks 5 units, so the limit is 5
+        self.add(4)
+        self.add(2)
+        self.assertEqual(CartItem.objects.get().quantity, 4)
+
+    def test_login_merges_guest_line_into_user_line(self):
+        CartItem.objects.create(user=self.user, product=self.variant.product, variant=self.variant, quantity=1)
+        self.add(2)
+        self.client.post(reverse('login'), {'email': 'jane@example.com', 'password': 'pass12345'})
+
+        line = CartItem.objects.get()
+        self.assertEqual((line.user, line.cart, line.quantity), (self.user, None, 3))
@@ -2,28 +2,20 @@ from django.shortcuts import render, redirect, get_object_or_404
 from store.models import Product, ProductVariant
 from .models import Cart, CartItem
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, transaction
+from django.db.models import F
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from decimal import Decimal 
+from .pricing import price_cart
 
 # --- HELPER FUNCTIONS ---
 
-def get_cart_totals(cart_items):
-    sub_total = Decimal('0.00')
-    for cart_item in cart_items:
-        sub_total += cart_item.sub_total()
-    
-    grand_total = sub_total
-    
-    return {
-        'sub_total': f'{sub_total:.2f}',
-        'grand_total': f'{grand_total:.2f}',
-    }
-
 def _cart_id(request):
     cart = request.session.session_key
     if not cart:
-        cart = request.session.create()
+        # create() returns None; the new key is on the session afterwards
+        request.session.create()
+        cart = request.session.session_key
     return cart
 
 # --- VIEWS ---
@@ -32,7 +24,6 @@ def add_cart(request, product_id):
     product = Product.objects.get(id=product_id) 
     
     # 1. INITIALIZE VARIABLES
-    product_variation = []  
     product_quantity = 1 
     selected_variant = None 
 
@@ -44,7 +35,6 @@ def add_cart(request, product_id):
         if variant_id:
             try:
                 selected_variant = ProductVariant.objects.get(product=product, id=variant_id)
-                product_variation.append(selected_variant)
             except:
                 pass
 
@@ -61,107 +51,42 @@ def add_cart(request, product_id):
         messages.warning(request, f'This {stock_type} is currently out of stock.')
         return redirect('store:store')
 
-    # 2. DETERMINE CART
+    # 2. DETERMINE CART OWNER (the user, or the guest's session cart)
     if current_user.is_authenticated:
-        cart_items_queryset = CartItem.objects.filter(product=product, user=current_user)
+        owner = {'user': current_user}
     else:
-        try:
-            cart = Cart.objects.get(cart_id=_cart_id(request))
-        except Cart.DoesNotExist:
-            cart = Cart.objects.create(cart_id=_cart_id(request))
-        cart.save()
-        cart_items_queryset = CartItem.objects.filter(product=product, cart=cart)
+        cart, _ = Cart.objects.get_or_create(cart_id=_cart_id(request))
+        owner = {'cart': cart}
 
-    # 3. CHECK IF ITEM EXISTS
-    is_cart_item_exists = cart_items_queryset.exists()
-    
     HOARDING_LIMIT = 5
     real_limit = min(HOARDING_LIMIT, current_stock)
 
-    if is_cart_item_exists:
-        ex_var_list = []
-        id_list = []
-        
-        for item in cart_items_queryset:
-            existing_variation = list(item.variations.all())
-            existing_variation.sort(key=lambda x: x.id) 
-            ex_var_list.append(existing_variation)
-            id_list.append(item.id)
-
-        product_variation.sort(key=lambda x: x.id)
-
-        if product_variation in ex_var_list:
-            # --- SCENARIO: ITEM EXISTS (INCREMENT) ---
-            index = ex_var_list.index(product_variation)
-            item_id = id_list[index]
-            item = CartItem.objects.get(product=product, id=item_id)
-            
-            future_quantity = item.quantity + product_quantity
-            
-            if future_quantity > real_limit:
-                # --- UPDATED MESSAGE LOGIC HERE ---
-                if current_stock < HOARDING_LIMIT:
-                    msg = f"Quantity exceeded available stock. Please select {current_stock} items or less."
-                else:
-                    msg = f"To avoid hoarding, you can only order {HOARDING_LIMIT} items of the same variant."
-                
-                messages.warning(request, msg)
-                return redirect('cart:cart')
-            
-            item.quantity += product_quantity
-            item.save()
-            
-        else:
-            # --- SCENARIO: NEW VARIANT (CREATE) ---
-            if product_quantity > real_limit:
-                # --- UPDATED MESSAGE LOGIC HERE ---
-                if current_stock < HOARDING_LIMIT:
-                    msg = f"Quantity exceeded available stock. Please select {current_stock} items or less."
-                else:
-                    msg = f"To avoid hoarding, you can only order {HOARDING_LIMIT} items of the same variant."
-                
-                messages.warning(request, msg)
-                return redirect('cart:cart')
-
-            if current_user.is_authenticated:
-                item = CartItem.objects.create(product=product, quantity=product_quantity, user=current_user)
-            else:
-                item = CartItem.objects.create(product=product, quantity=product_quantity, cart=cart)
-            
-            if len(product_variation) > 0:
-                item.variations.clear()
-                item.variations.add(*product_variation)
-            item.save()
-            
-    else:
-        # --- SCENARIO: NEW PRODUCT (CREATE) ---
-        if product_quantity > real_limit:
-            # --- UPDATED MESSAGE LOGIC HERE ---
+    # 3. UPSERT THE CART LINE (unique per owner + variant)
+    # a) Line exists: ONE conditional UPDATE that also enforces the limit
+    cart_line = CartItem.objects.filter(product=product, variant=selected_variant, **owner)
+    is_updated = cart_line.filter(quantity__lte=real_limit - product_quantity).update(
+        quantity=F('quantity') + product_quantity
+    )
+
+    # b) No line yet: INSERT it (the unique constraint rejects it if the line exists but is at the limit)
+    if not is_updated:
+        is_created = False
+        if product_quantity <= real_limit:
+            try:
+                with transaction.atomic():
+                    CartItem.objects.create(product=product, variant=selected_variant, quantity=product_quantity, **owner)
+                is_created = True
+            except IntegrityError:
+                pass
+
+        if not is_created:
             if current_stock < HOARDING_LIMIT:
                 msg = f"Quantity exceeded available stock. Please select {current_stock} items or less."
             else:
                 msg = f"To avoid hoarding, you can only order {HOARDING_LIMIT} items of the same variant."
             
             messages.warning(request, msg)
-            return redirect('cart:cart')
-
-        if current_user.is_authenticated:
-            cart_item = CartItem.objects.create(
-                product = product,
-                quantity = product_quantity,
-                user = current_user,
-            )
-        else:
-            cart_item = CartItem.objects.create(
-                product = product,
-                quantity = product_quantity,
-                cart = cart,
-            )
-            
-        if len(product_variation) > 0:
-            cart_item.variations.clear()
-            cart_item.variations.add(*product_variation)
-        cart_item.save()
+            return redirect('carts:cart')
     
     return redirect('carts:cart')
 
@@ -207,26 +132,25 @@ def remove_cart_item(request, product_id, cart_item_id):
     return redirect('carts:cart')
 
 
-def cart(request, total=0, quantity=0, cart_items=None):
+def cart(request):
+    cart_items = CartItem.objects.none()
     try:
         if request.user.is_authenticated:
             cart_items = CartItem.objects.filter(user=request.user, is_active=True)
         else:
-            cart = Cart.objects.get(cart_id=_cart_id(request))
+            # Read the session key directly so just viewing the cart never creates a session
+            cart = Cart.objects.get(cart_id=request.session.session_key)
             cart_items = CartItem.objects.filter(cart=cart, is_active=True)
-        
-        for cart_item in cart_items:
-            item_sub_total = cart_item.sub_total() 
-            total += item_sub_total
-            quantity += cart_item.quantity
-            
     except ObjectDoesNotExist:
         pass
-        
+
+    # Whole cart priced in a constant number of queries
+    cart_summary = price_cart(cart_items)
+
     context = {
-        'total': total,
-        'quantity': quantity,
-        'cart_items': cart_items,
+        'total': cart_summary.sub_total,
+        'quantity': cart_summary.quantity,
+        'cart_summary': cart_summary,
     }
     return render(request, 'carts/cart.html', context)
 
@@ -234,17 +158,13 @@ def cart(request, total=0, quantity=0, cart_items=None):
 def checkout(request):
     try:
         current_user = request.user
-        cart_items = CartItem.objects.filter(user=current_user, is_active=True)
-        cart_count = cart_items.count()
+        cart_summary = price_cart(CartItem.objects.filter(user=current_user, is_active=True))
         
-        if cart_count == 0:
+        if not cart_summary:
             return redirect('store:store')
 
-        total_cart_data = get_cart_totals(cart_items)
-
         context = {
-            'cart_items': cart_items,
-            'total_cart_data': total_cart_data,
+            'cart_summary': cart_summary,
         }
         
         return render(request, 'orders/checkout.html', context)
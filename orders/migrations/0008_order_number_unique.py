@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-17 21:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0007_order_delivery_fee'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='order_number',
+            field=models.CharField(max_length=50, unique=True),
+        ),
+    ]
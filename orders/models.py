@@ -31,7 +31,7 @@ class Payment(models.Model):
 class Order(models.Model):
     user = models.ForeignKey(Account, on_delete=models.SET_NULL, null=True)
     payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, blank=True, null=True)
-    order_number = models.CharField(max_length=50)
+    order_number = models.CharField(max_length=50, unique=True)
     
     first_name = models.CharField(max_length=50)
     last_name = models.CharField(max_length=50)
@@ -1,3 +1,112 @@
+from unittest import mock
+
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from accounts.models import Account
+from carts.models import CartItem
+from store.models import MpesaTransaction, ProductVariant, StockReservation
+from store.tests import make_catalogue
+from .models import Order, OrderProduct
+
+ORDER_FORM = {
+    'first_name': 'Jane', 'last_name': 'Doe', 'phone': '0712345678', 'email': 'jane@example.com',
+    'estate': 'Kilimani', 'city': 'Nairobi', 'order_note': '',
+}
+
+
+class PlaceOrderTests(TestCase):
+
+    def setUp(self):
+        make_catalogue(10)
+        self.user = Account.objects.create_user('Jane', 'Doe', 'jane', 'jane@example.com', 'pass12345')
+        self.user.is_active = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.client.get(reverse('store:store'))  # warm-up: builds the cached category tree
+
+    def fill_cart(self, line_count):
+        CartItem.objects.filter(user=self.user).delete()
+        for variant in ProductVariant.objects.order_by('id')[:line_count]:
+            CartItem.objects.create(user=self.user, product=variant.product, variant=variant, quantity=1)
+
+    def place_order(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('orders:place_order'), ORDER_FORM)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_order_is_written_in_one_pass(self):
+        self.fill_cart(3)
+        self.place_order()
+
+        order = Order.objects.get()
+        self.assertTrue(order.order_number.startswith(order.created_at.astimezone().strftime('%Y%m%d')))
+        self.assertEqual(order.grand_total, order.order_total + 100)
+
+        products = OrderProduct.objects.filter(order=order)
+        self.assertEqual(products.count(), 3)
+        for item in products:
+            self.assertEqual(item.product_name, item.product.name)
+            self.assertEqual(item.variant_details, item.product_variant.size_ml_g)
+            self.assertEqual(item.product_price, item.product_variant.price)
+
+    def test_query_count_does_not_grow_with_cart_size(self):
+        self.fill_cart(1)
+        self.place_order()  # so both measured orders replace an earlier one-line hold
+        one_line = self.place_order()
+        self.fill_cart(20)
+        many_lines = self.place_order()
+        self.assertEqual(one_line, many_lines)
+
+    def test_sold_out_line_blocks_the_order(self):
+        self.fill_cart(2)
+        variant = ProductVariant.objects.order_by('id').first()
+        ProductVariant.objects.filter(pk=variant.pk).update(stock=0)  # last unit bought by someone else
+
+        response = self.client.post(reverse('orders:place_order'), ORDER_FORM)
+        self.assertRedirects(response, reverse('carts:cart'), fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(ProductVariant.objects.order_by('id')[1].stock, 5)  # the other line was not taken
+
+    def test_order_holds_its_stock(self):
+        self.fill_cart(2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.place_order()
+
+        order = Order.objects.get()
+        self.assertEqual(order.stock_reservations.count(), 2)
+        first = ProductVariant.objects.select_related('product').order_by('id').first()
+        self.assertEqual((first.stock, first.product.stock), (4, 8))
+
+    def test_colliding_order_number_is_retried(self):
+        self.fill_cart(1)
+        self.place_order()
+        taken = Order.objects.get().order_number
+        with mock.patch('orders.views.generate_order_number', side_effect=[taken, '20260101FRESH00001']):
+            self.place_order()
+        self.assertEqual(set(Order.objects.values_list('order_number', flat=True)), {taken, '20260101FRESH00001'})
+
+    def test_resubmitted_form_does_not_hold_the_stock_twice(self):
+        self.fill_cart(1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.place_order()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.place_order()
+
+        first, second = Order.objects.order_by('id')
+        self.assertEqual(first.stock_reservations.get().status, StockReservation.RELEASED)
+        self.assertEqual(second.stock_reservations.get().status, StockReservation.HELD)
+        self.assertEqual(ProductVariant.objects.order_by('id').first().stock, 4)
+
+    def test_holds_of_an_order_being_paid_are_kept(self):
+        self.fill_cart(1)
+        self.place_order()
+        first = Order.objects.get()
+        MpesaTransaction.objects.create(order=first, checkout_request_id='ws_CO_1', amount=first.grand_total, phone_number='254712345678')
+        self.place_order()
 
-# Create your tests here.
+        self.assertEqual(first.stock_reservations.get().status, StockReservation.HELD)
+        self.assertEqual(ProductVariant.objects.order_by('id').first().stock, 3)
@@ -1,107 +1,115 @@
 from django.shortcuts import render, redirect
 from carts.models import CartItem
+from carts.pricing import price_cart, delivery_fee_for
 from .forms import OrderForm
 from .models import Order, OrderProduct, Payment
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from decimal import Decimal
-import datetime 
+from django.db import IntegrityError, transaction
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
+from store.stock import OutOfStock, release_unpaid_holds, reserve_order_stock
+import secrets
+
+
+def generate_order_number():
+    """
+    Date + 10 random hex chars (e.g. 20251130A3F9C21B7D).
+    Known before the INSERT, so the order is written once instead of saved twice to use its id.
+    """
+    return timezone.localdate().strftime('%Y%m%d') + secrets.token_hex(5).upper()
+
+
+ORDER_NUMBER_ATTEMPTS = 3
+
+
+def create_order(**fields):
+    """Order.objects.create() under a fresh order number, retried if it collides (order_number is unique)."""
+    for attempt in range(ORDER_NUMBER_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                return Order.objects.create(order_number=generate_order_number(), **fields)
+        except IntegrityError:
+            if attempt == ORDER_NUMBER_ATTEMPTS - 1:
+                raise
+
 
 @login_required(login_url='login')
-def place_order(request, total=0, quantity=0):
+def place_order(request):
     current_user = request.user
 
-    # 1. Check Cart
-    cart_items = CartItem.objects.filter(user=current_user)
-    cart_count = cart_items.count()
-    if cart_count <= 0:
+    # 1. Check Cart & Calculate Totals (whole cart priced in a constant number of queries)
+    cart_summary = price_cart(CartItem.objects.filter(user=current_user))
+    if not cart_summary:
         return redirect('store:store')
 
-    # 2. Calculate Totals
-    grand_total = 0
-    delivery_fee = 0
-    for cart_item in cart_items:
-        total += cart_item.sub_total()
-        quantity += cart_item.quantity
-    grand_total = total + delivery_fee
-
-    # 3. Handle Form
+    # 2. Handle Form
     if request.method == 'POST':
         form = OrderForm(request.POST)
         if form.is_valid():
 
-            # DELIVERY FEE LOGIC 
-            delivery_fee = 0
-            # Check if user filled in Estate and City
-            if form.cleaned_data.get('estate') and form.cleaned_data.get('city'):
-                delivery_fee = Decimal('100.00') 
-            
-            # Recalculate Grand Total (Subtotal + Delivery)
-            grand_total = total + delivery_fee
-
-
-            # A. Create Order
-            data = Order()
-            data.user = current_user
-            data.first_name = form.cleaned_data['first_name']
-            data.last_name = form.cleaned_data['last_name']
-            data.phone = form.cleaned_data['phone']
-            data.email = form.cleaned_data['email']
-            data.estate = form.cleaned_data['estate']
-            data.city = form.cleaned_data['city']
-            data.order_note = form.cleaned_data['order_note']
-            data.delivery_fee = delivery_fee
-            data.order_total = total
-            data.grand_total = grand_total
-            data.ip = request.META.get('REMOTE_ADDR')
-            data.save()
-            
-            # B. Generate Order Number
-            yr = int(datetime.date.today().strftime('%Y'))
-            dt = int(datetime.date.today().strftime('%d'))
-            mt = int(datetime.date.today().strftime('%m'))
-            d = datetime.date(yr,mt,dt)
-            current_date = d.strftime("%Y%m%d") 
-            order_number = current_date + str(data.id)
-            data.order_number = order_number
-            data.save()
-
-            # Define 'order' variable here 
-            order = data 
-
-            # C. CREATE ORDER PRODUCTS 
-            # This loop must be indented INSIDE the 'if form.is_valid()' block
-            for item in cart_items:
-                # 1. CREATE the object
-                orderproduct = OrderProduct()
-
-                # 2. Fill details
-                orderproduct.order_id = order.id  # Now 'order' exists!
-                orderproduct.user_id = request.user.id
-                orderproduct.product_id = item.product_id
-                orderproduct.quantity = item.quantity
-                
-                # 3. Get the specific Variant (Size)
-                variant = item.variations.first()
-                
-                # 4. Save Price AND the Link to the Variant
-                if variant:
-                    orderproduct.product_price = variant.price 
-                    orderproduct.product_variant = variant  # <--- THIS IS THE FIX
-                    
-                    # Optional: Snapshot the name so it stays forever
-                    orderproduct.variant_details = variant.size_ml_g 
-                else:
-                    # Fallback if no variant found (shouldn't happen)
-                    orderproduct.product_price = 0 
-
-                # 5. Save to database
-                orderproduct.ordered = True
-                orderproduct.save()
+            # DELIVERY FEE LOGIC (courier fee only if user filled in Estate and City)
+            cart_summary = cart_summary.with_delivery_fee(
+                delivery_fee_for(form.cleaned_data.get('estate'), form.cleaned_data.get('city'))
+            )
+            total = cart_summary.sub_total
+            grand_total = cart_summary.grand_total
+
+            # A. Create Order + Order Products + stock holds in ONE transaction (all or nothing)
+            with transaction.atomic():
+                order = create_order(
+                    user=current_user,
+                    first_name=form.cleaned_data['first_name'],
+                    last_name=form.cleaned_data['last_name'],
+                    phone=form.cleaned_data['phone'],
+                    email=form.cleaned_data['email'],
+                    estate=form.cleaned_data['estate'],
+                    city=form.cleaned_data['city'],
+                    order_note=form.cleaned_data['order_note'],
+                    delivery_fee=cart_summary.delivery_fee,
+                    order_total=total,
+                    grand_total=grand_total,
+                    ip=request.META.get('REMOTE_ADDR'),
+                )
+
+                # B. CREATE ORDER PRODUCTS with a single bulk INSERT
+                # Lines (and their variants) were already loaded by price_cart
+                OrderProduct.objects.bulk_create([
+                    OrderProduct(
+                        order=order,
+                        user=current_user,
+                        product=line.product,
+                        product_variant=line.variant,
+                        quantity=line.quantity,
+                        product_price=line.unit_price,
+                        ordered=True,
+                        # Snapshots (kept even if the product/variant is edited or deleted)
+                        product_name=line.product.name,
+                        variant_details=line.variant.size_ml_g if line.variant else None,
+                    )
+                    for line in cart_summary.lines
+                ])
+
+                # C. HOLD THE STOCK (one conditional UPDATE; fails if the last units went meanwhile).
+                #    A re-submitted form replaces the earlier unpaid order's holds instead of adding to them.
+                try:
+                    release_unpaid_holds(current_user.id)
+                    reserve_order_stock(order, cart_summary.lines)
+                    sold_out = None
+                except OutOfStock as e:
+                    transaction.set_rollback(True)  # no order without its stock
+                    sold_out = e.names
+
+            if sold_out:
+                messages.error(request, f"Sorry, not enough stock left for: {', '.join(sold_out)}. Please update your cart.")
+                return redirect('carts:cart')
 
             # D. Load the Payment Page or Trigger M-Pesa
+            # (order_detail.html lists order.orderproduct_set with each product's image)
+            prefetch_related_objects([order], 'orderproduct_set__product')
             context = {
                 'order': order,
-                'cart_items': cart_items,
+                'cart_items': cart_summary.lines,
                 'total': total,
                 'grand_total': grand_total,
             }
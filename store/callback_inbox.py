@@ -0,0 +1,110 @@
+# store/callback_inbox.py
+"""
+Persist-then-process inbox for Daraja callbacks.
+
+The webhook view calls record_callback(), which stores the raw body in ONE insert
+and returns, so Safaricom gets its ack no matter how slow the order/payment work is.
+`python manage.py process_mpesa_callbacks` drains the inbox in batches through the
+idempotent payments.process_stk_callback(), retrying failures with backoff. So is a
+callback for a CheckoutRequestID with no transaction yet (it arrived before the STK
+worker committed it).
+replay() puts any stored callback back in the queue (safe: processing is idempotent).
+"""
+import datetime
+import json
+import logging
+
+from django.utils import timezone
+
+from .models import MpesaCallback
+from .payments import UNKNOWN, process_stk_callback
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+RETRY_BASE = datetime.timedelta(seconds=5)     # 5s, 10s, 20s ... between attempts
+RETRY_MAX = datetime.timedelta(minutes=10)
+# A row left 'Processing' this long belonged to a processor that died; it is retried
+STALE_AFTER = datetime.timedelta(minutes=5)
+
+
+def record_callback(raw_body):
+    """Appends the raw webhook body to the inbox (one INSERT)."""
+    body = raw_body.decode('utf-8', errors='replace') if isinstance(raw_body, bytes) else raw_body
+    try:
+        checkout_req_id = json.loads(body)['Body']['stkCallback'].get('CheckoutRequestID')
+    except (ValueError, KeyError, TypeError, AttributeError):
+        checkout_req_id = None  # still stored, so it can be inspected and replayed
+    return MpesaCallback.objects.create(body=body, checkout_request_id=checkout_req_id)
+
+
+def claim_callbacks(limit=50):
+    """Moves up to `limit` due callbacks (oldest first) to 'Processing' and returns them."""
+    now = timezone.now()
+    MpesaCallback.objects.filter(status=MpesaCallback.PROCESSING, next_attempt_at__lt=now - STALE_AFTER).update(
+        status=MpesaCallback.PENDING
+    )
+    candidate_ids = list(
+        MpesaCallback.objects.filter(status=MpesaCallback.PENDING, next_attempt_at__lte=now)
+        .order_by('next_attempt_at', 'id').values_list('id', flat=True)[:limit]
+    )
+    claimed = [
+        callback_id for callback_id in candidate_ids
+        if MpesaCallback.objects.filter(id=callback_id, status=MpesaCallback.PENDING)
+        .update(status=MpesaCallback.PROCESSING, next_attempt_at=now)
+    ]
+    return list(MpesaCallback.objects.filter(id__in=claimed).order_by('id'))
+
+
+def _retry_later(callback, attempts, **changes):
+    """Back to 'Pending' after a backoff (5s, 10s, 20s ...), or 'Failed' after MAX_ATTEMPTS. Returns the status."""
+    if attempts >= MAX_ATTEMPTS:
+        status, next_attempt_at = MpesaCallback.FAILED, timezone.now()
+    else:
+        status = MpesaCallback.PENDING
+        next_attempt_at = timezone.now() + min(RETRY_BASE * (2 ** (attempts - 1)), RETRY_MAX)
+    MpesaCallback.objects.filter(id=callback.id).update(
+        status=status, attempts=attempts, next_attempt_at=next_attempt_at, **changes
+    )
+    return status
+
+
+def process_callback(callback):
+    """Applies one claimed inbox row. Returns its new status."""
+    attempts = callback.attempts + 1
+    try:
+        stk_callback = json.loads(callback.body).get('Body', {}).get('stkCallback', {})
+        outcome = process_stk_callback(stk_callback)
+    except Exception as e:
+        logger.exception(f"M-Pesa callback #{callback.id} failed (attempt {attempts})")
+        return _retry_later(callback, attempts, last_error=repr(e))
+
+    if outcome == UNKNOWN:
+        # Usually the callback beat the STK worker's commit of its MpesaTransaction: try again shortly
+        return _retry_later(callback, attempts, outcome=outcome, last_error='No transaction with this CheckoutRequestID (yet)')
+
+    MpesaCallback.objects.filter(id=callback.id).update(
+        status=MpesaCallback.PROCESSED, outcome=outcome, attempts=attempts, processed_at=timezone.now()
+    )
+    return MpesaCallback.PROCESSED
+
+
+def process_pending(limit=50):
+    """Drains one batch. Returns {status: count} for what happened to it."""
+    counts = {}
+    for callback in claim_callbacks(limit):
+        status = process_callback(callback)
+        counts[status] = counts.get(status, 0) + 1
+    return counts
+
+
+def replay(callback_ids=None, checkout_request_id=None):
+    """Queues stored callbacks again (by id and/or CheckoutRequestID). Returns how many."""
+    if callback_ids is None and checkout_request_id is None:
+        raise ValueError("Pass callback ids or a CheckoutRequestID to replay.")
+    callbacks = MpesaCallback.objects.exclude(status=MpesaCallback.PROCESSING)
+    if callback_ids is not None:
+        callbacks = callbacks.filter(id__in=callback_ids)
+    if checkout_request_id is not None:
+        callbacks = callbacks.filter(checkout_request_id=checkout_request_id)
+    return callbacks.update(status=MpesaCallback.PENDING, next_attempt_at=timezone.now(), attempts=0, last_error=None)
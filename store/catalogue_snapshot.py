@@ -0,0 +1,138 @@
+# store/catalogue_snapshot.py
+"""
+Optional in-process catalogue snapshot for the store listing (CATALOGUE_SNAPSHOT_ENABLED).
+
+The filterable product columns (id, category, parent category, brand, available,
+created, min_price) are held as compact typed arrays (the stdlib `array` module),
+pre-sorted in listing order (newest first). Category / brand / price filters and
+sorting are then evaluated in memory, and the view only runs one primary-key SELECT
+for the cards it shows. No COUNT, OFFSET or multi-join filter query at all.
+
+The snapshot is built with one query the first time a listing needs it, and dropped
+whenever the catalogue version changes (store/page_cache.py, bumped by the
+Product/Variant/Category/Brand signals). It rebuilds on the next use. Callers fall
+back to SQL when it's disabled, or when the catalogue is bigger than
+CATALOGUE_SNAPSHOT_MAX_PRODUCTS.
+"""
+import math
+import threading
+from array import array
+from bisect import bisect_right
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+
+from .models import Product
+from .page_cache import get_catalogue_version
+
+
+class CatalogueSnapshot:
+
+    def __init__(self, rows, version):
+        """rows: (id, category_id, parent_category_id, brand_id, available, created, min_price) newest first."""
+        self.version = version
+        self.ids = array('q')
+        self.category_ids = array('q')
+        self.parent_ids = array('q')      # 0 = top-level category
+        self.brand_ids = array('q')
+        self.available = array('b')
+        self.created = array('d')         # POSIX timestamps
+        self.min_prices = array('d')      # NaN = no active variant
+        for product_id, category_id, parent_id, brand_id, available, created, min_price in rows:
+            self.ids.append(product_id)
+            self.category_ids.append(category_id)
+            self.parent_ids.append(parent_id or 0)
+            self.brand_ids.append(brand_id)
+            self.available.append(available)
+            self.created.append(created.timestamp())
+            self.min_prices.append(float(min_price) if min_price is not None else math.nan)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def filter(self, category_id=None, brand_ids=None, min_price=None, max_price=None, order='-created'):
+        """
+        Row positions of available products matching every given filter, in `order`
+        ('-created' is the snapshot's own order, 'price' / '-price' sort on min_price).
+        Same semantics as the SQL listing: a category also covers its children.
+        """
+        rows = [i for i, available in enumerate(self.available) if available]
+        if category_id is not None:
+            categories, parents = self.category_ids, self.parent_ids
+            rows = [i for i in rows if categories[i] == category_id or parents[i] == category_id]
+        if brand_ids:
+            wanted, brands = set(brand_ids), self.brand_ids
+            rows = [i for i in rows if brands[i] in wanted]
+        if min_price is not None or max_price is not None:
+            low = float(min_price) if min_price is not None else -math.inf
+            high = float(max_price) if max_price is not None else math.inf
+            prices = self.min_prices
+            rows = [i for i in rows if low <= prices[i] <= high]  # NaN never matches, like NULL
+        if order in ('price', '-price'):
+            rows.sort(key=self.min_prices.__getitem__, reverse=order == '-price')
+        return rows
+
+    def position_after(self, rows, cursor):
+        """Index in `rows` (newest-first positions) of the first product after a (created, id) cursor."""
+        created, product_id = cursor
+        target = (-created.timestamp(), -product_id)
+        return bisect_right(rows, target, key=lambda i: (-self.created[i], -self.ids[i]))
+
+    def product_ids(self, rows):
+        return [self.ids[i] for i in rows]
+
+
+# --- 1. ACCESS ---
+_snapshot = None
+_lock = threading.Lock()
+
+
+def _build(version):
+    rows = (
+        Product.objects.order_by('-created', '-id')
+        .values_list('id', 'category_id', 'category__parent_id', 'brand_id', 'available', 'created', 'min_price')
+    )
+    return CatalogueSnapshot(rows.iterator(), version)
+
+
+def get_snapshot():
+    """The current snapshot, or None when disabled or the catalogue is too large (use SQL then)."""
+    global _snapshot
+    if not getattr(settings, 'CATALOGUE_SNAPSHOT_ENABLED', False):
+        return None
+    version = get_catalogue_version()
+    snapshot = _snapshot
+    if snapshot is None or snapshot.version != version:
+        with _lock:
+            if _snapshot is None or _snapshot.version != version:
+                # Size check first, so a huge catalogue never gets loaded into memory
+                if Product.objects.count() > getattr(settings, 'CATALOGUE_SNAPSHOT_MAX_PRODUCTS', 20000):
+                    _snapshot = _TooLarge(version)
+                else:
+                    _snapshot = _build(version)
+            snapshot = _snapshot
+    return snapshot if isinstance(snapshot, CatalogueSnapshot) else None
+
+
+class _TooLarge:
+    """Remembers (per version) that the catalogue was over the limit, so we don't re-count per request."""
+    def __init__(self, version):
+        self.version = version
+
+
+# --- 2. LISTING HELPERS ---
+def parse_filters(request):
+    """(brand_ids, min_price, max_price) from the listing GET params, or None if they don't parse."""
+    try:
+        brand_ids = [int(brand_id) for brand_id in request.GET.getlist('brands')]
+        min_price = Decimal(request.GET['min_price']) if request.GET.get('min_price') else None
+        max_price = Decimal(request.GET['max_price']) if request.GET.get('max_price') else None
+    except (ValueError, InvalidOperation):
+        return None
+    return brand_ids, min_price, max_price
+
+
+def load_products(product_ids):
+    """Product rows (category and brand joined in) for the given ids, in that order."""
+    products = Product.objects.select_related('category', 'brand').in_bulk(product_ids)
+    return [products[product_id] for product_id in product_ids if product_id in products]
@@ -0,0 +1,83 @@
+# store/category_tree.py
+"""
+Process-wide cache of the category tree (navbar menu, store sidebar, category lookups).
+
+The tree is built with ONE query the first time it is needed, then served from memory.
+Category save/delete signals (store/signals.py) call invalidate_category_tree(), which
+drops this process's copy and bumps the tree's version stamp (store/version_stamps.py),
+which every process reads, so the others rebuild within a few seconds.
+"""
+import threading
+
+from django.urls import reverse
+
+from .models import Category
+from .version_stamps import bump_stamp, get_stamp
+
+VERSION_CACHE_KEY = 'store:category_tree:version'
+
+
+class CategoryNode:
+    """Read-only stand-in for a Category row (same attribute names the templates use)."""
+    __slots__ = ('id', 'name', 'slug', 'parent_id', 'parent', 'children', 'url')
+
+    def __init__(self, category):
+        self.id = category.id
+        self.name = category.name
+        self.slug = category.slug
+        self.parent_id = category.parent_id
+        self.parent = None
+        self.children = []
+        self.url = reverse('store:products_by_category', args=[category.slug])
+
+    def get_url(self):
+        return self.url
+
+    def __str__(self):
+        return self.name
+
+
+class CategoryTree:
+
+    def __init__(self, categories, version):
+        self.version = version
+        self.all = [CategoryNode(category) for category in categories]  # ordered by name (Category.Meta)
+        self.by_id = {node.id: node for node in self.all}
+        self.by_slug = {node.slug: node for node in self.all}
+        self.roots = []
+
+        for node in self.all:
+            parent = self.by_id.get(node.parent_id)
+            if parent:
+                node.parent = parent
+                parent.children.append(node)
+            else:
+                self.roots.append(node)
+
+    def get(self, slug):
+        return self.by_slug.get(slug)
+
+
+_tree = None
+_lock = threading.Lock()
+
+
+def get_category_tree():
+    """Returns the cached CategoryTree, rebuilding it only if a Category changed."""
+    global _tree
+    version = get_stamp(VERSION_CACHE_KEY)
+    tree = _tree
+    if tree is not None and tree.version == version:
+        return tree
+
+    with _lock:
+        # Another thread may have rebuilt it while we waited
+        if _tree is None or _tree.version != version:
+            _tree = CategoryTree(Category.objects.all(), version)
+        return _tree
+
+
+def invalidate_category_tree():
+    global _tree
+    _tree = None
+    bump_stamp(VERSION_CACHE_KEY)
@@ -1,8 +1,13 @@
 # store/context_processors.py
-from .models import Category
+from .category_tree import get_category_tree
+from .page_cache import FRAGMENT_CACHE_TIMEOUT, get_catalogue_version
 
 def menu_links(request):
-    # Fetch all categories from the database
-    links = Category.objects.all()
+    # Categories come from the in-memory tree cache (no query once it is built)
+    category_tree = get_category_tree()
     # Return them as a dictionary accessible to templates
-    return dict(links=links)
\ No newline at end of file
+    return dict(links=category_tree.all, category_tree=category_tree)
+
+def catalogue_cache(request):
+    # Version stamp + timeout for the {% cache %} product-card fragments (see store/page_cache.py)
+    return dict(catalogue_version=get_catalogue_version(), card_cache_timeout=FRAGMENT_CACHE_TIMEOUT)
@@ -0,0 +1,212 @@
+# store/daraja_simulator.py
+"""
+Local stand-in for the Safaricom Daraja API, so the whole payment path
+(stk_push_request -> initiate_stk_push -> stk_push_callback) can run without the sandbox.
+
+Serves the three endpoints the shop uses:
+  GET  /oauth/v1/generate               -> access token
+  POST /mpesa/stkpush/v1/processrequest -> accepts the push, then fires the callback later
+  POST /mpesa/stkpushquery/v1/query     -> "still processing" until the callback fired
+
+Callbacks arrive after a random delay, fail at `failure_rate` (cancelled, insufficient
+funds...) and are delivered twice at `duplicate_rate`, like Safaricom's retries.
+Run it with `python manage.py run_daraja_simulator` and point MPESA_API_URL at it.
+"""
+import datetime
+import json
+import logging
+import random
+import string
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+FAILURES = [
+    (1032, 'Request cancelled by user'),
+    (1, 'The balance is insufficient for the transaction'),
+    (2001, 'The initiator information is invalid'),
+    (1037, 'DS timeout user cannot be reached'),
+]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+    def do_GET(self):
+        if self.path.startswith('/oauth/v1/generate'):
+            self.reply(200, {'access_token': uuid.uuid4().hex, 'expires_in': '3599'})
+        else:
+            self.reply(404, {'errorCode': '404.001.01', 'errorMessage': 'Resource not found'})
+
+    def do_POST(self):
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            self.reply(400, {'errorCode': '400.002.01', 'errorMessage': 'Invalid JSON'})
+            return
+
+        simulator = self.server.simulator
+        if self.path.startswith('/mpesa/stkpush/v1/processrequest'):
+            self.reply(*simulator.push(payload))
+        elif self.path.startswith('/mpesa/stkpushquery/v1/query'):
+            self.reply(*simulator.query(payload))
+        else:
+            self.reply(404, {'errorCode': '404.001.01', 'errorMessage': 'Resource not found'})
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DarajaSimulator:
+
+    def __init__(self, host='127.0.0.1', port=0, callback_delay=(1.0, 3.0), failure_rate=0.0,
+                 duplicate_rate=0.0, seed=None, deliver=None):
+        self.host = host
+        self.port = port
+        self.callback_delay = callback_delay
+        self.failure_rate = failure_rate
+        self.duplicate_rate = duplicate_rate
+        self.random = random.Random(seed)
+        # deliver(callback_url, body) -> anything; defaults to a real HTTP POST
+        self.deliver = deliver or self.post_callback
+
+        self._lock = threading.Lock()
+        self.pushes = {}               # CheckoutRequestID -> {'payload', 'result' (None until the callback fired)}
+        self.callback_latencies = []   # seconds each callback delivery took (webhook ack time)
+        self.callback_errors = 0
+        self._server = None
+        self._timers = []
+
+    # --- Lifecycle ---
+    def start(self):
+        self._server = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._server.daemon_threads = True
+        self._server.simulator = self
+        self.port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        for timer in self._timers:
+            timer.cancel()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    # --- Endpoints ---
+    def push(self, payload):
+        phone = str(payload.get('PhoneNumber', ''))
+        if not (phone.startswith('254') and len(phone) == 12 and phone.isdigit()):
+            return 400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid PhoneNumber'}
+        try:
+            amount = int(payload.get('Amount'))
+        except (TypeError, ValueError):
+            amount = 0
+        if amount < 1:
+            return 400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid Amount'}
+
+        checkout_request_id = f"ws_CO_{datetime.datetime.now():%d%m%Y%H%M%S}{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            merchant_request_id = f"{self.random.randint(10000, 99999)}-{self.random.randint(1000000, 9999999)}-1"
+            self.pushes[checkout_request_id] = {'payload': payload, 'merchant_request_id': merchant_request_id, 'result': None}
+            delay = self.random.uniform(*self.callback_delay)
+
+        timer = threading.Timer(delay, self._fire_callback, args=[checkout_request_id])
+        timer.daemon = True
+        self._timers.append(timer)
+        timer.start()
+
+        return 200, {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+    def query(self, payload):
+        checkout_request_id = payload.get('CheckoutRequestID')
+        with self._lock:
+            push = self.pushes.get(checkout_request_id)
+        if push is None:
+            return 400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid CheckoutRequestID'}
+        if push['result'] is None:
+            return 500, {'requestId': uuid.uuid4().hex, 'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'}
+
+        result_code, result_desc = push['result']
+        return 200, {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': push['merchant_request_id'],
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': str(result_code),
+            'ResultDesc': result_desc,
+        }
+
+    # --- Callbacks ---
+    def _fire_callback(self, checkout_request_id):
+        with self._lock:
+            push = self.pushes[checkout_request_id]
+            if self.random.random() < self.failure_rate:
+                push['result'] = self.random.choice(FAILURES)
+            else:
+                push['result'] = (0, 'The service request is processed successfully.')
+            deliveries = 2 if self.random.random() < self.duplicate_rate else 1
+            body = self.callback_body(checkout_request_id, push)
+
+        for _ in range(deliveries):
+            started = time.monotonic()
+            try:
+                self.deliver(push['payload'].get('CallBackURL'), body)
+            except Exception as e:
+                logger.error(f"Simulator could not deliver callback {checkout_request_id}: {e}")
+                with self._lock:
+                    self.callback_errors += 1
+                continue
+            with self._lock:
+                self.callback_latencies.append(time.monotonic() - started)
+
+    def callback_body(self, checkout_request_id, push):
+        result_code, result_desc = push['result']
+        callback = {
+            'MerchantRequestID': push['merchant_request_id'],
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': result_code,
+            'ResultDesc': result_desc,
+        }
+        if result_code == 0:
+            payload = push['payload']
+            callback['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': int(payload['Amount'])},
+                {'Name': 'MpesaReceiptNumber', 'Value': ''.join(self.random.choices(string.ascii_uppercase + string.digits, k=10))},
+                {'Name': 'TransactionDate', 'Value': int(f"{datetime.datetime.now():%Y%m%d%H%M%S}")},
+                {'Name': 'PhoneNumber', 'Value': int(payload['PhoneNumber'])},
+            ]}
+        return {'Body': {'stkCallback': callback}}
+
+    def post_callback(self, callback_url, body):
+        response = requests.post(callback_url, json=body, timeout=10)
+        response.raise_for_status()
+        return response
+
+    @property
+    def pending_callbacks(self):
+        with self._lock:
+            return sum(1 for push in self.pushes.values() if push['result'] is None)
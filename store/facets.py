@@ -0,0 +1,94 @@
+# store/facets.py
+"""
+Facet counts for the listing filter panel ("Brand (12)", "KES 500 - 999 (30)").
+
+compute_facets() gets per-brand AND per-price-bucket counts in ONE aggregate query:
+GROUP BY brand, with a filtered COUNT per price bucket, which are summed up in Python.
+Counts describe the base listing (category or search keyword) before brand/price
+filters, so get_facets() caches them per listing query and catalogue version and
+changing a filter costs no facet query at all.
+"""
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from .page_cache import queryset_cache_key
+
+# Lower bounds (KES) of the price buckets, on Product.min_price (the displayed price)
+PRICE_BUCKET_BOUNDS = [0, 500, 1000, 2000, 5000]
+FACET_CACHE_TIMEOUT = 10 * 60
+
+
+def price_buckets():
+    """[(low, high)] with high inclusive (same as the max_price filter) and None for the open top bucket."""
+    bounds = PRICE_BUCKET_BOUNDS + [None]
+    return [
+        (Decimal(low), Decimal(high) - Decimal('0.01') if high is not None else None)
+        for low, high in zip(bounds, bounds[1:])
+    ]
+
+
+def bucket_label(low, high):
+    if high is None:
+        return f"KES {low:,.0f}+"
+    if not low:
+        return f"Under KES {high + Decimal('0.01'):,.0f}"
+    return f"KES {low:,.0f} - {high:,.0f}"
+
+
+def compute_facets(products):
+    buckets = price_buckets()
+    bucket_counts = {
+        f'bucket_{i}': Count('id', filter=Q(min_price__gte=low) & (Q(min_price__lte=high) if high is not None else Q()))
+        for i, (low, high) in enumerate(buckets)
+    }
+    rows = (
+        products.order_by()
+        .values('brand_id', 'brand__name')
+        .annotate(product_count=Count('id'), **bucket_counts)
+        .order_by('brand__name')
+    )
+
+    brands = []
+    totals = [0] * len(buckets)
+    for row in rows:
+        brands.append({'id': row['brand_id'], 'name': row['brand__name'], 'count': row['product_count']})
+        for i in range(len(buckets)):
+            totals[i] += row[f'bucket_{i}']
+
+    return {
+        'brands': brands,
+        'price_buckets': [
+            {'min': low, 'max': high, 'label': bucket_label(low, high), 'count': count}
+            for (low, high), count in zip(buckets, totals)
+        ],
+    }
+
+
+def get_facets(products):
+    """Cached compute_facets() of the base (unfiltered) listing queryset."""
+    if products.query.is_empty():
+        return {'brands': [], 'price_buckets': []}
+    key = queryset_cache_key('store:facets', products)
+    facets = cache.get(key)
+    if facets is None:
+        facets = compute_facets(products)
+        cache.set(key, facets, FACET_CACHE_TIMEOUT)
+    return facets
+
+
+def price_bucket_links(request, facets):
+    """The non-empty buckets, each with the query string that applies it (other filters kept)."""
+    links = []
+    for bucket in facets['price_buckets']:
+        if not bucket['count']:
+            continue
+        params = request.GET.copy()
+        for param in ('page', 'cursor', 'min_price', 'max_price'):
+            params.pop(param, None)
+        params['min_price'] = bucket['min']
+        if bucket['max'] is not None:
+            params['max_price'] = bucket['max']
+        links.append(dict(bucket, query=params.urlencode()))
+    return links
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Product
+from store.page_cache import bump_catalogue_version
+from store.stock import rollup_product_stock
+
+
+class Command(BaseCommand):
+    help = "Recomputes the denormalized cheapest-variant price/size, variant count and stock on every Product."
+
+    def handle(self, *args, **options):
+        count = 0
+        for product in Product.objects.only('id').iterator():
+            product.refresh_variant_summary()
+            count += 1
+        rollup_product_stock()  # Product.stock = sum of the variants' stock (was sync_stock.py)
+        bump_catalogue_version()  # update() skips the signals
+
+        self.stdout.write(self.style.SUCCESS(f"Updated variant summary for {count} products."))
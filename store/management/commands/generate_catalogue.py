@@ -0,0 +1,190 @@
+import random
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from accounts.models import Account
+from carts.models import CartItem
+from orders.models import Order, OrderProduct
+from store import search
+from store.category_tree import invalidate_category_tree
+from store.page_cache import bump_catalogue_version
+from store.models import Brand, Category, Product, ProductVariant
+
+# Everything generated is prefixed so --clear can remove it without touching real data
+PREFIX = 'syn'
+BATCH_SIZE = 2000
+
+# Real top-level slugs the home page and store view look for, with generated children
+CATEGORY_TREE = {
+    'haircare': ['Shampoo', 'Conditioner', 'Hair Oil', 'Hair Mask', 'Styling Gel', 'Leave-In'],
+    'skincare': ['Cleanser', 'Toner', 'Serum', 'Moisturiser', 'Sunscreen', 'Face Mask'],
+    f'{PREFIX}-bodycare': ['Body Lotion', 'Body Wash', 'Body Butter'],
+    f'{PREFIX}-fragrance': ['Perfume', 'Body Mist'],
+}
+ADJECTIVES = ['Hydrating', 'Nourishing', 'Repair', 'Gentle', 'Clarifying', 'Brightening', 'Soothing',
+              'Intense', 'Daily', 'Silky', 'Argan', 'Shea', 'Coconut', 'Aloe', 'Charcoal', 'Vitamin C']
+INGREDIENTS = ['argan oil', 'shea butter', 'aloe vera', 'niacinamide', 'hyaluronic acid', 'tea tree',
+               'castor oil', 'vitamin e', 'glycerin', 'rosemary', 'honey', 'jojoba']
+SIZES = ['50ml', '100ml', '150ml', '250ml', '400ml', '500ml', '1L']
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates a large, reproducible synthetic catalogue (categories, brands, products, variants) "
+        "plus users with carts and orders, for benchmarking. Same --seed, same data."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=50000)
+        parser.add_argument('--brands', type=int, default=80)
+        parser.add_argument('--max-variants', type=int, default=3, help="Variants per product: 1 to this (default 3).")
+        parser.add_argument('--users', type=int, default=200, help="Users, each with a cart and some orders.")
+        parser.add_argument('--orders', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--clear', action='store_true', help="Delete previously generated data first.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        with transaction.atomic():
+            if options['clear']:
+                self.clear()
+            categories = self.create_categories()
+            brands = Brand.objects.bulk_create(
+                [Brand(name=f"{PREFIX.upper()} Brand {i:03d}") for i in range(options['brands'])]
+            )
+            product_count, variant_count = self.create_products(rng, options['products'], categories, brands, options['max_variants'])
+            users = self.create_users(options['users'])
+            line_count = self.create_carts(rng, users)
+            order_count = self.create_orders(rng, users, options['orders'])
+
+        # Bulk inserts skip the signals, so refresh the derived data once at the end
+        invalidate_category_tree()
+        bump_catalogue_version()
+        search.index_products()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {product_count} products, {variant_count} variants, {len(brands)} brands, "
+            f"{len(users)} users, {line_count} cart lines and {order_count} orders (seed {options['seed']})."
+        ))
+
+    def clear(self):
+        Order.objects.filter(order_number__startswith=PREFIX.upper()).delete()
+        Account.objects.filter(email__endswith=f'@{PREFIX}.example.com').delete()
+        Product.objects.filter(slug__startswith=f'{PREFIX}-').delete()
+        Brand.objects.filter(name__startswith=f'{PREFIX.upper()} Brand').delete()
+        Category.objects.filter(slug__startswith=f'{PREFIX}-').delete()
+        search.index_products()
+
+    def create_categories(self):
+        leaves = []
+        for root_slug, children in CATEGORY_TREE.items():
+            root, _ = Category.objects.get_or_create(
+                slug=root_slug, defaults={'name': root_slug.replace(f'{PREFIX}-', '').title()}
+            )
+            for name in children:
+                slug = f"{PREFIX}-{root_slug.replace(f'{PREFIX}-', '')}-{name.lower().replace(' ', '-')}"
+                child, _ = Category.objects.get_or_create(slug=slug, defaults={'name': name, 'parent': root})
+                leaves.append(child)
+        return leaves
+
+    def create_products(self, rng, count, categories, brands, max_variants):
+        product_count = variant_count = 0
+        for start in range(0, count, BATCH_SIZE):
+            products, variant_specs = [], []
+            for i in range(start, min(start + BATCH_SIZE, count)):
+                category = rng.choice(categories)
+                name = f"{rng.choice(ADJECTIVES)} {category.name} {i:06d}"
+                # One row per size (product + size is unique), cheapest first
+                variants = sorted(
+                    (Decimal(rng.randrange(150, 9000, 10)), size, rng.randint(0, 40))
+                    for size in rng.sample(SIZES, rng.randint(1, min(max_variants, len(SIZES))))
+                )
+                cheapest = variants[0]
+                products.append(Product(
+                    category=category,
+                    brand=rng.choice(brands),
+                    name=name,
+                    slug=f"{PREFIX}-{i:06d}",
+                    description=f"{name} with {rng.choice(INGREDIENTS)} and {rng.choice(INGREDIENTS)}.",
+                    stock=sum(stock for _, _, stock in variants),
+                    available=rng.random() > 0.05,
+                    image='',
+                    # Same values refresh_variant_summary() would compute (all variants are active)
+                    min_price=cheapest[0],
+                    display_size=cheapest[1],
+                    variant_count=len(variants),
+                ))
+                variant_specs.append(variants)
+
+            products = Product.objects.bulk_create(products)
+            ProductVariant.objects.bulk_create([
+                ProductVariant(product=product, size_ml_g=size, price=price, stock=stock)
+                for product, variants in zip(products, variant_specs)
+                for price, size, stock in variants
+            ], batch_size=BATCH_SIZE)
+            product_count += len(products)
+            variant_count += sum(len(variants) for variants in variant_specs)
+            self.stdout.write(f"  {product_count}/{count} products")
+        return product_count, variant_count
+
+    def create_users(self, count):
+        password = make_password(None)  # unusable: these accounts can't log in
+        Account.objects.bulk_create([
+            Account(first_name='Synthetic', last_name=f'User {i}', username=f'{PREFIX}user{i}',
+                    email=f'user{i}@{PREFIX}.example.com', password=password, is_active=True)
+            for i in range(count)
+        ])
+        return list(Account.objects.filter(email__endswith=f'@{PREFIX}.example.com').order_by('id'))
+
+    def sample_variants(self, rng, size):
+        # Random synthetic variants, picked in Python from the id list (no ORDER BY RANDOM() scan)
+        ids = list(ProductVariant.objects.filter(product__slug__startswith=f'{PREFIX}-').order_by('id').values_list('id', flat=True))
+        chosen = [rng.choice(ids) for _ in range(size)] if ids else []
+        by_id = ProductVariant.objects.select_related('product').in_bulk(set(chosen))
+        return [by_id[variant_id] for variant_id in chosen]
+
+    def create_carts(self, rng, users):
+        lines = []
+        variants = iter(self.sample_variants(rng, len(users) * 4))
+        for user in users:
+            seen = set()
+            for _ in range(rng.randint(0, 4)):
+                variant = next(variants, None)
+                if variant is None or variant.id in seen:
+                    continue
+                seen.add(variant.id)
+                lines.append(CartItem(user=user, product=variant.product, variant=variant, quantity=rng.randint(1, 3)))
+        CartItem.objects.bulk_create(lines, batch_size=BATCH_SIZE)
+        return len(lines)
+
+    def create_orders(self, rng, users, count):
+        if not users or not count:
+            return 0
+        variants = iter(self.sample_variants(rng, count * 3))
+        orders, order_lines = [], []
+        for i in range(count):
+            user = rng.choice(users)
+            items = [variant for variant in (next(variants, None) for _ in range(rng.randint(1, 3))) if variant]
+            quantities = [rng.randint(1, 2) for _ in items]
+            total = sum((variant.price * quantity for variant, quantity in zip(items, quantities)), Decimal('0.00'))
+            paid = rng.random() < 0.8
+            orders.append(Order(
+                user=user, order_number=f"{PREFIX.upper()}{i:07d}", first_name=user.first_name, last_name=user.last_name,
+                phone='0712345678', email=user.email, estate='Kilimani', city='Nairobi', delivery_fee=100,
+                order_total=total, grand_total=total + 100, status='Accepted' if paid else 'New', is_ordered=paid,
+            ))
+            order_lines.append(list(zip(items, quantities)))
+
+        orders = Order.objects.bulk_create(orders, batch_size=BATCH_SIZE)
+        OrderProduct.objects.bulk_create([
+            OrderProduct(order=order, user=order.user, product=variant.product, product_variant=variant, quantity=quantity,
+                         product_price=variant.price, ordered=order.is_ordered,
+                         product_name=variant.product.name, variant_details=variant.size_ml_g)
+            for order, lines in zip(orders, order_lines)
+            for variant, quantity in lines
+        ], batch_size=BATCH_SIZE)
+        return len(orders)
@@ -0,0 +1,261 @@
+import json
+import secrets
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from accounts.models import Account
+from carts.models import CartItem
+from orders.models import Order, Payment
+from store import callback_inbox, mpesa_utils, payments, stk_jobs
+from store.daraja_simulator import DarajaSimulator
+from store.management.commands.run_daraja_simulator import delay_range
+from store.models import Brand, Category, MpesaCallback, Product, ProductVariant, StkPushJob
+
+# One customer per concurrent checkout (a cart belongs to its user); reused across runs
+LOADTEST_USERNAME = 'loadtest{}'
+LOADTEST_DOMAIN = '@azara.local'
+ORDER_FORM = {
+    'first_name': 'Load', 'last_name': 'Test', 'phone': '0712345678',
+    'estate': '', 'city': '', 'order_note': 'load test',
+}
+
+
+def percentile(values, q):
+    """Nearest-rank percentile (q in 0-100) of a list of seconds."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+class Command(BaseCommand):
+    help = (
+        "End-to-end payment load test: N concurrent customers, each logged in with a one-line cart, "
+        "go through place_order and the payment POST (the real views), the STK worker and the callback "
+        "inbox, against the local Daraja simulator. Reports p50/p95/p99 per stage."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=50)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--stk-threads', type=int, default=4, help="STK worker pool size.")
+        parser.add_argument('--delay', type=delay_range, default=(0.5, 2.0), help="Simulated callback delay, e.g. 0.5-2.")
+        parser.add_argument('--failure-rate', type=float, default=0.1)
+        parser.add_argument('--duplicate-rate', type=float, default=0.2)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--timeout', type=float, default=60, help="Seconds to wait for each checkout to settle.")
+        parser.add_argument('--keep', action='store_true', help="Keep the generated product and orders afterwards.")
+        parser.add_argument('--force', action='store_true', help="Run even with DEBUG off (it writes test orders).")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError("This writes test orders to the database; run it with DEBUG=True or pass --force.")
+
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.outcomes = Counter()
+        self.lock = threading.Lock()
+        self.order_ids = []
+
+        simulator = DarajaSimulator(
+            callback_delay=options['delay'], failure_rate=options['failure_rate'],
+            duplicate_rate=options['duplicate_rate'], seed=options['seed'], deliver=self.deliver_callback,
+        ).start()
+        previous_client = mpesa_utils.set_client(mpesa_utils.DarajaClient(
+            base_url=simulator.url, consumer_key='simulator', consumer_secret='simulator',
+            passkey='simulator', callback_base_url='http://testserver',
+        ))
+        variant, users = self.create_carts(options['checkouts'])
+        stop = threading.Event()
+        workers = [
+            threading.Thread(target=self.run_stk_worker, args=[stop, options['stk_threads']], daemon=True),
+            threading.Thread(target=self.run_callback_processor, args=[stop], daemon=True),
+        ]
+
+        started = time.monotonic()
+        try:
+            for worker in workers:
+                worker.start()
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+                list(pool.map(lambda user: self.checkout(user, options['timeout']), users))
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+            simulator.stop()
+            mpesa_utils.set_client(previous_client)
+        elapsed = time.monotonic() - started
+
+        checkout_ids = self.collect_db_stages(self.order_ids)
+        self.latencies['callback_ack'] = simulator.callback_latencies
+        self.errors['callback_ack'] += simulator.callback_errors
+        self.report(len(users), elapsed)
+
+        if not options['keep']:
+            MpesaCallback.objects.filter(checkout_request_id__in=checkout_ids).delete()
+            Order.objects.filter(user__in=users).delete()  # these customers only ever place load-test orders
+            Payment.objects.filter(user__in=users).delete()
+            CartItem.objects.filter(user__in=users).delete()
+            variant.product.delete()
+
+    # --- Setup ---
+    def create_carts(self, count):
+        """A product with a variant stocked for every checkout, and that many customers with it in their cart."""
+        run = secrets.token_hex(4).lower()
+        category, _ = Category.objects.get_or_create(slug='loadtest', defaults={'name': 'Load test'})
+        brand, _ = Brand.objects.get_or_create(name='Load test')
+        product = Product.objects.create(
+            category=category, brand=brand, stock=count, name=f'Load test {run}', slug=f'loadtest-{run}',
+            description='Load test product', available=False,  # never listed in the shop
+        )
+        variant = ProductVariant.objects.create(product=product, size_ml_g='100ml', price=500, stock=count)
+
+        usernames = [LOADTEST_USERNAME.format(i) for i in range(count)]
+        existing = set(Account.objects.filter(username__in=usernames).values_list('username', flat=True))
+        Account.objects.bulk_create([
+            # No usable password ('!'): these accounts can't be logged into from outside
+            Account(first_name='Load', last_name='Test', username=username, email=username + LOADTEST_DOMAIN, password='!')
+            for username in usernames if username not in existing
+        ])
+        users = list(Account.objects.filter(username__in=usernames).order_by('id'))
+        Account.objects.filter(username__in=usernames).update(is_active=True)
+
+        CartItem.objects.filter(user__in=users).delete()
+        CartItem.objects.bulk_create([CartItem(user=user, product=product, variant=variant, quantity=1) for user in users])
+        return variant, users
+
+    # --- Stages ---
+    def record(self, stage, seconds=None, error=False):
+        with self.lock:
+            if error:
+                self.errors[stage] += 1
+            else:
+                self.latencies[stage].append(seconds)
+
+    def checkout(self, user, timeout):
+        """
+        Stage 'place_order': the order form POST (order, lines and stock holds).
+        Stage 'checkout': the payment POST. Stage 'settle': payment POST -> order paid/failed.
+        """
+        stage = 'place_order'
+        try:
+            client = Client()
+            client.force_login(user)
+            started = time.monotonic()
+            response = client.post(reverse('orders:place_order'), dict(ORDER_FORM, email=user.email))
+            order_id = Order.objects.filter(user=user).order_by('-id').values_list('id', flat=True).first()
+            if response.status_code != 200 or order_id is None:
+                self.record(stage, error=True)
+                return
+            self.record(stage, time.monotonic() - started)
+            with self.lock:
+                self.order_ids.append(order_id)
+
+            stage = 'checkout'
+            started = time.monotonic()
+            response = client.post(reverse('store:stk_push_request', args=[order_id]), {'phone_number': '0712345678'})
+            if response.status_code != 200:
+                self.record(stage, error=True)
+                return
+            self.record(stage, time.monotonic() - started)
+
+            while time.monotonic() - started < timeout:
+                state = payments.get_payment_status(order_id)['state']
+                if state in payments.FINAL_STATES:
+                    self.record('settle', time.monotonic() - started)
+                    with self.lock:
+                        self.outcomes[state] += 1
+                    return
+                time.sleep(0.05)
+            self.record('settle', error=True)
+            with self.lock:
+                self.outcomes['timeout'] += 1
+        except Exception as e:
+            self.stderr.write(f"Checkout for {user.username} failed at {stage}: {e}")
+            self.record(stage, error=True)
+        finally:
+            connection.close()
+
+    def deliver_callback(self, callback_url, body):
+        """Posts the simulator's callback to the real webhook view (stage 'callback_ack')."""
+        try:
+            response = Client().post(reverse('store:mpesa_callback'), json.dumps(body), content_type='application/json')
+        finally:
+            connection.close()
+        if response.status_code != 200:
+            raise RuntimeError(f"webhook answered {response.status_code}")
+
+    def run_stk_worker(self, stop, threads):
+        def run(job):
+            try:
+                return stk_jobs.run_job(job)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            while not stop.is_set():
+                jobs = self.safely(stk_jobs.claim_jobs, 'stk_push', 20) or []
+                list(pool.map(run, jobs))
+                if not jobs:
+                    time.sleep(0.05)
+        connection.close()
+
+    def run_callback_processor(self, stop):
+        while not stop.is_set():
+            if not self.safely(callback_inbox.process_pending, 'callback_processing', 50):
+                time.sleep(0.05)
+        connection.close()
+
+    def safely(self, func, stage, *args):
+        try:
+            return func(*args)
+        except Exception as e:
+            # e.g. SQLite "database is locked" under write contention: count it and keep going
+            self.stderr.write(f"{stage}: {e}")
+            self.record(stage, error=True)
+            return None
+
+    def collect_db_stages(self, order_ids):
+        """
+        Stage 'stk_push': job queued -> Daraja answered (queue wait + OAuth + processrequest).
+        Stage 'callback_processing': callback stored -> applied to the order.
+        Returns the run's CheckoutRequestIDs.
+        """
+        jobs = StkPushJob.objects.filter(order_id__in=order_ids).values_list('status', 'created_at', 'finished_at', 'checkout_request_id')
+        checkout_ids = []
+        for status, created_at, finished_at, checkout_request_id in jobs:
+            if status == StkPushJob.SENT and finished_at:
+                self.latencies['stk_push'].append((finished_at - created_at).total_seconds())
+                checkout_ids.append(checkout_request_id)
+            else:
+                self.errors['stk_push'] += 1
+
+        callbacks = MpesaCallback.objects.filter(checkout_request_id__in=checkout_ids).values_list('status', 'received_at', 'processed_at')
+        for status, received_at, processed_at in callbacks:
+            if status == MpesaCallback.PROCESSED:
+                self.latencies['callback_processing'].append((processed_at - received_at).total_seconds())
+            else:
+                self.errors['callback_processing'] += 1
+        return checkout_ids
+
+    # --- Report ---
+    def report(self, checkouts, elapsed):
+        self.stdout.write(f"\n{checkouts} checkouts in {elapsed:.2f}s ({checkouts / elapsed:.1f}/s)")
+        self.stdout.write(f"{'stage':<22}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+        stages = ['place_order', 'checkout', 'stk_push', 'callback_ack', 'callback_processing', 'settle']
+        for stage in stages:
+            values = self.latencies.get(stage, [])
+            self.stdout.write(
+                f"{stage:<22}{len(values):>7}"
+                + ''.join(f"{percentile(values, q) * 1000:>10.1f}" for q in (50, 95, 99, 100))
+                + f"{self.errors.get(stage, 0):>8}"
+            )
+        self.stdout.write("Outcomes: " + ", ".join(f"{state}={count}" for state, count in sorted(self.outcomes.items())))
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from store import callback_inbox
+
+
+class Command(BaseCommand):
+    help = "Drains the M-Pesa callback inbox (retrying failures), or replays stored callbacks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=50, help="Callbacks claimed per poll (default 50).")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds to sleep when the inbox is empty.")
+        parser.add_argument('--once', action='store_true', help="Drain what is due once and exit (cron / tests).")
+        parser.add_argument('--replay', type=int, nargs='+', metavar='ID', help="Re-queue these inbox rows, then drain.")
+        parser.add_argument('--replay-checkout', metavar='CHECKOUT_REQUEST_ID', help="Re-queue every callback for this CheckoutRequestID, then drain.")
+
+    def handle(self, *args, **options):
+        if options['replay'] or options['replay_checkout']:
+            count = callback_inbox.replay(options['replay'], options['replay_checkout'])
+            self.stdout.write(f"Re-queued {count} callback(s).")
+
+        while True:
+            close_old_connections()
+            counts = callback_inbox.process_pending(options['batch'])
+            if counts:
+                self.stdout.write(", ".join(f"{count} {status.lower()}" for status, count in sorted(counts.items())))
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['poll_interval'])
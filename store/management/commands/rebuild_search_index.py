@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from store import search
+from store.models import Product
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the full-text product search index (SQLite FTS5 / Postgres tsvector) from scratch."
+
+    def handle(self, *args, **options):
+        if search.get_backend() is None:
+            self.stdout.write(self.style.WARNING("No full-text backend for this database; search uses icontains."))
+            return
+
+        search.create_index(populate=False)
+        search.index_products()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {Product.objects.count()} products."))
@@ -0,0 +1,38 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from store import reconcile
+from store.mpesa_utils import DarajaClient
+
+
+class Command(BaseCommand):
+    help = "Settles 'Pending' M-Pesa transactions whose callback never came, using Daraja's STK Push Query API."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=int(reconcile.STALE_AFTER.total_seconds()),
+                            help="Only transactions pending at least this many seconds (default %(default)s).")
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--max-batches', type=int, default=5, help="Batches per run (default 5).")
+        parser.add_argument('--rate', type=float, default=5, help="Max Daraja queries per second (default 5).")
+        parser.add_argument('--api-url', help="Daraja base URL, e.g. a local stub at http://127.0.0.1:8001.")
+        parser.add_argument('--loop', type=float, metavar='SECONDS', help="Keep running, one pass every SECONDS.")
+
+    def handle(self, *args, **options):
+        client = DarajaClient(base_url=options['api_url']) if options['api_url'] else None
+
+        while True:
+            close_old_connections()
+            report = reconcile.reconcile_pending(
+                client=client,
+                older_than=datetime.timedelta(seconds=options['older_than']),
+                batch_size=options['batch_size'],
+                max_batches=options['max_batches'],
+                rate_per_second=options['rate'],
+            )
+            self.stdout.write(report.summary())
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
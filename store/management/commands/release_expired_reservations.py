@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from store import stock
+
+
+class Command(BaseCommand):
+    help = "Puts back the stock held by unpaid orders whose reservation has expired."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--loop', type=float, metavar='SECONDS', help="Keep running, one pass every SECONDS.")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            released = 0
+            while True:
+                count = stock.release_expired(limit=options['batch_size'])
+                released += count
+                if count < options['batch_size']:
+                    break
+            self.stdout.write(f"Released {released} expired reservations.")
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
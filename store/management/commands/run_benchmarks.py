@@ -0,0 +1,174 @@
+import datetime
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from accounts.models import Account
+from carts.models import CartItem
+from carts.pricing import price_cart
+from store.management.commands.loadtest_payments import percentile
+from store.models import Brand, Product, ProductVariant
+from store.showcase import build_showcase
+from store.views import LISTING_PAGE_SIZE, apply_product_filters
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the main store views (through the test client) and model helpers on the current "
+        "database, with query counts, and compares them against a saved baseline. "
+        "Use generate_catalogue first for a realistic data size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help="Timed runs per benchmark (after one warm-up run).")
+        parser.add_argument('--only', nargs='+', default=[], help="Only run benchmarks whose name contains one of these.")
+        parser.add_argument('--output', help="Write the results to this JSON file.")
+        parser.add_argument('--baseline', help="Compare against a JSON file written by --output.")
+        parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed median slowdown vs the baseline (default 0.2 = 20%%).")
+        parser.add_argument('--fail-on-regression', action='store_true', help="Exit with an error if anything regressed.")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            try:
+                with open(options['baseline']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not read baseline {options['baseline']}: {e}")
+
+        benchmarks = [
+            (name, func) for name, func in self.benchmarks()
+            if not options['only'] or any(part in name for part in options['only'])
+        ]
+        if not benchmarks:
+            raise CommandError("No benchmarks to run (empty catalogue, or nothing matches --only).")
+
+        results = {}
+        for name, func in benchmarks:
+            results[name] = self.measure(func, options['repeat'])
+            self.stdout.write(f"  {name}: {results[name]['median_ms']:.1f} ms, {results[name]['queries']} queries")
+
+        report = {'meta': self.meta(options['repeat']), 'results': results}
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        regressions = self.report(results, baseline, options['tolerance'])
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f"{len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+
+    # --- Benchmarks ---
+    def benchmarks(self):
+        """(name, callable) pairs. Views go through the full middleware/template stack."""
+        product = Product.objects.filter(available=True).select_related('category').order_by('-created').first()
+        if product is None:
+            return []
+        # A guest with a session: without one every timed request after the warm-up would be an
+        # anonymous full-page cache hit (store/page_cache.py), timing cache.get instead of the view
+        client = Client()
+        session = client.session
+        session['benchmark'] = True
+        session.save()
+        factory = RequestFactory()
+        brand_ids = list(Brand.objects.annotate(n=Count('products')).order_by('-n').values_list('id', flat=True)[:3])
+        available = Product.objects.filter(available=True)
+        deep_page = max(1, available.count() // LISTING_PAGE_SIZE // 2)
+        filters = {'brands': brand_ids, 'min_price': 500, 'max_price': 3000}
+
+        def get(url, data=None, on=client):
+            def run():
+                response = on.get(url, data)
+                if response.status_code != 200:
+                    raise CommandError(f"GET {url} answered {response.status_code}")
+            return run
+
+        def filtered_listing():
+            products, _ = apply_product_filters(factory.get('/store/', filters), available.order_by('-created'))
+            list(products[:LISTING_PAGE_SIZE])
+
+        benchmarks = [
+            ('view.home', get(reverse('store:home'))),
+            ('view.store', get(reverse('store:store'))),
+            ('view.store_category', get(reverse('store:products_by_category', args=['haircare']))),
+            ('view.store_filtered', get(reverse('store:store'), filters)),
+            ('view.store_deep_page', get(reverse('store:store'), {'page': deep_page})),
+            ('view.search', get(reverse('store:search'), {'keyword': 'hydrating shampoo'})),
+            ('view.search_typo', get(reverse('store:search'), {'keyword': 'shampo'})),
+            ('view.product_detail', get(product.get_url())),
+            ('helper.build_showcase', lambda: build_showcase('haircare')),
+            ('helper.apply_product_filters', filtered_listing),
+        ]
+
+        # Cart: the user with the biggest cart, logged in on a separate client
+        shopper_id = (CartItem.objects.filter(user__isnull=False, is_active=True)
+                      .values('user_id').annotate(n=Count('id')).order_by('-n').values_list('user_id', flat=True).first())
+        if shopper_id:
+            shopper_client = Client()
+            shopper_client.force_login(Account.objects.get(pk=shopper_id))
+            benchmarks += [
+                ('view.cart', get(reverse('carts:cart'), on=shopper_client)),
+                ('helper.price_cart', lambda: price_cart(CartItem.objects.filter(user_id=shopper_id, is_active=True))),
+            ]
+        return benchmarks
+
+    def measure(self, func, repeat):
+        func()  # warm-up: fills the in-process caches (category tree, search vocabulary...)
+        timings = []
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(repeat):
+                started = time.perf_counter()
+                func()
+                timings.append(time.perf_counter() - started)
+        return {
+            'median_ms': round(statistics.median(timings) * 1000, 2),
+            'p95_ms': round(percentile(timings, 95) * 1000, 2),
+            'queries': round(len(queries) / repeat),
+        }
+
+    def meta(self, repeat):
+        return {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'database': connection.vendor,
+            'products': Product.objects.count(),
+            'variants': ProductVariant.objects.count(),
+            'repeat': repeat,
+        }
+
+    # --- Report ---
+    def report(self, results, baseline, tolerance):
+        """Prints the results (and the diff against the baseline). Returns the names that regressed."""
+        base = (baseline or {}).get('results', {})
+        if baseline:
+            meta = baseline.get('meta', {})
+            self.stdout.write(f"\nBaseline: {meta.get('date')} ({meta.get('products')} products on {meta.get('database')})")
+
+        self.stdout.write(f"\n{'benchmark':<30}{'median ms':>11}{'p95 ms':>10}{'queries':>9}{'base ms':>10}{'change':>9}{'base q':>8}")
+        regressions = []
+        for name, result in results.items():
+            line = f"{name:<30}{result['median_ms']:>11.1f}{result['p95_ms']:>10.1f}{result['queries']:>9}"
+            previous = base.get(name)
+            if previous:
+                change = (result['median_ms'] - previous['median_ms']) / previous['median_ms'] if previous['median_ms'] else 0.0
+                # Sub-millisecond jitter isn't a regression; an extra query always is
+                slower = change > tolerance and result['median_ms'] - previous['median_ms'] > 1
+                more_queries = result['queries'] > previous['queries']
+                line += f"{previous['median_ms']:>10.1f}{change:>+9.0%}{previous['queries']:>8}"
+                if slower or more_queries:
+                    regressions.append(name)
+                    line = self.style.ERROR(line + "  REGRESSION")
+                elif change < -tolerance:
+                    line = self.style.SUCCESS(line)
+            self.stdout.write(line)
+
+        missing = sorted(set(base) - set(results))
+        if missing:
+            self.stdout.write(f"Not run this time: {', '.join(missing)}")
+        return regressions
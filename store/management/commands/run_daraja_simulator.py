@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.daraja_simulator import DarajaSimulator
+
+
+def delay_range(value):
+    """'2' -> (2.0, 2.0), '1-3' -> (1.0, 3.0)"""
+    low, _, high = value.partition('-')
+    return float(low), float(high or low)
+
+
+class Command(BaseCommand):
+    help = "Runs a local Daraja stand-in (OAuth, STK push, STK query) that fires callbacks back at the shop."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--delay', type=delay_range, default=(1.0, 3.0), help="Callback delay in seconds, e.g. 2 or 1-3.")
+        parser.add_argument('--failure-rate', type=float, default=0.1, help="Share of pushes that fail (0-1).")
+        parser.add_argument('--duplicate-rate', type=float, default=0.1, help="Share of callbacks delivered twice (0-1).")
+        parser.add_argument('--seed', type=int, help="Fixed random seed for repeatable runs.")
+
+    def handle(self, *args, **options):
+        simulator = DarajaSimulator(
+            host=options['host'], port=options['port'], callback_delay=options['delay'],
+            failure_rate=options['failure_rate'], duplicate_rate=options['duplicate_rate'], seed=options['seed'],
+        )
+        try:
+            simulator.start()
+        except OSError as e:
+            raise CommandError(f"Could not listen on {options['host']}:{options['port']}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(f"Daraja simulator on {simulator.url}"))
+        self.stdout.write(f"Start the shop with MPESA_API_URL={simulator.url} (callbacks go to APP_URL/mpesa/callback/).")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            simulator.stop()
+            self.stdout.write(f"Pushes: {len(simulator.pushes)}, callbacks delivered: {len(simulator.callback_latencies)}, "
+                              f"delivery errors: {simulator.callback_errors}")
@@ -0,0 +1,65 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from store import stk_jobs
+from store.models import StkPushJob
+
+logger = logging.getLogger(__name__)
+
+
+def _run(job):
+    # run_job fails the job on any error; this only catches the database itself being down.
+    # The job then stays 'Running' until fail_stale_jobs() fails it, and the loop goes on.
+    try:
+        return stk_jobs.run_job(job)
+    except Exception:
+        logger.exception(f"STK job {job.id} could not be recorded")
+        return StkPushJob.FAILED
+
+
+def _run_in_thread(job):
+    # Each pool thread has its own DB connection; close it so it isn't leaked
+    try:
+        return _run(job)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Runs the STK push worker pool: claims queued StkPushJobs and sends them to Daraja."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4, help="Concurrent Daraja calls (default 4; 1 = no pool).")
+        parser.add_argument('--batch', type=int, default=20, help="Jobs claimed per poll (default 20).")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds to sleep when the queue is empty.")
+        parser.add_argument('--once', action='store_true', help="Drain the queue once and exit (cron / tests).")
+
+    def handle(self, *args, **options):
+        threads = max(options['threads'], 1)
+        # With a single thread, jobs simply run here on this command's own DB connection
+        pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.stdout.write(f"STK worker started with {threads} thread(s).")
+
+        try:
+            while True:
+                close_old_connections()
+                stale = stk_jobs.fail_stale_jobs()
+                if stale:
+                    self.stdout.write(self.style.WARNING(f"Failed {stale} stale job(s)."))
+
+                jobs = stk_jobs.claim_jobs(options['batch'])
+                results = list(pool.map(_run_in_thread, jobs) if pool else map(_run, jobs))
+                if results:
+                    self.stdout.write(f"Processed {len(results)} job(s): {results.count('Sent')} sent, {results.count('Failed')} failed.")
+
+                if not jobs:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+        finally:
+            if pool:
+                pool.shutdown()
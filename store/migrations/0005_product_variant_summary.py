@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-17 20:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0004_product_is_available_product_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='display_size',
+            field=models.CharField(blank=True, default='', editable=False, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='min_price',
+            field=models.DecimalField(blank=True, db_index=True, decimal_places=2, editable=False, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='variant_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from store import search
+    search.create_index(schema_editor.connection)
+
+
+def drop_search_index(apps, schema_editor):
+    from store import search
+    search.drop_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0005_product_variant_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
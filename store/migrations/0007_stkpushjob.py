@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2026-10-17 20:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0007_order_delivery_fee'),
+        ('store', '0006_product_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StkPushJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phone_number', models.CharField(max_length=15)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('status', models.CharField(choices=[('Queued', 'Queued'), ('Running', 'Running'), ('Sent', 'Sent'), ('Failed', 'Failed')], default='Queued', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('checkout_request_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('message', models.CharField(blank=True, max_length=255, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stk_push_jobs', to='orders.order')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='stkpushjob',
+            index=models.Index(fields=['status', 'created_at'], name='stkjob_status_created_idx'),
+        ),
+    ]
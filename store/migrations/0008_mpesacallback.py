@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-17 21:04
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0007_stkpushjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MpesaCallback',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField()),
+                ('checkout_request_id', models.CharField(blank=True, db_index=True, max_length=100, null=True)),
+                ('status', models.CharField(choices=[('Pending', 'Pending'), ('Processing', 'Processing'), ('Processed', 'Processed'), ('Failed', 'Failed')], default='Pending', max_length=10)),
+                ('outcome', models.CharField(blank=True, max_length=20, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mpesacallback',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='mpesacb_status_next_idx'),
+        ),
+    ]
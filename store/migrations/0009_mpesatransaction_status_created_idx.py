@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 21:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0008_mpesacallback'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['status', 'created_at'], name='mpesatxn_status_created_idx'),
+        ),
+    ]
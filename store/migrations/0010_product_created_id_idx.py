@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 21:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0009_mpesatransaction_status_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['created', 'id'], name='product_created_id_idx'),
+        ),
+    ]
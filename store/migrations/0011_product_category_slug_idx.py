@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 21:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0010_product_created_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'slug'], name='product_category_slug_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2 on 2026-10-17 21:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0007_order_delivery_fee'),
+        ('store', '0011_product_category_slug_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('Held', 'Held'), ('Committed', 'Committed'), ('Released', 'Released')], default='Held', max_length=10)),
+                ('expires_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_reservations', to='orders.order')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_reservations', to='store.product')),
+                ('variant', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stock_reservations', to='store.productvariant')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='stockreservation',
+            index=models.Index(fields=['status', 'expires_at'], name='stockres_status_expires_idx'),
+        ),
+    ]
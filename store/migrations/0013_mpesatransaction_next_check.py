@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-17 21:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_stockreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='check_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='next_check_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
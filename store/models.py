@@ -1,6 +1,7 @@
 from django.db import models
 from django.urls import reverse
 from django.conf import settings 
+from django.utils import timezone
 
 # 1. CATEGORY MODEL
 class Category(models.Model):
@@ -50,9 +51,22 @@ class Product(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    # Denormalized "cheapest active variant" summary.
+    # Kept in sync by store/signals.py whenever a ProductVariant is saved or deleted,
+    # so listing pages can show price/size without hitting the variants table per card.
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, db_index=True, editable=False)
+    display_size = models.CharField(max_length=50, blank=True, default='', editable=False)
+    variant_count = models.PositiveIntegerField(default=0, editable=False)
+
     class Meta:
         ordering = ('name',)
         index_together = (('id', 'slug'),)
+        # Listing order (newest first) and the keyset cursor, see store/pagination.py
+        indexes = [
+            models.Index(fields=['created', 'id'], name='product_created_id_idx'),
+            # Product detail lookup: /store/<category_slug>/<product_slug>/
+            models.Index(fields=['category', 'slug'], name='product_category_slug_idx'),
+        ]
 
     def __str__(self):
         return f"{self.brand.name} - {self.name}"
@@ -60,17 +74,33 @@ class Product(models.Model):
     def get_url(self):
         return reverse('store:product_detail', args=[self.category.slug, self.slug])
 
-    # Logic to fetch price from variants
+    # Price of the cheapest active variant (read from the denormalized column)
     @property
     def get_display_price(self):
-        cheapest_variant = self.variants.filter(is_active=True).order_by('price').first()
-        return cheapest_variant.price if cheapest_variant else 0.00
+        return self.min_price if self.min_price is not None else 0.00
     
-    # Logic to fetch size from variants
+    # Size of the cheapest active variant (read from the denormalized column)
     @property
     def get_display_size(self):
-        cheapest_variant = self.variants.filter(is_active=True).order_by('price').first()
-        return cheapest_variant.size_ml_g if cheapest_variant else "N/A"
+        return self.display_size if self.variant_count else "N/A"
+
+    def refresh_variant_summary(self):
+        """
+        Recomputes min_price / display_size / variant_count from the active variants
+        and writes them with a single UPDATE (does not touch 'updated' or other fields).
+        """
+        active_variants = self.variants.filter(is_active=True)
+        cheapest_variant = active_variants.order_by('price', 'id').first()
+
+        self.min_price = cheapest_variant.price if cheapest_variant else None
+        self.display_size = cheapest_variant.size_ml_g if cheapest_variant else ''
+        self.variant_count = active_variants.count() if cheapest_variant else 0
+
+        Product.objects.filter(pk=self.pk).update(
+            min_price=self.min_price,
+            display_size=self.display_size,
+            variant_count=self.variant_count,
+        )
 
 # 4. PRODUCT VARIANT MODEL
 class ProductVariant(models.Model):
@@ -101,8 +131,105 @@ class MpesaTransaction(models.Model):
     phone_number = models.CharField(max_length=15, blank=True, null=True)
     status = models.CharField(max_length=20, default='Pending') # Pending, Successful, Failed
     result_desc = models.TextField(blank=True, null=True) # Error message from M-PESA if any
+
+    # reconcile_mpesa: STK Push Queries made so far for a 'Pending' one, and when to ask again
+    check_attempts = models.PositiveSmallIntegerField(default=0)
+    next_check_at = models.DateTimeField(blank=True, null=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # reconcile_mpesa scans for old 'Pending' rows
+        indexes = [models.Index(fields=['status', 'created_at'], name='mpesatxn_status_created_idx')]
+
+    def __str__(self):
+        return f"M-PESA {self.mpesa_receipt_number or 'Pending'} - {self.status}"
+
+class StkPushJob(models.Model):
+    """
+    A queued STK push. The checkout view only inserts one of these; the
+    `run_stk_worker` command does the Daraja calls and creates the MpesaTransaction.
+    """
+    QUEUED = 'Queued'
+    RUNNING = 'Running'
+    SENT = 'Sent'        # Daraja accepted it: the prompt is on the customer's phone
+    FAILED = 'Failed'
+    STATUS_CHOICES = [(QUEUED, QUEUED), (RUNNING, RUNNING), (SENT, SENT), (FAILED, FAILED)]
+
+    order = models.ForeignKey('orders.Order', on_delete=models.CASCADE, related_name='stk_push_jobs')
+    phone_number = models.CharField(max_length=15)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    checkout_request_id = models.CharField(max_length=100, blank=True, null=True)
+    message = models.CharField(max_length=255, blank=True, null=True)  # CustomerMessage / error shown on the waiting page
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'], name='stkjob_status_created_idx')]
+
+    @property
+    def is_finished(self):
+        return self.status in (self.SENT, self.FAILED)
+
+    def __str__(self):
+        return f"STK job #{self.id} for order {self.order_id} - {self.status}"
+
+
+class MpesaCallback(models.Model):
+    """
+    Inbox of raw Daraja callbacks. The webhook only appends a row here and acks;
+    `process_mpesa_callbacks` applies them later (with retries) and any row can be replayed.
+    The stored body is never modified.
+    """
+    PENDING = 'Pending'
+    PROCESSING = 'Processing'
+    PROCESSED = 'Processed'
+    FAILED = 'Failed'        # gave up after MAX_ATTEMPTS; replay to try again
+    STATUS_CHOICES = [(PENDING, PENDING), (PROCESSING, PROCESSING), (PROCESSED, PROCESSED), (FAILED, FAILED)]
+
+    body = models.TextField()
+    checkout_request_id = models.CharField(max_length=100, blank=True, null=True, db_index=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    outcome = models.CharField(max_length=20, blank=True, null=True)  # paid / failed / duplicate / unknown
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+
+    received_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'], name='mpesacb_status_next_idx')]
+
+    def __str__(self):
+        return f"Callback #{self.id} {self.checkout_request_id or '?'} - {self.status}"
+
+
+class StockReservation(models.Model):
+    """
+    Stock held for an unpaid order (store/stock.py). The units are already taken off
+    the variant (or product) when the row is written; RELEASED puts them back.
+    """
+    HELD = 'Held'
+    COMMITTED = 'Committed'  # paid: the units are sold
+    RELEASED = 'Released'    # payment failed or the hold expired: the units went back
+    STATUS_CHOICES = [(HELD, HELD), (COMMITTED, COMMITTED), (RELEASED, RELEASED)]
+
+    order = models.ForeignKey('orders.Order', on_delete=models.CASCADE, related_name='stock_reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_reservations')
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, blank=True, null=True, related_name='stock_reservations')
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=HELD)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # release_expired_reservations scans for old 'Held' rows
+        indexes = [models.Index(fields=['status', 'expires_at'], name='stockres_status_expires_idx')]
+
     def __str__(self):
-        return f"M-PESA {self.mpesa_receipt_number or 'Pending'} - {self.status}"
\ No newline at end of file
+        return f"{self.quantity} x {self.variant or self.product} for order {self.order_id} - {self.status}"
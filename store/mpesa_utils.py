@@ -1,9 +1,18 @@
 import base64
 import os
 import datetime
+import logging
+import random
+import threading
+import time
+from decimal import ROUND_CEILING, Decimal
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
 
 # --- 1. CONFIGURATION ---
 def get_config(key, default=None):
@@ -12,91 +21,365 @@ def get_config(key, default=None):
 MPESA_CONSUMER_KEY = get_config('MPESA_CONSUMER_KEY')
 MPESA_CONSUMER_SECRET = get_config('MPESA_CONSUMER_SECRET')
 MPESA_PASSKEY = get_config('MPESA_PASSKEY')
-MPESA_SHORTCODE = get_config('MPESA_SHORTCODE', '174379') 
-BASE_APP_URL = get_config('APP_URL') 
-MPESA_API_URL = "https://sandbox.safaricom.co.ke" 
-
-# --- 2. HELPER FUNCTIONS ---
-def format_timestamp():
-    return datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-
-def generate_stk_password(timestamp):
-    data_to_encode = str(MPESA_SHORTCODE) + MPESA_PASSKEY + timestamp
-    encoded_string = base64.b64encode(data_to_encode.encode('utf-8'))
-    return encoded_string.decode('utf-8')
-
-def generate_access_token():
-    try:
-        # 1. Clean the keys (Remove accidental spaces/newlines from Render)
-        consumer_key = str(MPESA_CONSUMER_KEY).strip()
-        consumer_secret = str(MPESA_CONSUMER_SECRET).strip()
-        
-        api_url = f"{MPESA_API_URL}/oauth/v1/generate?grant_type=client_credentials"
-        
-        # 2. Make the request using the CLEANED keys
-        response = requests.get(
-            api_url, 
-            auth=HTTPBasicAuth(consumer_key, consumer_secret)
-        )
-        
-        # Check for errors
-        response.raise_for_status() 
-        token_data = response.json()
-        return token_data.get('access_token')
-        
-    except Exception as e:
-        # Print the detailed response text if available (helps debugging)
-        if 'response' in locals():
-            print(f"Safaricom Response Body: {response.text}")
-            
-        print(f"Error generating Access Token: {e}")
+MPESA_SHORTCODE = get_config('MPESA_SHORTCODE', '174379')
+BASE_APP_URL = get_config('APP_URL')
+MPESA_SANDBOX_URL = "https://sandbox.safaricom.co.ke"
+# Point this at a local stub (e.g. http://127.0.0.1:8001) to test without the sandbox
+MPESA_API_URL = get_config('MPESA_API_URL', MPESA_SANDBOX_URL)
+# Amount actually charged instead of the order total. Defaults to 1 KES on the sandbox only;
+# the local simulator (store/daraja_simulator.py) and production get the real amount.
+MPESA_TEST_AMOUNT = get_config('MPESA_TEST_AMOUNT')
+
+# Network limits for every Daraja call (seconds)
+MPESA_CONNECT_TIMEOUT = float(get_config('MPESA_CONNECT_TIMEOUT', 3.05))
+MPESA_READ_TIMEOUT = float(get_config('MPESA_READ_TIMEOUT', 10))
+
+
+def charge_amount(amount):
+    """Whole shillings to request for `amount` (M-Pesa only takes integers): rounded UP, never below the total."""
+    return int(Decimal(str(amount)).quantize(Decimal('1'), rounding=ROUND_CEILING))
+
+
+# --- 2. ACCESS TOKEN CACHE ---
+class AccessTokenManager:
+    """
+    Caches the Daraja access token until shortly before it expires.
+
+    - Per process: the token is kept in memory, so most payments need no OAuth call.
+    - Single-flight: when several threads need a new token at the same moment, only
+      one of them calls Safaricom; the rest wait on the lock and reuse its token.
+    - Across workers: the token is also stored in Django's cache (the database cache in
+      production, see settings.CACHES), so all processes reuse one token.
+    """
+    CACHE_KEY = 'mpesa:access_token'
+    EXPIRY_MARGIN = 60  # seconds: refresh this long before Safaricom's expires_in runs out
+    DEFAULT_EXPIRES_IN = 3599
+
+    def __init__(self, fetch_token, cache_key=CACHE_KEY):
+        self._fetch_token = fetch_token
+        self.cache_key = cache_key
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+
+    def _local_token(self):
+        if self._token and time.time() < self._expires_at - self.EXPIRY_MARGIN:
+            return self._token
         return None
 
-# --- 3. INITIATE STK PUSH ---
+    def get_token(self):
+        token = self._local_token()
+        if token:
+            return token
+
+        with self._lock:
+            # Another thread may have refreshed it while we were waiting
+            token = self._local_token()
+            if token:
+                return token
+
+            # Another worker may have refreshed it
+            shared = cache.get(self.cache_key)
+            if shared and time.time() < shared['expires_at'] - self.EXPIRY_MARGIN:
+                self._token, self._expires_at = shared['token'], shared['expires_at']
+                return self._token
+
+            token_data = self._fetch_token()
+            if not token_data or not token_data.get('access_token'):
+                return None
+
+            expires_in = int(token_data.get('expires_in') or self.DEFAULT_EXPIRES_IN)
+            self._token = token_data['access_token']
+            self._expires_at = time.time() + expires_in
+            cache.set(
+                self.cache_key,
+                {'token': self._token, 'expires_at': self._expires_at},
+                max(expires_in - self.EXPIRY_MARGIN, 1),
+            )
+            return self._token
+
+    def invalidate(self):
+        """Drops the cached token (e.g. after Safaricom rejects it with a 401)."""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0
+            cache.delete(self.cache_key)
+
+
+# --- 3. CIRCUIT BREAKER ---
+class CircuitOpenError(Exception):
+    """Raised instead of calling Daraja while the circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Fails fast when Daraja is degraded.
+
+    After `failure_threshold` consecutive failures (timeouts, connection errors, 5xx)
+    the circuit opens and calls are refused for `reset_timeout` seconds. Then ONE
+    trial call is let through (half-open): success closes the circuit, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def _refusing(self):
+        if self._opened_at is None:
+            return False
+        return time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight
+
+    def before_call(self):
+        with self._lock:
+            if self._refusing():
+                raise CircuitOpenError("Daraja circuit is open")
+            if self._opened_at is not None:
+                self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    @property
+    def is_open(self):
+        """True while calls would be refused (open, or half-open with its trial call in flight)."""
+        with self._lock:
+            return self._refusing()
+
+
+# --- 4. DARAJA CLIENT ---
+class DarajaClient:
+    """
+    One client per process, reused by every payment:
+    - a pooled keep-alive requests.Session (no TCP+TLS handshake per call),
+    - connect/read timeouts on every request,
+    - bounded retries with jittered backoff for idempotent calls only
+      (an STK push is never retried, since that could prompt the customer twice),
+    - a circuit breaker that fails fast while Safaricom is degraded.
+    """
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, base_url=MPESA_API_URL, consumer_key=MPESA_CONSUMER_KEY, consumer_secret=MPESA_CONSUMER_SECRET,
+                 shortcode=MPESA_SHORTCODE, passkey=MPESA_PASSKEY, callback_base_url=BASE_APP_URL,
+                 connect_timeout=MPESA_CONNECT_TIMEOUT, read_timeout=MPESA_READ_TIMEOUT,
+                 max_retries=2, backoff=0.5, breaker=None, pool_size=10, test_amount=MPESA_TEST_AMOUNT):
+        self.base_url = base_url.rstrip('/')
+        if test_amount is None and self.base_url == MPESA_SANDBOX_URL:
+            test_amount = 1
+        self.test_amount = int(test_amount) if test_amount else None
+        # Clean the keys (Remove accidental spaces/newlines from Render)
+        self.consumer_key = str(consumer_key).strip()
+        self.consumer_secret = str(consumer_secret).strip()
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.callback_base_url = callback_base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.tokens = AccessTokenManager(self.fetch_access_token, cache_key=f'mpesa:access_token:{self.base_url}')
+
+    # --- Transport ---
+    def _request(self, method, path, idempotent=False, expected_statuses=(), **kwargs):
+        """
+        Sends one Daraja request through the breaker. Returns the Response;
+        raises requests.RequestException (or CircuitOpenError) on failure.
+        Statuses in `expected_statuses` are answers, not errors (returned as-is).
+        """
+        attempts = 1 + (self.max_retries if idempotent else 0)
+        url = f"{self.base_url}{path}"
+
+        for attempt in range(attempts):
+            self.breaker.before_call()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                if response.status_code in self.RETRY_STATUSES and response.status_code not in expected_statuses:
+                    response.raise_for_status()
+            except requests.RequestException as e:
+                # Any transport failure (incl. ChunkedEncodingError, TooManyRedirects...) is an outcome,
+                # so a half-open trial call always clears and the circuit can't stay stuck refusing
+                self.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+                # Exponential backoff with full jitter so workers don't retry in lockstep
+                delay = self.backoff * (2 ** attempt)
+                logger.warning(f"Daraja {method} {path} failed ({e}); retry {attempt + 1}/{self.max_retries}")
+                time.sleep(random.uniform(0, delay))
+                continue
+            except Exception:
+                self.breaker.record_failure()
+                raise
+
+            self.breaker.record_success()
+            if response.status_code not in expected_statuses:
+                response.raise_for_status()  # 4xx: caller error, not a sign Daraja is down
+            return response
+
+    # --- Helpers ---
+    def format_timestamp(self):
+        return datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+
+    def stk_password(self, timestamp):
+        data_to_encode = str(self.shortcode) + self.passkey + timestamp
+        encoded_string = base64.b64encode(data_to_encode.encode('utf-8'))
+        return encoded_string.decode('utf-8')
+
+    @staticmethod
+    def format_phone_number(phone_number):
+        phone_number = str(phone_number).strip()
+        if phone_number.startswith('0'):
+            phone_number = '254' + phone_number[1:]
+        elif phone_number.startswith('+254'):
+            phone_number = phone_number[1:]
+        return phone_number
+
+    def _auth_headers(self):
+        access_token = self.tokens.get_token()
+        if not access_token:
+            return None
+        return {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+
+    # --- API Calls ---
+    def fetch_access_token(self):
+        """
+        Does the actual OAuth round-trip to Safaricom (idempotent, so retried).
+        Returns the token JSON ({'access_token': ..., 'expires_in': ...}) or None.
+        """
+        try:
+            response = self._request(
+                'GET', '/oauth/v1/generate?grant_type=client_credentials', idempotent=True,
+                auth=HTTPBasicAuth(self.consumer_key, self.consumer_secret),
+            )
+            return response.json()
+        except CircuitOpenError:
+            logger.error("Skipping M-PESA OAuth: circuit open")
+            return None
+        except (requests.RequestException, ValueError) as e:
+            body = getattr(getattr(e, 'response', None), 'text', '')
+            logger.error(f"Error generating Access Token: {e} {body}")
+            return None
+
+    def initiate_stk_push(self, phone_number, amount, order_id):
+        """Returns Daraja's JSON, or {'ResponseCode': '1', 'CustomerMessage': ...} on failure."""
+        # Checked up-front so a degraded API costs nothing (not even a token lookup)
+        if self.breaker.is_open:
+            return {'ResponseCode': '1', 'CustomerMessage': 'M-PESA is temporarily unavailable. Please try again shortly.'}
+
+        headers = self._auth_headers()
+        if not headers:
+            return {'ResponseCode': '1', 'CustomerMessage': 'Failed to authenticate with M-PESA.'}
+
+        timestamp = self.format_timestamp()
+        phone_number = self.format_phone_number(phone_number)
+
+        actual_amount = self.test_amount or charge_amount(amount)
+
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": self.stk_password(timestamp),
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": actual_amount,
+            "PartyA": phone_number,
+            "PartyB": self.shortcode,
+            "PhoneNumber": phone_number,
+            # This must match  urls.py structure
+            "CallBackURL": f"{self.callback_base_url}/mpesa/callback/",
+            "AccountReference": str(order_id),
+            "TransactionDesc": f"Payment for Order #{order_id}"
+        }
+
+        try:
+            response = self._request('POST', '/mpesa/stkpush/v1/processrequest', json=payload, headers=headers)
+            return response.json()
+        except CircuitOpenError:
+            return {'ResponseCode': '1', 'CustomerMessage': 'M-PESA is temporarily unavailable. Please try again shortly.'}
+        except (requests.RequestException, ValueError) as e:
+            # Expired/revoked token: drop it so the next attempt fetches a fresh one
+            if getattr(getattr(e, 'response', None), 'status_code', None) == 401:
+                self.tokens.invalidate()
+            logger.error(f"STK Push Error: {e}")
+            return {'ResponseCode': '1', 'CustomerMessage': 'STK Push Connection Failed'}
+
+    def query_stk_push(self, checkout_request_id):
+        """
+        STK Push Query: asks Daraja how a push ended. Returns Daraja's JSON
+        ({'ResultCode': ..., 'ResultDesc': ...} once final, or {'errorCode': '500.001.1001', ...}
+        while the customer is still being prompted), or None if Daraja couldn't be reached.
+        """
+        headers = self._auth_headers()
+        if not headers:
+            return None
+
+        timestamp = self.format_timestamp()
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": self.stk_password(timestamp),
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        }
+        try:
+            # A read, so safe to retry. Daraja answers "still processing" with a 500 + errorCode.
+            response = self._request('POST', '/mpesa/stkpushquery/v1/query', idempotent=True,
+                                     expected_statuses=(500,), json=payload, headers=headers)
+            data = response.json()
+        except CircuitOpenError:
+            return None
+        except (requests.RequestException, ValueError) as e:
+            if getattr(getattr(e, 'response', None), 'status_code', None) == 401:
+                self.tokens.invalidate()
+            logger.error(f"STK Query Error for {checkout_request_id}: {e}")
+            return None
+
+        if response.status_code == 500 and 'errorCode' not in data:
+            self.breaker.record_failure()  # a real server error, not a "still processing" answer
+            return None
+        return data
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """The shared per-process DarajaClient (created on first use)."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = DarajaClient()
+    return _client
+
+
+def set_client(client):
+    """Swaps the shared client (e.g. for one aimed at the local simulator). Returns the previous one."""
+    global _client
+    with _client_lock:
+        previous, _client = _client, client
+    return previous
+
+
+# --- 5. INITIATE STK PUSH ---
 def initiate_stk_push(phone_number, amount, order_id):
-    access_token = generate_access_token()
-    if not access_token:
-        return {'ResponseCode': '1', 'CustomerMessage': 'Failed to authenticate with M-PESA.'}
-
-    timestamp = format_timestamp()
-    password = generate_stk_password(timestamp)
-    
-    # Format Phone Number
-    phone_number = str(phone_number).strip()
-    if phone_number.startswith('0'):
-        phone_number = '254' + phone_number[1:]
-    elif phone_number.startswith('+254'):
-        phone_number = phone_number[1:]
-    
-    # This must match  urls.py structure
-    callback_url = f"{BASE_APP_URL}/mpesa/callback/"
-
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-
-    actual_amount= 1
-
-    payload = {
-        "BusinessShortCode": MPESA_SHORTCODE,
-        "Password": password,
-        "Timestamp": timestamp,
-        "TransactionType": "CustomerPayBillOnline",
-        "Amount": actual_amount,
-        "PartyA": phone_number,
-        "PartyB": MPESA_SHORTCODE,
-        "PhoneNumber": phone_number,
-        "CallBackURL": callback_url,
-        "AccountReference": str(order_id),
-        "TransactionDesc": f"Payment for Order #{order_id}"
-    }
-
-    try:
-        api_url = f"{MPESA_API_URL}/mpesa/stkpush/v1/processrequest"
-        response = requests.post(api_url, json=payload, headers=headers)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"STK Push Error: {e}")
-        return {'ResponseCode': '1', 'CustomerMessage': 'STK Push Connection Failed'}
\ No newline at end of file
+    return get_client().initiate_stk_push(phone_number, amount, order_id)
@@ -0,0 +1,116 @@
+# store/page_cache.py
+"""
+Caching of rendered catalogue HTML, keyed on a catalogue version stamp.
+
+Any Product / ProductVariant / Category / Brand save or delete (store/signals.py)
+bumps the version, so every cached page and product card is dropped at once
+(the old keys simply stop being read and expire).
+
+Two layers:
+  - @cache_anonymous_page: whole responses of home / store / category / product pages,
+    per path + query string, but only for visitors without a session or messages cookie.
+    They go to their own bounded cache alias ('pages'), so they can't push out anything else.
+    Those all see the same page (no cart badge, no "Welcome, ...", no flash messages).
+    The CSRF token in cached HTML is swapped for the visitor's own on every hit.
+  - {% cache card_cache_timeout ... catalogue_version %} around product cards in the
+    templates, which also helps logged-in users and guests with a cart.
+"""
+import hashlib
+import re
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils.cache import patch_vary_headers
+
+from .version_stamps import bump_stamp, get_stamp
+
+VERSION_CACHE_KEY = 'store:catalogue:version'
+PAGE_CACHE_TIMEOUT = 10 * 60       # whole anonymous pages
+FRAGMENT_CACHE_TIMEOUT = 60 * 60   # product cards
+
+CSRF_PLACEHOLDER = b'__azara_csrf_token__'
+CSRF_INPUT = re.compile(rb'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+
+
+# --- 1. CATALOGUE VERSION ---
+def get_catalogue_version():
+    return get_stamp(VERSION_CACHE_KEY)
+
+
+def bump_catalogue_version():
+    bump_stamp(VERSION_CACHE_KEY)
+
+
+def queryset_cache_key(prefix, queryset):
+    """Cache key for something derived from a queryset (its SQL), under the current catalogue version."""
+    sql_hash = hashlib.md5(str(queryset.order_by().query).encode()).hexdigest()
+    return f'{prefix}:{get_catalogue_version()}:{sql_hash}'
+
+
+# --- 2. CSRF IN CACHED HTML ---
+def strip_csrf(content):
+    """Rendered HTML (bytes) with every CSRF token replaced by a placeholder, safe to share."""
+    return CSRF_INPUT.sub(rb'\1' + CSRF_PLACEHOLDER + rb'\2', content)
+
+
+def fill_csrf(request, content):
+    """Puts this visitor's token back. get_token() also makes CsrfViewMiddleware send their cookie."""
+    if CSRF_PLACEHOLDER in content:
+        content = content.replace(CSRF_PLACEHOLDER, get_token(request).encode())
+    return content
+
+
+# --- 3. FULL-PAGE CACHE ---
+def is_cacheable_request(request):
+    """Only visitors whose page can't contain anything personal (cart count, name, messages)."""
+    return (
+        request.method in ('GET', 'HEAD')
+        and settings.SESSION_COOKIE_NAME not in request.COOKIES
+        and CookieStorage.cookie_name not in request.COOKIES
+        and not request.user.is_authenticated
+    )
+
+
+def page_cache_key(request, extra_version=''):
+    # Same filters in a different order (?brands=2&brands=1) share one entry
+    query = sorted((key, sorted(values)) for key, values in request.GET.lists())
+    raw = f"{request.method}:{request.path}:{query}:{extra_version}"
+    return f"store:page:{get_catalogue_version()}:{hashlib.md5(raw.encode()).hexdigest()}"
+
+
+def _versioned_key(request, version, args, kwargs):
+    extra_version = version(request, *args, **kwargs) if version else ''
+    return page_cache_key(request, extra_version) if extra_version is not None else None
+
+
+def cache_anonymous_page(view=None, *, version=None):
+    """
+    @cache_anonymous_page, or @cache_anonymous_page(version=func) for pages that also change
+    without a catalogue bump: func(request, *args, **kwargs) returns an extra version for the
+    key, or None while it isn't known yet (asked again once the view has run).
+    """
+    if view is None:
+        return lambda view: cache_anonymous_page(view, version=version)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not is_cacheable_request(request):
+            return view(request, *args, **kwargs)
+        key = _versioned_key(request, version, args, kwargs)
+        cached = caches['pages'].get(key) if key else None
+        if cached is not None:
+            content, content_type = cached
+            response = HttpResponse(fill_csrf(request, content), content_type=content_type)
+        else:
+            response = view(request, *args, **kwargs)
+            key = key or _versioned_key(request, version, args, kwargs)  # the view may have just made it known
+            if key and response.status_code == 200 and not response.streaming and not response.cookies:
+                caches['pages'].set(key, (strip_csrf(response.content), response['Content-Type']), PAGE_CACHE_TIMEOUT)
+
+        patch_vary_headers(response, ['Cookie'])
+        return response
+    return wrapper
@@ -0,0 +1,86 @@
+# store/pagination.py
+"""
+Listing pagination helpers for the store grid.
+
+Numbered pages (?page=N) are kept for the first MAX_NUMBERED_PAGES, where OFFSET is cheap.
+Past that the "Next" link switches to a cursor (?cursor=...) holding the (created, id) of the
+last card shown, so page 500 costs the same as page 2: WHERE (created, id) < cursor
+ORDER BY created DESC, id DESC LIMIT page size, served by the product_created_id_idx index.
+
+The "N Items found" count comes from count_estimate(), a COUNT(*) cached per listing query
+and catalogue version, so browsing through pages doesn't re-count every time.
+"""
+import base64
+import datetime
+
+from django.core.cache import cache
+from django.db.models import Q
+
+from .page_cache import queryset_cache_key
+
+MAX_NUMBERED_PAGES = 10
+COUNT_CACHE_TIMEOUT = 10 * 60
+
+
+# --- 1. COUNT ESTIMATE ---
+def count_estimate(queryset):
+    """COUNT(*) of the queryset, cached until the catalogue changes (or for COUNT_CACHE_TIMEOUT)."""
+    if queryset.query.is_empty():
+        return 0  # .none(): no SQL to key on (or to run)
+    key = queryset_cache_key('store:listing_count', queryset)
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, COUNT_CACHE_TIMEOUT)
+    return count
+
+
+# --- 2. CURSORS ---
+def encode_cursor(product):
+    raw = f"{product.created.isoformat()}|{product.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(created, id) from a cursor, or None if it's missing or garbled."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created, product_id = raw.rsplit('|', 1)
+        return datetime.datetime.fromisoformat(created), int(product_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+class CursorPage:
+    """One keyset page. Has the bits of Django's Page the store template uses."""
+
+    def __init__(self, rows, per_page):
+        """rows: up to per_page + 1 products after the cursor (the extra one only tells there's a next page)."""
+        self.object_list = rows[:per_page]
+        self.next_cursor = encode_cursor(self.object_list[-1]) if len(rows) > per_page else None
+
+    @classmethod
+    def from_queryset(cls, queryset, after, per_page):
+        created, product_id = after
+        rows = list(
+            queryset.filter(Q(created__lt=created) | Q(created=created, id__lt=product_id))
+            .order_by('-created', '-id')[:per_page + 1]
+        )
+        return cls(rows, per_page)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return False  # forward-only cursor: the way back is the "First" link, not a previous page
+
+    def has_other_pages(self):
+        return True  # reached through a cursor, so the first pages exist
@@ -0,0 +1,139 @@
+# store/payments.py
+"""
+M-Pesa callback processing.
+
+process_stk_callback() applies one Daraja stkCallback to the MpesaTransaction,
+Order, Payment, cart and stock holds in a single atomic block. Safaricom retries
+callbacks, so it is idempotent: the CheckoutRequestID is the dedup key, and only the first
+delivery can move a transaction out of 'Pending'. Every later (or concurrent)
+duplicate returns early without touching anything else.
+"""
+import datetime
+import logging
+from decimal import Decimal
+
+from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
+
+from carts.models import CartItem
+from orders.models import Order, Payment
+
+from .models import MpesaTransaction, StkPushJob
+from .stock import commit_reservations, release_reservations
+
+logger = logging.getLogger(__name__)
+
+# Outcomes returned by process_stk_callback()
+PAID = 'paid'
+FAILED = 'failed'
+DUPLICATE = 'duplicate'
+UNKNOWN = 'unknown'
+
+
+def parse_metadata(stk_callback):
+    """CallbackMetadata.Item [{'Name': ..., 'Value': ...}] -> dict"""
+    items = stk_callback.get('CallbackMetadata', {}).get('Item', [])
+    return {item.get('Name'): item.get('Value') for item in items}
+
+
+def parse_transaction_date(value):
+    # Daraja sends e.g. 20240115143012 (Nairobi local time)
+    try:
+        naive = datetime.datetime.strptime(str(value), '%Y%m%d%H%M%S')
+    except (TypeError, ValueError):
+        return None
+    return timezone.make_aware(naive)
+
+
+def process_stk_callback(stk_callback):
+    """Applies one stkCallback payload. Returns PAID, FAILED, DUPLICATE or UNKNOWN."""
+    checkout_req_id = stk_callback.get('CheckoutRequestID')
+    result_code = stk_callback.get('ResultCode')  # 0 = Success, 1/1032 = Cancelled/Fail
+    succeeded = str(result_code) == '0'
+    metadata = parse_metadata(stk_callback) if succeeded else {}
+    receipt_no = metadata.get('MpesaReceiptNumber')
+
+    with transaction.atomic():
+        # 1. Claim the transaction. The UPDATE only matches a 'Pending' row and holds its
+        #    row lock until commit, so a concurrent duplicate waits here, then matches nothing.
+        claimed = MpesaTransaction.objects.filter(checkout_request_id=checkout_req_id, status='Pending').update(
+            status='Successful' if succeeded else 'Failed',
+            mpesa_receipt_number=receipt_no,
+            transaction_date=parse_transaction_date(metadata.get('TransactionDate')),
+            result_desc=stk_callback.get('ResultDesc'),
+        )
+        if not claimed:
+            if MpesaTransaction.objects.filter(checkout_request_id=checkout_req_id).exists():
+                return DUPLICATE
+            logger.warning(f"M-Pesa callback for unknown CheckoutRequestID {checkout_req_id}")
+            return UNKNOWN
+
+        if not succeeded:
+            # User cancelled or insufficient funds.
+            # The items remain in the cart so the user can try again; the held stock goes back
+            # until they do (stk_push_request takes it again).
+            release_reservations(MpesaTransaction.objects.get(checkout_request_id=checkout_req_id).order_id)
+            return FAILED
+
+        # 2. Lock the order: two different pushes for the same order must not both pay it
+        order = Order.objects.select_for_update().get(mpesa_transactions__checkout_request_id=checkout_req_id)
+        if order.is_ordered:
+            logger.warning(f"Order {order.id} already paid; receipt {receipt_no} recorded on its transaction only")
+            return PAID
+
+        # 3. Record the payment (the amount M-Pesa actually charged) and mark the order paid
+        charged = metadata.get('Amount')
+        if charged is None:  # an STK Push Query result carries no metadata: use the amount that was requested
+            charged = MpesaTransaction.objects.filter(checkout_request_id=checkout_req_id).values_list('amount', flat=True).first()
+        order.payment = Payment.objects.create(
+            user=order.user,
+            payment_id=receipt_no or checkout_req_id,  # an STK Push Query result carries no receipt number
+            payment_method='M-Pesa',
+            amount_paid=Decimal(str(charged)) if charged is not None else order.grand_total,
+            status='Completed'
+        )
+        order.is_ordered = True  # Marks it as "Paid"
+        order.status = 'Accepted'
+        order.save(update_fields=['payment', 'is_ordered', 'status', 'updated_at'])
+        commit_reservations(order.id)  # the held units are sold
+
+        # 4. CLEAR THE CART ITEMS of the user attached to the order
+        if order.user_id:
+            CartItem.objects.filter(user_id=order.user_id).delete()
+
+    return PAID
+
+
+# --- PAYMENT STATUS (waiting page) ---
+SENDING = 'sending'   # STK push still queued / being sent
+WAITING = 'waiting'   # prompt is on the phone, waiting for the callback
+# (PAID and FAILED as above)
+FINAL_STATES = (PAID, FAILED)
+
+
+def get_payment_status(order_id):
+    """
+    Where an order's payment stands, for the waiting page:
+    {'state': sending|waiting|paid|failed, 'message': ..., 'redirect_url': ...}
+    Raises Order.DoesNotExist for an unknown order.
+    """
+    order = Order.objects.only('id', 'is_ordered').get(id=order_id)
+    status = {'state': WAITING, 'message': '', 'redirect_url': reverse('store:order_complete', args=[order.id])}
+
+    if order.is_ordered:
+        status['state'] = PAID
+        return status
+
+    job = StkPushJob.objects.filter(order_id=order.id).order_by('-id').first()
+    if job and not job.is_finished:
+        status['state'] = SENDING
+    elif job and job.status == StkPushJob.FAILED:
+        status.update(state=FAILED, message=job.message or 'Failed to initiate M-Pesa.')
+    else:
+        transaction_status = (
+            MpesaTransaction.objects.filter(order_id=order.id).order_by('-id').values_list('status', 'result_desc').first()
+        )
+        if transaction_status and transaction_status[0] == 'Failed':
+            status.update(state=FAILED, message=transaction_status[1] or 'The payment was cancelled or failed.')
+    return status
@@ -0,0 +1,98 @@
+# store/product_bundle.py
+"""
+Product detail page: one-query loader and a cached render of the page body.
+
+load_product_detail() reads the product, its category, brand and active variants in
+ONE query (variant rows with the product joined in; only a product without active
+variants needs a second, plain lookup). The lookup by (category, slug) is served by
+the product_category_slug_idx index.
+
+The rendered body (everything below the navbar) is cached per product under a version
+stamp: a per-product counter bumped by Product / ProductVariant signals, plus the
+category tree version (a renamed category slug changes the URL). The CSRF token is
+swapped for the visitor's own on every hit, like the full-page cache. The anonymous
+full-page cache of the product page is keyed on the same product version (page_version).
+"""
+from django.core.cache import cache
+from django.http import Http404
+
+from .category_tree import get_category_tree
+from .models import Product, ProductVariant
+from .version_stamps import bump_stamp, get_stamp
+
+BODY_CACHE_TIMEOUT = 60 * 60
+
+
+# --- 1. VERSION STAMP ---
+def _version_key(product_id):
+    return f'store:product_version:{product_id}'
+
+
+def get_product_version(product_id):
+    return get_stamp(_version_key(product_id))
+
+
+def bump_product_version(product_id):
+    bump_stamp(_version_key(product_id))
+
+
+# --- 2. LOADER ---
+def load_product_detail(category_slug, product_slug):
+    """(product, active variants) of an available product, or Http404."""
+    variants = list(
+        ProductVariant.objects
+        .filter(product__category__slug=category_slug, product__slug=product_slug, product__available=True, is_active=True)
+        .select_related('product__category', 'product__brand')
+        .order_by('product_id', 'id')
+    )
+    if variants:
+        product = variants[0].product
+        variants = [variant for variant in variants if variant.product_id == product.id]
+        for variant in variants:
+            variant.product = product  # one shared instance instead of a copy per row
+        return product, variants
+
+    # No active variants (or no such product): plain lookup
+    try:
+        product = Product.objects.select_related('category', 'brand').get(
+            category__slug=category_slug, slug=product_slug, available=True,
+        )
+    except Product.DoesNotExist:
+        raise Http404("No Product matches the given query.")
+    return product, []
+
+
+# --- 3. CACHED BODY ---
+def _slug_key(category_slug, product_slug):
+    return f'store:product_slug:{category_slug}:{product_slug}'
+
+
+def _body_key(product_id):
+    return f'store:product_body:{product_id}:{get_product_version(product_id)}:{get_category_tree().version}'
+
+
+def get_cached_body(category_slug, product_slug):
+    """The cached body for this URL (CSRF placeholder inside), or None."""
+    product_id = cache.get(_slug_key(category_slug, product_slug))
+    if product_id is None:
+        return None
+    cached = cache.get(_body_key(product_id))
+    # Any product change (slug, availability...) bumped the version, so a hit is still valid for this URL
+    if cached is None or cached[0] != (category_slug, product_slug):
+        return None
+    return cached[1]
+
+
+def page_version(request, category_slug, product_slug):
+    """
+    Product version for the full-page cache key (@cache_anonymous_page), so a stock change
+    (store/stock.py bumps it, no catalogue bump) drops the cached page too.
+    None until a render has mapped the URL to its product.
+    """
+    product_id = cache.get(_slug_key(category_slug, product_slug))
+    return None if product_id is None else get_product_version(product_id)
+
+
+def cache_body(category_slug, product_slug, product_id, body):
+    cache.set(_slug_key(category_slug, product_slug), product_id, BODY_CACHE_TIMEOUT)
+    cache.set(_body_key(product_id), ((category_slug, product_slug), body), BODY_CACHE_TIMEOUT)
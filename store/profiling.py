@@ -0,0 +1,260 @@
+# store/profiling.py
+"""
+Opt-in request profiling (set PROFILING_ENABLED=True; otherwise the middleware removes itself).
+
+For every request it records, per URL name (e.g. 'store:store'):
+  - number of SQL queries and total DB time
+  - template render time (includes queries the template triggers, e.g. lazy relations)
+  - outbound HTTP calls and time (Daraja, Cloudinary... anything going through urllib3)
+Totals are kept in memory (see snapshot()), served at the staff-only
+/staff/profiling/ endpoint, and each request is logged as one JSON line.
+
+A sampled share of requests (PROFILING_DUPLICATE_SAMPLE_RATE) also runs duplicate-query
+detection: the same SQL executed DUPLICATE_THRESHOLD+ times in one request (an N+1) is
+reported with the template line and the project code (model property, view...) that issued it.
+"""
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from asgiref.local import Local
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_THRESHOLD = 3      # same query this many times in one request = N+1 suspect
+MAX_DUPLICATE_ENTRIES = 20   # distinct duplicate (sql, location) pairs kept per URL name
+SQL_PREVIEW_LENGTH = 200
+
+_current = Local()           # per-request (also across sync/async hops)
+_lock = threading.Lock()
+_stats = {}                  # url name -> aggregated totals
+_patched = False
+
+PROJECT_ROOT = str(settings.BASE_DIR)
+IGNORED_PATHS = (os.path.dirname(__file__) + os.sep + 'profiling.py', 'site-packages', os.sep + 'lib' + os.sep + 'python')
+
+
+class RequestProfile:
+    __slots__ = ('queries', 'db_time', 'template_time', 'template_depth', 'http_calls', 'http_time',
+                 'http_depth', 'sample_duplicates', 'query_sites')
+
+    def __init__(self, sample_duplicates):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.http_calls = 0
+        self.http_time = 0.0
+        self.http_depth = 0
+        self.sample_duplicates = sample_duplicates
+        self.query_sites = {} if sample_duplicates else None  # sql -> Counter(location)
+
+
+# --- 1. HOOKS ---
+def _relative(path):
+    return os.path.relpath(path, PROJECT_ROOT) if path.startswith(PROJECT_ROOT) else path
+
+
+def _find_query_site():
+    """'templates/store/store.html:42 | store/models.py:88 in get_url' for the query being executed."""
+    template_site = code_site = None
+    frame = sys._getframe(2)
+    while frame is not None and not (template_site and code_site):
+        code = frame.f_code
+        if template_site is None and code.co_name == 'render_annotated':
+            node = frame.f_locals.get('self')
+            token = getattr(node, 'token', None)
+            origin = getattr(node, 'origin', None)
+            if token is not None and origin is not None:
+                template_site = f"{_relative(origin.name)}:{token.lineno}"
+        elif code_site is None and code.co_filename.startswith(PROJECT_ROOT) \
+                and not any(part in code.co_filename for part in IGNORED_PATHS):
+            code_site = f"{_relative(code.co_filename)}:{frame.f_lineno} in {code.co_name}"
+        frame = frame.f_back
+    return ' | '.join(site for site in (template_site, code_site) if site) or 'unknown'
+
+
+def _sql_wrapper(execute, sql, params, many, context):
+    profile = getattr(_current, 'profile', None)
+    if profile is None:
+        return execute(sql, params, many, context)
+
+    if profile.sample_duplicates:
+        profile.query_sites.setdefault(sql, Counter())[_find_query_site()] += 1
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.queries += 1
+        profile.db_time += time.perf_counter() - started
+
+
+def _timed(kind):
+    """Wraps a function so its (outermost) duration is added to the current profile."""
+    def decorate(func):
+        def wrapper(*args, **kwargs):
+            profile = getattr(_current, 'profile', None)
+            if profile is None or getattr(profile, f'{kind}_depth'):
+                return func(*args, **kwargs)  # not profiling, or nested (redirects, includes)
+            setattr(profile, f'{kind}_depth', 1)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                setattr(profile, f'{kind}_depth', 0)
+                setattr(profile, f'{kind}_time', getattr(profile, f'{kind}_time') + time.perf_counter() - started)
+                if kind == 'http':
+                    profile.http_calls += 1
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorate
+
+
+def _wrap_connection(connection, **kwargs):
+    if _sql_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_sql_wrapper)
+
+
+def install_hooks():
+    """
+    Patches template rendering and urllib3 once per process (only when profiling is enabled),
+    and puts the SQL wrapper on every DB connection. Connections are per thread, and an async
+    request's queries run on sync_to_async's thread, so it can't be installed per request.
+    """
+    global _patched
+    if _patched:
+        return
+    from django.template.backends.django import Template
+    from urllib3.connectionpool import HTTPConnectionPool
+
+    Template.render = _timed('template')(Template.render)
+    HTTPConnectionPool.urlopen = _timed('http')(HTTPConnectionPool.urlopen)
+    connection_created.connect(_wrap_connection)
+    for connection in connections.all(initialized_only=True):
+        _wrap_connection(connection)
+    _patched = True
+
+
+# --- 2. AGGREGATION ---
+def _record(url_name, method, status, elapsed, profile):
+    with _lock:
+        entry = _stats.setdefault(url_name, {
+            'requests': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'queries': 0, 'max_queries': 0,
+            'db_ms': 0.0, 'template_ms': 0.0, 'http_calls': 0, 'http_ms': 0.0,
+            'sampled': 0, 'duplicates': Counter(),
+        })
+        entry['requests'] += 1
+        entry['total_ms'] += elapsed * 1000
+        entry['max_ms'] = max(entry['max_ms'], elapsed * 1000)
+        entry['queries'] += profile.queries
+        entry['max_queries'] = max(entry['max_queries'], profile.queries)
+        entry['db_ms'] += profile.db_time * 1000
+        entry['template_ms'] += profile.template_time * 1000
+        entry['http_calls'] += profile.http_calls
+        entry['http_ms'] += profile.http_time * 1000
+
+        duplicates = []
+        if profile.sample_duplicates:
+            entry['sampled'] += 1
+            for sql, sites in profile.query_sites.items():
+                if sum(sites.values()) < DUPLICATE_THRESHOLD:
+                    continue
+                site = sites.most_common(1)[0][0]
+                duplicates.append({'sql': sql[:SQL_PREVIEW_LENGTH], 'count': sum(sites.values()), 'site': site})
+                key = (sql[:SQL_PREVIEW_LENGTH], site)
+                if key in entry['duplicates'] or len(entry['duplicates']) < MAX_DUPLICATE_ENTRIES:
+                    entry['duplicates'][key] += sum(sites.values())
+
+    logger.info(json.dumps({
+        'event': 'request_profile', 'url_name': url_name, 'method': method, 'status': status,
+        'ms': round(elapsed * 1000, 1), 'queries': profile.queries, 'db_ms': round(profile.db_time * 1000, 1),
+        'template_ms': round(profile.template_time * 1000, 1), 'http_calls': profile.http_calls,
+        'http_ms': round(profile.http_time * 1000, 1), 'duplicates': duplicates,
+    }))
+
+
+def snapshot():
+    """Per URL name averages and totals, slowest (by total time) first."""
+    with _lock:
+        report = []
+        for url_name, entry in _stats.items():
+            requests = entry['requests']
+            report.append({
+                'url_name': url_name,
+                'requests': requests,
+                'avg_ms': round(entry['total_ms'] / requests, 1),
+                'max_ms': round(entry['max_ms'], 1),
+                'avg_queries': round(entry['queries'] / requests, 1),
+                'max_queries': entry['max_queries'],
+                'avg_db_ms': round(entry['db_ms'] / requests, 1),
+                'avg_template_ms': round(entry['template_ms'] / requests, 1),
+                'http_calls': entry['http_calls'],
+                'avg_http_ms': round(entry['http_ms'] / requests, 1),
+                'sampled_requests': entry['sampled'],
+                'duplicate_queries': [
+                    {'sql': sql, 'site': site, 'executions': count}
+                    for (sql, site), count in entry['duplicates'].most_common()
+                ],
+            })
+    report.sort(key=lambda row: row['avg_ms'] * row['requests'], reverse=True)
+    return report
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+# --- 3. MIDDLEWARE ---
+class ProfilingMiddleware:
+    """Sync and async: under ASGI it keeps the chain async (the payment status stream stays off threads)."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILING_DUPLICATE_SAMPLE_RATE', 0.05)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        install_hooks()
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        profile, started = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.profile = None
+        return self._finish(request, response, profile, started)
+
+    async def __acall__(self, request):
+        profile, started = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.profile = None
+        return self._finish(request, response, profile, started)
+
+    def _start(self):
+        # _current follows the request into sync_to_async threads (it is context-local)
+        _current.profile = RequestProfile(sample_duplicates=random.random() < self.sample_rate)
+        return _current.profile, time.perf_counter()
+
+    def _finish(self, request, response, profile, started):
+        match = getattr(request, 'resolver_match', None)
+        url_name = match.view_name if match else '<unresolved>'
+        _record(url_name, request.method, response.status_code, time.perf_counter() - started, profile)
+        return response
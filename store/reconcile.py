@@ -0,0 +1,181 @@
+# store/reconcile.py
+"""
+Reconciliation of M-Pesa transactions whose callback never arrived.
+
+reconcile_pending() finds 'Pending' MpesaTransactions older than a few minutes
+(index on status, created_at), asks Daraja's STK Push Query API how each one ended,
+and applies final answers through payments.process_stk_callback(), the same code
+path a real callback takes. Queries are spread out to stay under a rate limit.
+Run it with `python manage.py reconcile_mpesa`.
+
+A transaction without a final answer (still processing, rejected, Daraja unreachable)
+gets its next check pushed back, doubling each time, so it never blocks newer ones.
+After MAX_CHECKS queries (about 8 hours) it is failed, which also releases its stock.
+
+A push Daraja accepted but the STK worker couldn't record (its MpesaTransaction insert
+failed) is left as a failed job with a CheckoutRequestID; adopt_orphaned_pushes() gives it
+its 'Pending' transaction so it is queried like any other.
+"""
+import datetime
+import logging
+import time
+from dataclasses import dataclass, field
+
+from django.db.models import Q
+from django.utils import timezone
+
+from . import payments
+from .models import MpesaTransaction, StkPushJob
+from .mpesa_utils import get_client
+
+logger = logging.getLogger(__name__)
+
+STALE_AFTER = datetime.timedelta(minutes=3)  # the phone prompt itself times out after about a minute
+STILL_PROCESSING = '500.001.1001'            # Daraja errorCode: customer hasn't answered yet
+RECHECK_MAX_INTERVAL = datetime.timedelta(hours=1)
+MAX_CHECKS = 12
+
+
+@dataclass
+class ReconcileReport:
+    scanned: int = 0
+    paid: int = 0
+    failed: int = 0
+    duplicate: int = 0       # settled meanwhile by a late callback
+    still_pending: int = 0
+    errors: int = 0
+    gave_up: int = 0         # no final answer after MAX_CHECKS queries: failed
+    adopted: int = 0         # accepted pushes the STK worker failed to record
+    latencies: list = field(default_factory=list)  # seconds per Daraja query
+    elapsed: float = 0.0
+
+    def add(self, outcome):
+        setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def latency(self, quantile):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(int(quantile * len(ordered)), len(ordered) - 1)]
+
+    def summary(self):
+        return (
+            f"scanned={self.scanned} paid={self.paid} failed={self.failed} duplicate={self.duplicate} "
+            f"still_pending={self.still_pending} errors={self.errors} gave_up={self.gave_up} adopted={self.adopted} "
+            f"query_p50={self.latency(0.5) * 1000:.0f}ms query_max={self.latency(1.0) * 1000:.0f}ms "
+            f"elapsed={self.elapsed:.2f}s"
+        )
+
+
+def adopt_orphaned_pushes(limit=100):
+    """Creates the missing 'Pending' MpesaTransaction of failed jobs Daraja had accepted. Returns how many."""
+    jobs = list(
+        StkPushJob.objects
+        .filter(status=StkPushJob.FAILED, checkout_request_id__isnull=False)
+        .exclude(checkout_request_id__in=MpesaTransaction.objects.values('checkout_request_id'))
+        .order_by('id')[:limit]
+    )
+    MpesaTransaction.objects.bulk_create([
+        MpesaTransaction(order_id=job.order_id, checkout_request_id=job.checkout_request_id,
+                         amount=job.amount, phone_number=job.phone_number, status='Pending')
+        for job in jobs
+    ], ignore_conflicts=True)
+    if jobs:
+        logger.warning(f"Adopted {len(jobs)} M-Pesa push(es) the STK worker failed to record")
+    return len(jobs)
+
+
+def stale_pending_ids(older_than=STALE_AFTER, limit=100):
+    """
+    (CheckoutRequestID, check_attempts) of the oldest stale 'Pending' transactions that are
+    due for a check (served by the status/created_at index).
+    """
+    now = timezone.now()
+    return list(
+        MpesaTransaction.objects
+        .filter(status='Pending', created_at__lte=now - older_than)
+        .filter(Q(next_check_at__isnull=True) | Q(next_check_at__lte=now))
+        .order_by('created_at', 'id')
+        .values_list('checkout_request_id', 'check_attempts')[:limit]
+    )
+
+
+def schedule_next_check(checkout_request_id, attempts):
+    """Counts this check and pushes the next one back (STALE_AFTER, doubling, at most RECHECK_MAX_INTERVAL)."""
+    delay = min(STALE_AFTER * 2 ** attempts, RECHECK_MAX_INTERVAL)
+    MpesaTransaction.objects.filter(checkout_request_id=checkout_request_id).update(
+        check_attempts=attempts + 1, next_check_at=timezone.now() + delay,
+    )
+
+
+def give_up(checkout_request_id, report):
+    """Fails the transaction through the callback path (the order stays unpaid, its stock goes back)."""
+    outcome = payments.process_stk_callback({
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': 'unresolved',
+        'ResultDesc': f'No final answer from M-Pesa after {MAX_CHECKS} status queries',
+    })
+    logger.warning(f"Gave up on M-Pesa transaction {checkout_request_id} after {MAX_CHECKS} queries")
+    report.add('gave_up' if outcome == payments.FAILED else 'duplicate')
+
+
+def reconcile_transaction(client, checkout_request_id, report):
+    """Queries one transaction and applies a final answer. Returns the outcome it counted."""
+    started = time.monotonic()
+    result = client.query_stk_push(checkout_request_id)
+    report.latencies.append(time.monotonic() - started)
+
+    if not result:
+        outcome = 'errors'
+    elif result.get('errorCode') == STILL_PROCESSING:
+        outcome = 'still_pending'
+    elif 'ResultCode' in result:
+        # Same shape as the stkCallback body, so it takes the exact callback path
+        outcome = payments.process_stk_callback({
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': result['ResultCode'],
+            'ResultDesc': result.get('ResultDesc'),
+        })
+        if outcome not in (payments.PAID, payments.FAILED, payments.DUPLICATE):
+            outcome = 'errors'
+    else:
+        logger.warning(f"Unexpected STK Query answer for {checkout_request_id}: {result}")
+        outcome = 'errors'
+    report.add(outcome)
+    return outcome
+
+
+def reconcile_pending(client=None, older_than=STALE_AFTER, batch_size=20, max_batches=5, rate_per_second=5):
+    """Queries Daraja for up to batch_size * max_batches stale transactions. Returns a ReconcileReport."""
+    client = client or get_client()
+    report = ReconcileReport()
+    report.adopted = adopt_orphaned_pushes()
+    min_interval = 1.0 / rate_per_second if rate_per_second else 0
+    started = time.monotonic()
+    next_call = started
+
+    for _ in range(max_batches):
+        # Every row checked below gets a later next_check_at, so the next batch moves on to newer ones
+        batch = stale_pending_ids(older_than, batch_size)
+        if not batch:
+            break
+        for checkout_request_id, attempts in batch:
+            # Rate limit: never start queries closer together than min_interval
+            wait = next_call - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            next_call = time.monotonic() + min_interval
+
+            schedule_next_check(checkout_request_id, attempts)
+            report.scanned += 1
+            try:
+                outcome = reconcile_transaction(client, checkout_request_id, report)
+                if outcome in ('still_pending', 'errors') and attempts + 1 >= MAX_CHECKS:
+                    give_up(checkout_request_id, report)
+            except Exception:
+                logger.exception(f"Reconciling {checkout_request_id} failed")
+                report.add('errors')
+
+    report.elapsed = time.monotonic() - started
+    logger.info(f"M-Pesa reconciliation: {report.summary()}")
+    return report
@@ -0,0 +1,293 @@
+# store/search.py
+"""
+Full-text product search.
+
+Products are indexed (name, brand, category, description) into:
+  - SQLite : an FTS5 virtual table  -> store_product_fts      (local / dev)
+  - Postgres: a tsvector table + GIN -> store_product_search  (when DATABASE_URL is set)
+
+search_products() turns a keyword into a ranked, filterable Product queryset,
+so the normal listing pipeline (brand/price filters + pagination) still applies.
+The index is kept up to date by the signals in store/signals.py.
+"""
+import bisect
+import difflib
+import re
+import time
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+# Column weights: a hit in the name counts more than a hit in the description
+WEIGHT_NAME = 10.0
+WEIGHT_BRAND = 5.0
+WEIGHT_CATEGORY = 3.0
+WEIGHT_DESCRIPTION = 1.0
+
+# Typo tolerance settings
+MIN_FUZZY_TERM_LENGTH = 4
+FUZZY_CUTOFF = 0.75
+MAX_FUZZY_MATCHES = 3
+VOCABULARY_TTL = 300  # seconds before the in-process term list is re-read
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+# Shared SELECT used by both backends to build index rows.
+# The category column holds "Parent Child" so searching 'haircare' finds every hair product.
+DOCUMENT_SQL = """
+    SELECT p.id, p.name, b.name, COALESCE(parent.name || ' ', '') || c.name, p.description
+    FROM store_product p
+    INNER JOIN store_brand b ON b.id = p.brand_id
+    INNER JOIN store_category c ON c.id = p.category_id
+    LEFT OUTER JOIN store_category parent ON parent.id = c.parent_id
+"""
+
+
+def tokenize(keyword):
+    return [term.lower() for term in TERM_RE.findall(keyword or '')]
+
+
+# --- 1. BACKENDS ---
+class SqliteFtsBackend:
+    table = 'store_product_fts'
+    vocab_table = 'store_product_fts_vocab'
+
+    def create_index(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} "
+            f"USING fts5(name, brand, category, description, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.vocab_table} USING fts5vocab({self.table}, 'row')")
+
+    def drop_index(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {self.vocab_table}")
+        cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+
+    def delete_rows(self, cursor, product_ids=None):
+        if product_ids is None:
+            cursor.execute(f"DELETE FROM {self.table}")
+        else:
+            placeholders = ', '.join(['%s'] * len(product_ids))
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid IN ({placeholders})", list(product_ids))
+
+    def insert_rows(self, cursor, product_ids=None):
+        sql = f"INSERT INTO {self.table} (rowid, name, brand, category, description) {DOCUMENT_SQL}"
+        if product_ids is None:
+            cursor.execute(sql)
+        else:
+            placeholders = ', '.join(['%s'] * len(product_ids))
+            cursor.execute(f"{sql} WHERE p.id IN ({placeholders})", list(product_ids))
+
+    def vocabulary(self, cursor):
+        cursor.execute(f"SELECT term FROM {self.vocab_table}")
+        return [row[0] for row in cursor.fetchall()]
+
+    def build_query(self, term_groups):
+        # ("shampo"* OR "shampoo") AND ("oil"*)
+        clauses = []
+        for prefix, corrections in term_groups:
+            options = [f'"{prefix}"*'] + [f'"{word}"' for word in corrections]
+            clauses.append('(' + ' OR '.join(options) + ')')
+        return ' AND '.join(clauses)
+
+    def match_sql(self):
+        return f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s"
+
+    def rank_sql(self):
+        # bm25() is "lower is better", so it is negated to sort descending like Postgres
+        return (
+            f"SELECT -bm25({self.table}, {WEIGHT_NAME}, {WEIGHT_BRAND}, {WEIGHT_CATEGORY}, {WEIGHT_DESCRIPTION}) "
+            f"FROM {self.table} WHERE {self.table} MATCH %s AND rowid = store_product.id"
+        )
+
+
+class PostgresSearchBackend:
+    table = 'store_product_search'
+    config = 'simple'
+
+    def create_index(self, cursor):
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            f"product_id bigint PRIMARY KEY REFERENCES store_product(id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            f"document tsvector NOT NULL)"
+        )
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_document_gin ON {self.table} USING GIN (document)")
+
+    def drop_index(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+
+    def delete_rows(self, cursor, product_ids=None):
+        if product_ids is None:
+            cursor.execute(f"DELETE FROM {self.table}")
+        else:
+            cursor.execute(f"DELETE FROM {self.table} WHERE product_id = ANY(%s)", [list(product_ids)])
+
+    def insert_rows(self, cursor, product_ids=None):
+        cfg = self.config
+        sql = (
+            f"INSERT INTO {self.table} (product_id, document) "
+            f"SELECT doc.id, "
+            f"setweight(to_tsvector('{cfg}', coalesce(doc.name, '')), 'A') || "
+            f"setweight(to_tsvector('{cfg}', coalesce(doc.brand, '')), 'B') || "
+            f"setweight(to_tsvector('{cfg}', coalesce(doc.category, '')), 'C') || "
+            f"setweight(to_tsvector('{cfg}', coalesce(doc.description, '')), 'D') "
+            f"FROM ({DOCUMENT_SQL}) AS doc (id, name, brand, category, description)"
+        )
+        if product_ids is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(f"{sql} WHERE doc.id = ANY(%s)", [list(product_ids)])
+
+    def vocabulary(self, cursor):
+        cursor.execute(f"SELECT word FROM ts_stat('SELECT document FROM {self.table}')")
+        return [row[0] for row in cursor.fetchall()]
+
+    def build_query(self, term_groups):
+        # (shampo:* | shampoo) & (oil:*)
+        clauses = []
+        for prefix, corrections in term_groups:
+            options = [f"{prefix}:*"] + list(corrections)
+            clauses.append('(' + ' | '.join(options) + ')')
+        return ' & '.join(clauses)
+
+    def match_sql(self):
+        return f"SELECT product_id FROM {self.table} WHERE document @@ to_tsquery('{self.config}', %s)"
+
+    def rank_sql(self):
+        # ts_rank weights are ordered {D, C, B, A}
+        weights = f"'{{{WEIGHT_DESCRIPTION / 10}, {WEIGHT_CATEGORY / 10}, {WEIGHT_BRAND / 10}, {WEIGHT_NAME / 10}}}'"
+        return (
+            f"SELECT ts_rank({weights}, document, to_tsquery('{self.config}', %s)) "
+            f"FROM {self.table} WHERE product_id = store_product.id"
+        )
+
+
+_sqlite_has_fts5 = None
+
+
+def get_backend(conn=None):
+    """Returns the search backend for the given DB connection, or None (plain icontains fallback)."""
+    global _sqlite_has_fts5
+    conn = conn or connection
+    if conn.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    if conn.vendor == 'sqlite':
+        if _sqlite_has_fts5 is None:
+            with conn.cursor() as cursor:
+                cursor.execute("PRAGMA compile_options")
+                _sqlite_has_fts5 = any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+        if _sqlite_has_fts5:
+            return SqliteFtsBackend()
+    return None
+
+
+# --- 2. INDEX MAINTENANCE ---
+def create_index(conn=None, populate=True):
+    conn = conn or connection
+    backend = get_backend(conn)
+    if backend is None:
+        return
+    with conn.cursor() as cursor:
+        backend.create_index(cursor)
+        if populate:
+            backend.insert_rows(cursor)
+
+
+def drop_index(conn=None):
+    conn = conn or connection
+    backend = get_backend(conn)
+    if backend is None:
+        return
+    with conn.cursor() as cursor:
+        backend.drop_index(cursor)
+
+
+def index_products(product_ids=None):
+    """
+    (Re)indexes the given products, or the whole catalogue when product_ids is None.
+    Deleted products are simply dropped, since the INSERT ... SELECT finds no row for them.
+    """
+    backend = get_backend()
+    if backend is None:
+        return
+    if product_ids is not None:
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            backend.delete_rows(cursor, product_ids)
+            backend.insert_rows(cursor, product_ids)
+    _vocabulary_cache['expires'] = 0
+
+
+def unindex_products(product_ids):
+    backend = get_backend()
+    if backend is None:
+        return
+    with connection.cursor() as cursor:
+        backend.delete_rows(cursor, list(product_ids))
+
+
+# --- 3. TYPO TOLERANCE ---
+_vocabulary_cache = {'terms': [], 'expires': 0}
+
+
+def get_vocabulary(backend):
+    """Sorted list of every indexed term, cached in-process for VOCABULARY_TTL seconds."""
+    now = time.monotonic()
+    if now >= _vocabulary_cache['expires']:
+        with connection.cursor() as cursor:
+            # Only plain word terms can be safely dropped into a MATCH / tsquery string
+            words = (term for term in backend.vocabulary(cursor) if TERM_RE.fullmatch(term))
+            _vocabulary_cache['terms'] = sorted(set(words))
+        _vocabulary_cache['expires'] = now + VOCABULARY_TTL
+    return _vocabulary_cache['terms']
+
+
+def has_prefix_match(vocabulary, term):
+    position = bisect.bisect_left(vocabulary, term)
+    return position < len(vocabulary) and vocabulary[position].startswith(term)
+
+
+def expand_terms(backend, terms):
+    """
+    Returns [(prefix, [corrections...]), ...].
+    Every term is matched as a prefix; terms that match nothing in the index
+    also get the closest indexed words (e.g. 'shampo0' -> 'shampoo').
+    """
+    vocabulary = get_vocabulary(backend)
+    groups = []
+    for term in terms:
+        corrections = []
+        if len(term) >= MIN_FUZZY_TERM_LENGTH and not has_prefix_match(vocabulary, term):
+            corrections = difflib.get_close_matches(term, vocabulary, n=MAX_FUZZY_MATCHES, cutoff=FUZZY_CUTOFF)
+        groups.append((term, corrections))
+    return groups
+
+
+# --- 4. QUERYING ---
+def search_products(products, keyword):
+    """
+    Narrows a Product queryset to those matching `keyword`, ordered by relevance
+    (then newest first). Falls back to the old icontains scan if no index backend exists.
+    """
+    terms = tokenize(keyword)
+    if not terms:
+        return products.none()
+
+    backend = get_backend()
+    if backend is None:
+        return products.filter(
+            Q(description__icontains=keyword) | Q(name__icontains=keyword) | Q(category__name__icontains=keyword)
+        ).order_by('-created')
+
+    query = backend.build_query(expand_terms(backend, terms))
+    return (
+        products
+        .filter(id__in=RawSQL(backend.match_sql(), [query]))
+        .annotate(search_rank=RawSQL(backend.rank_sql(), [query]))
+        .order_by('-search_rank', '-created', '-id')
+    )
@@ -0,0 +1,55 @@
+# store/showcase.py
+"""
+Precomputed home-page showcase (the "Explore Haircare / Skincare" rows).
+
+build_showcase() picks the newest available product of each child category with
+ONE window-function query (ROW_NUMBER() per category), topping up with the newest
+products of the whole family when there are fewer than SHOWCASE_SIZE children.
+get_showcase() keeps the result for every section as one cached snapshot under the
+catalogue version (store/page_cache.py), so any product/category change refreshes it
+and the home page itself costs a single cache read.
+"""
+from django.core.cache import cache
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+
+from .category_tree import get_category_tree
+from .models import Product
+from .page_cache import get_catalogue_version
+
+SECTIONS = ('haircare', 'skincare')
+SHOWCASE_SIZE = 4
+SHOWCASE_TIMEOUT = 24 * 60 * 60  # a version bump replaces it long before this
+
+
+def build_showcase(parent_slug):
+    """Up to SHOWCASE_SIZE products: one per child category (in menu order), then the newest extras."""
+    parent = get_category_tree().get(parent_slug)
+    if parent is None:
+        return []
+
+    # Cards use category.slug (URL) and brand, so load them in the same query
+    family = Product.objects.filter(available=True).select_related('category', 'brand')
+    newest_per_child = family.filter(category_id__in=[child.id for child in parent.children]).annotate(
+        category_rank=Window(RowNumber(), partition_by=F('category_id'), order_by=[F('created').desc(), F('id').desc()]),
+    ).filter(category_rank=1)
+
+    by_category = {product.category_id: product for product in newest_per_child}
+    products = [by_category[child.id] for child in parent.children if child.id in by_category][:SHOWCASE_SIZE]
+
+    if len(products) < SHOWCASE_SIZE:
+        extras = family.filter(Q(category_id=parent.id) | Q(category__parent_id=parent.id)) \
+            .exclude(id__in=[product.id for product in products]) \
+            .order_by('-created', '-id')[:SHOWCASE_SIZE - len(products)]
+        products.extend(extras)
+    return products
+
+
+def get_showcase():
+    """{section slug: [products]} from the snapshot, rebuilt once per catalogue version."""
+    key = f'store:showcase:{get_catalogue_version()}'
+    showcase = cache.get(key)
+    if showcase is None:
+        showcase = {slug: build_showcase(slug) for slug in SECTIONS}
+        cache.set(key, showcase, SHOWCASE_TIMEOUT)
+    return showcase
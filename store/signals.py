@@ -0,0 +1,97 @@
+# store/signals.py
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.db.models import Q
+from django.dispatch import receiver
+
+from .models import Brand, Category, Product, ProductVariant
+from . import search
+from .category_tree import invalidate_category_tree
+from .page_cache import bump_catalogue_version
+from .product_bundle import bump_product_version
+from .stock import rollup_product_stock
+
+
+# --- KEEP PRODUCT'S VARIANT SUMMARY IN SYNC ---
+# Any variant write (new size, price change, toggled inactive, delete)
+# recomputes the cheapest-variant columns on the parent product.
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+def refresh_product_variant_summary(sender, instance, **kwargs):
+    # Use filter().first() because during a cascade delete the product may already be gone
+    product = Product.objects.filter(pk=instance.product_id).first()
+    if product:
+        product.refresh_variant_summary()
+
+
+# --- KEEP PRODUCT STOCK = SUM OF ITS VARIANTS' STOCK ---
+# (checkouts change variant stock with update(), which rolls up by itself: store/stock.py)
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+def rollup_variant_stock(sender, instance, **kwargs):
+    rollup_product_stock([instance.product_id])
+
+
+# --- KEEP THE FULL-TEXT SEARCH INDEX IN SYNC ---
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    search.index_products([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.unindex_products([instance.pk])
+
+
+# Brand / category names are part of each product's search document
+@receiver(post_save, sender=Brand)
+def reindex_brand_products(sender, instance, created, **kwargs):
+    if not created:
+        search.index_products(instance.products.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created, **kwargs):
+    if not created:
+        products = Product.objects.filter(Q(category=instance) | Q(category__parent=instance))
+        search.index_products(products.values_list('id', flat=True))
+
+
+# --- DROP THE CACHED CATEGORY TREE ---
+# Dropped right away (for this connection) and again on commit, so no other
+# request can re-cache the old rows under the new version
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_cached_category_tree(sender, instance, **kwargs):
+    invalidate_category_tree()
+    transaction.on_commit(invalidate_category_tree)
+
+
+# --- DROP CACHED CATALOGUE PAGES AND PRODUCT CARDS ---
+# Same now-and-on-commit bump as the category tree
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+def invalidate_cached_catalogue_pages(sender, instance, **kwargs):
+    bump_catalogue_version()
+    transaction.on_commit(bump_catalogue_version)
+
+
+# --- DROP THE CACHED PRODUCT DETAIL BODY ---
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_detail(sender, instance, **kwargs):
+    bump_product_version(instance.pk)
+    transaction.on_commit(lambda: bump_product_version(instance.pk))
+
+
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+def invalidate_variant_product_detail(sender, instance, **kwargs):
+    bump_product_version(instance.product_id)
+    transaction.on_commit(lambda: bump_product_version(instance.product_id))
@@ -0,0 +1,112 @@
+# store/stk_jobs.py
+"""
+Database-backed queue for STK push initiation (no external broker needed).
+
+The checkout view calls enqueue_stk_push() and returns at once; the worker pool
+started by `python manage.py run_stk_worker` claims queued jobs, does the Daraja
+calls and records the MpesaTransaction. The waiting page polls the job status.
+"""
+import datetime
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from orders.models import Order
+
+from .models import MpesaTransaction, StkPushJob
+from .mpesa_utils import charge_amount, initiate_stk_push
+
+logger = logging.getLogger(__name__)
+
+# A job left 'Running' this long belonged to a worker that died mid-call.
+# It is failed (NOT re-sent) since the prompt may already be on the customer's phone.
+STALE_AFTER = datetime.timedelta(minutes=2)
+
+
+def enqueue_stk_push(order, phone_number, amount):
+    """Queues an STK push for the order (a double-submitted form reuses the job already waiting)."""
+    with transaction.atomic():
+        # Locking the order row serializes two concurrent submits: the second sees the first's job
+        Order.objects.select_for_update().only('id').get(pk=order.pk)
+        job = (
+            StkPushJob.objects
+            .filter(order=order, status__in=[StkPushJob.QUEUED, StkPushJob.RUNNING])
+            .order_by('-id').first()
+        )
+        if job is None:
+            job = StkPushJob.objects.create(order=order, phone_number=phone_number, amount=amount)
+    return job
+
+
+def claim_jobs(limit=10):
+    """
+    Moves up to `limit` queued jobs (oldest first) to 'Running' and returns them.
+    Each claim is a conditional UPDATE, so two workers never run the same job.
+    """
+    candidate_ids = list(
+        StkPushJob.objects.filter(status=StkPushJob.QUEUED).order_by('created_at', 'id').values_list('id', flat=True)[:limit]
+    )
+    claimed = []
+    now = timezone.now()
+    for job_id in candidate_ids:
+        won = StkPushJob.objects.filter(id=job_id, status=StkPushJob.QUEUED).update(status=StkPushJob.RUNNING, started_at=now)
+        if won:
+            claimed.append(job_id)
+    return list(StkPushJob.objects.filter(id__in=claimed).select_related('order').order_by('created_at', 'id'))
+
+
+def run_job(job):
+    """
+    Sends one claimed job to Daraja and records the outcome. Never raises while the
+    database can be written: any error fails the job. A push Daraja accepted keeps its
+    CheckoutRequestID on the job, so reconciliation still settles it (reconcile.adopt_orphaned_pushes).
+    """
+    try:
+        return _send(job)
+    except Exception:
+        logger.exception(f"STK job {job.id} crashed")
+        StkPushJob.objects.filter(id=job.id).update(
+            status=StkPushJob.FAILED, message='Failed to initiate M-Pesa.', finished_at=timezone.now()
+        )
+        return StkPushJob.FAILED
+
+
+def _send(job):
+    StkPushJob.objects.filter(id=job.id).update(attempts=job.attempts + 1)
+    try:
+        response = initiate_stk_push(job.phone_number, charge_amount(job.amount), job.order_id)
+    except Exception:
+        logger.exception(f"STK push for job {job.id} crashed")
+        response = {'ResponseCode': '1', 'CustomerMessage': 'Failed to initiate M-Pesa.'}
+
+    if response and response.get('ResponseCode') == '0':
+        checkout_req_id = response.get('CheckoutRequestID')
+        # Written first on its own: the prompt is on the phone even if recording it below fails
+        StkPushJob.objects.filter(id=job.id).update(checkout_request_id=checkout_req_id)
+        with transaction.atomic():
+            MpesaTransaction.objects.create(
+                order_id=job.order_id,
+                checkout_request_id=checkout_req_id,
+                merchant_request_id=response.get('MerchantRequestID'),
+                amount=job.amount,
+                phone_number=job.phone_number,
+                status='Pending'
+            )
+            StkPushJob.objects.filter(id=job.id).update(
+                status=StkPushJob.SENT, message=response.get('CustomerMessage'), finished_at=timezone.now(),
+            )
+        return StkPushJob.SENT
+
+    error = (response or {}).get('CustomerMessage', 'Failed to initiate M-Pesa.')
+    StkPushJob.objects.filter(id=job.id).update(status=StkPushJob.FAILED, message=error[:255], finished_at=timezone.now())
+    return StkPushJob.FAILED
+
+
+def fail_stale_jobs():
+    """Fails jobs stuck in 'Running' (worker killed mid-call). Returns how many."""
+    return StkPushJob.objects.filter(
+        status=StkPushJob.RUNNING, started_at__lt=timezone.now() - STALE_AFTER
+    ).update(
+        status=StkPushJob.FAILED, message='Payment request timed out. Please try again.', finished_at=timezone.now()
+    )
@@ -0,0 +1,249 @@
+# store/stock.py
+"""
+Stock reservations for orders.
+
+place_order takes the cart's units off the shelf as soon as the order is written, in
+ONE conditional UPDATE per table (UPDATE ... SET stock = stock - n WHERE id IN (...)
+AND stock >= n). The row lock is taken by the write itself and only lives until the
+order's short transaction commits. There is no SELECT ... FOR UPDATE and no read-then-write,
+so two checkouts of the last unit can't both win: the second UPDATE re-checks
+stock >= n after the first commits and matches nothing.
+
+Every taken line is recorded as a StockReservation, held for STOCK_RESERVATION_MINUTES:
+  - payment succeeded         -> commit_reservations() (the units are sold)
+  - payment failed            -> release_reservations() (units go back)
+  - nobody paid in time       -> release_expired(), run by `release_expired_reservations`
+  - customer retries payment  -> renew_reservations() (extends / re-takes the holds)
+  - customer orders again     -> release_unpaid_holds() (a re-submitted order form doesn't hold twice)
+Holds change state with a conditional UPDATE on their status, so a failure callback and
+the expiry sweep can never both put the same units back.
+
+Product.stock is the sum of its variants' stock. It is rolled up after commit in its own
+statement (rollup_product_stock), so checkouts of different sizes of one product don't
+queue on the product row.
+"""
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Exists, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.utils import timezone
+
+from .models import Product, ProductVariant, StkPushJob, StockReservation
+from .product_bundle import bump_product_version
+
+logger = logging.getLogger(__name__)
+
+
+class OutOfStock(Exception):
+    """Some lines have fewer units left than asked for. Nothing was taken."""
+
+    def __init__(self, names):
+        self.names = names
+        super().__init__(f"Not enough stock for: {', '.join(names)}")
+
+
+class _Contested(Exception):
+    """Another process changed the holds first; the block is rolled back."""
+
+
+def reservation_ttl():
+    return datetime.timedelta(minutes=getattr(settings, 'STOCK_RESERVATION_MINUTES', 15))
+
+
+# --- 1. CONDITIONAL DECREMENT / PUT BACK ---
+def _per_row(wanted):
+    """CASE id WHEN .. THEN n END for a {pk: n} dict."""
+    return Case(*[When(pk=pk, then=Value(n)) for pk, n in wanted.items()], output_field=IntegerField())
+
+
+def _take(model, wanted):
+    """
+    Takes {pk: quantity} units off `model` rows in ONE conditional UPDATE.
+    True if every row had enough; otherwise nothing is taken (the savepoint is rolled back).
+    """
+    if not wanted:
+        return True
+    try:
+        with transaction.atomic():
+            taken = model.objects.filter(pk__in=wanted, stock__gte=_per_row(wanted)).update(
+                stock=F('stock') - _per_row(wanted)
+            )
+            if taken != len(wanted):
+                raise _Contested
+    except _Contested:
+        return False
+    return True
+
+
+def _put_back(model, wanted):
+    if wanted:
+        model.objects.filter(pk__in=wanted).update(stock=F('stock') + _per_row(wanted))
+
+
+def _split(rows):
+    """(variant units, product units) {pk: quantity} from (product_id, variant_id, quantity) rows."""
+    variants, products = {}, {}
+    for product_id, variant_id, quantity in rows:
+        if variant_id:
+            variants[variant_id] = variants.get(variant_id, 0) + quantity
+        else:
+            products[product_id] = products.get(product_id, 0) + quantity
+    return variants, products
+
+
+def _stock_changed(product_ids):
+    product_ids = set(product_ids)
+    # robust: the order is already committed, a failed roll-up is only logged (the next one catches up)
+    transaction.on_commit(lambda: rollup_product_stock(product_ids), robust=True)
+
+
+# --- 2. ROLL-UP ---
+def rollup_product_stock(product_ids=None):
+    """
+    Product.stock = sum of its variants' stock, in one UPDATE (all products with variants
+    when product_ids is None). Products without variants keep their own stock.
+    """
+    variants = ProductVariant.objects.filter(product=OuterRef('pk'))
+    total = variants.order_by().values('product').annotate(total=Sum('stock')).values('total')
+    products = Product.objects.filter(Exists(variants))
+    if product_ids is not None:
+        products = products.filter(pk__in=product_ids)
+    products.update(stock=Subquery(total))
+
+    # update() skips the signals: the product page shows the stock left
+    for product_id in product_ids or ():
+        bump_product_version(product_id)
+
+
+# --- 3. RESERVE ---
+def reserve_order_stock(order, lines):
+    """
+    Takes the units of the priced cart lines (carts/pricing.py) and holds them for the order.
+    Call it inside the transaction that writes the order: it raises OutOfStock, and the
+    rollback also undoes the order itself.
+    """
+    rows = [(line.product.id, line.variant.id if line.variant else None, line.quantity) for line in lines]
+    variants, products = _split(rows)
+    if not (_take(ProductVariant, variants) and _take(Product, products)):
+        raise OutOfStock(_short_names(variants, products))
+
+    expires_at = timezone.now() + reservation_ttl()
+    StockReservation.objects.bulk_create([
+        StockReservation(order=order, product_id=product_id, variant_id=variant_id, quantity=quantity, expires_at=expires_at)
+        for product_id, variant_id, quantity in rows
+    ])
+    _stock_changed(product_id for product_id, _, _ in rows)
+
+
+def _short_names(variants, products):
+    """Names of the rows that can't be covered (only runs when taking failed)."""
+    names = [
+        str(variant) for variant in ProductVariant.objects.select_related('product').filter(pk__in=variants)
+        if variant.stock < variants[variant.pk]
+    ]
+    names += [product.name for product in Product.objects.filter(pk__in=products) if product.stock < products[product.pk]]
+    return names
+
+
+# --- 4. COMMIT / RELEASE / RENEW ---
+def _held_rows(reservations):
+    return list(reservations.values_list('id', 'product_id', 'variant_id', 'quantity'))
+
+
+def _move(rows, from_status, **changes):
+    """Conditional status UPDATE of the given holds; _Contested unless it matched every one."""
+    ids = [row[0] for row in rows]
+    if StockReservation.objects.filter(id__in=ids, status=from_status).update(**changes) != len(ids):
+        raise _Contested
+
+
+def commit_reservations(order_id):
+    """
+    The order is paid: its holds are sold. Holds that had already lapsed are taken again
+    (a late payment); if those units are gone meanwhile, it is logged for the shop to sort out.
+    """
+    with transaction.atomic():
+        StockReservation.objects.filter(order_id=order_id, status=StockReservation.HELD).update(
+            status=StockReservation.COMMITTED
+        )
+        lapsed = _held_rows(
+            StockReservation.objects.filter(order_id=order_id, status=StockReservation.RELEASED).select_for_update()
+        )
+        for reservation_id, product_id, variant_id, quantity in lapsed:
+            model, pk = (ProductVariant, variant_id) if variant_id else (Product, product_id)
+            if not _take(model, {pk: quantity}):
+                logger.warning(f"Order {order_id} paid after its hold lapsed: {quantity} x {model.__name__} {pk} is oversold")
+        if lapsed:
+            _move(lapsed, StockReservation.RELEASED, status=StockReservation.COMMITTED)
+            _stock_changed(row[1] for row in lapsed)
+
+
+def _release(reservations):
+    """Puts the units of the given 'Held' reservations back. Returns how many holds were released."""
+    try:
+        with transaction.atomic():
+            # skip_locked: a hold another process is already releasing is left to it, nobody waits
+            rows = _held_rows(
+                reservations.filter(status=StockReservation.HELD).select_for_update(skip_locked=True)
+            )
+            if not rows:
+                return 0
+            _move(rows, StockReservation.HELD, status=StockReservation.RELEASED)
+            variants, products = _split(row[1:] for row in rows)
+            _put_back(ProductVariant, variants)
+            _put_back(Product, products)
+            _stock_changed(row[1] for row in rows)
+    except _Contested:
+        return 0
+    return len(rows)
+
+
+def release_reservations(order_id):
+    """Payment failed: the order's held units go back on the shelf."""
+    return _release(StockReservation.objects.filter(order_id=order_id))
+
+
+def release_unpaid_holds(user_id):
+    """
+    The customer is placing a new order: the holds of their earlier unpaid orders go back,
+    except those with a payment still in flight (queued push or 'Pending' M-Pesa transaction).
+    """
+    order_ids = set(
+        StockReservation.objects
+        .filter(status=StockReservation.HELD, order__user_id=user_id, order__is_ordered=False)
+        .exclude(order__stk_push_jobs__status__in=[StkPushJob.QUEUED, StkPushJob.RUNNING])
+        .exclude(order__mpesa_transactions__status='Pending')
+        .values_list('order_id', flat=True)
+    )
+    return _release(StockReservation.objects.filter(order_id__in=order_ids)) if order_ids else 0
+
+
+def release_expired(limit=500):
+    """Releases up to `limit` holds past their expiry (oldest first). Returns how many."""
+    expired = StockReservation.objects.filter(status=StockReservation.HELD, expires_at__lte=timezone.now())
+    ids = expired.order_by('expires_at', 'id').values_list('id', flat=True)[:limit]
+    return _release(StockReservation.objects.filter(id__in=list(ids)))
+
+
+def renew_reservations(order_id):
+    """
+    Another payment attempt: the order's holds get a fresh expiry, and released ones are
+    taken again. Raises OutOfStock (nothing changed) if some of those units are gone.
+    """
+    expires_at = timezone.now() + reservation_ttl()
+    try:
+        with transaction.atomic():
+            StockReservation.objects.filter(order_id=order_id, status=StockReservation.HELD).update(expires_at=expires_at)
+            lapsed = _held_rows(StockReservation.objects.filter(order_id=order_id, status=StockReservation.RELEASED))
+            if not lapsed:
+                return
+            _move(lapsed, StockReservation.RELEASED, status=StockReservation.HELD, expires_at=expires_at)
+            variants, products = _split(row[1:] for row in lapsed)
+            if not (_take(ProductVariant, variants) and _take(Product, products)):
+                raise OutOfStock(_short_names(variants, products))
+            _stock_changed(row[1] for row in lapsed)
+    except _Contested:
+        pass  # a concurrent attempt for the same order renewed them
+
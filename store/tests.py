@@ -1,3 +1,1232 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import requests
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models import Q
+from django.http import Http404, HttpResponse
+from django.template import engines
+from django.test import RequestFactory, TestCase, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import Account
+from carts.pricing import CartLine
+from orders.models import Order, Payment
+from orders.views import generate_order_number
+
+from . import callback_inbox, catalogue_snapshot, facets, mpesa_utils, page_cache, payments, product_bundle, profiling, reconcile, showcase, stk_jobs, stock, version_stamps, views
+from .daraja_simulator import DarajaSimulator
+from .models import Category, Brand, Product, ProductVariant, MpesaCallback, MpesaTransaction, StkPushJob, StockReservation
+from .views import LISTING_PAGE_SIZE
+
+# Max SQL queries allowed for one store/search listing request.
+# Covers everything on the page: session, navbar menu, cart badge, sidebar, count and the page itself.
+LISTING_QUERY_BUDGET = 10
+
+
+def make_catalogue(product_count):
+    """Creates a haircare > shampoo tree with `product_count` products (2 variants each)."""
+    haircare = Category.objects.create(name='Haircare', slug='haircare')
+    shampoo = Category.objects.create(name='Shampoo', slug='shampoo', parent=haircare)
+    brands = [Brand.objects.create(name=f'Brand {i}') for i in range(3)]
+
+    for i in range(product_count):
+        product = Product.objects.create(
+            category=shampoo,
+            brand=brands[i % len(brands)],
+            stock=10,
+            name=f'Shampoo {i}',
+            slug=f'shampoo-{i}',
+            description='Gentle cleansing shampoo',
+        )
+        ProductVariant.objects.create(product=product, size_ml_g='250ml', price=300 + i, stock=5)
+        ProductVariant.objects.create(product=product, size_ml_g='500ml', price=550 + i, stock=5)
+
+
+class ListingQueryBudgetTests(TestCase):
+
+    def count_queries(self, url):
+        # The .update() calls below skip the signals, so drop the cached pages by hand
+        page_cache.bump_catalogue_version()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertListingWithinBudget(self, url):
+        # A one-card page and a full page must cost the same, and stay under the budget
+        self.client.get(url)  # warm-up: the first hit also builds the category tree
+        Product.objects.exclude(slug='shampoo-0').update(available=False)
+        single_card = self.count_queries(url)
+
+        Product.objects.update(available=True)
+        full_page = self.count_queries(url)
+
+        self.assertEqual(single_card, full_page, f"{url} query count grows with page size")
+        self.assertLessEqual(full_page, LISTING_QUERY_BUDGET, f"{url} exceeded its query budget")
+
+    def setUp(self):
+        make_catalogue(LISTING_PAGE_SIZE * 2)
+
+    def test_store_listing_budget(self):
+        self.assertListingWithinBudget(reverse('store:store'))
+
+    def test_category_listing_budget(self):
+        self.assertListingWithinBudget(reverse('store:products_by_category', args=['haircare']))
+
+    def test_search_listing_budget(self):
+        self.assertListingWithinBudget(reverse('store:search') + '?keyword=shampoo')
+
+    def test_filtered_listing_budget(self):
+        self.assertListingWithinBudget(reverse('store:store') + '?min_price=300&max_price=400&page=1')
+
+    def test_cards_show_cheapest_variant_price(self):
+        response = self.client.get(reverse('store:store'))
+        product = response.context['products'][0]
+        self.assertEqual(product.get_display_price, product.variants.order_by('price').first().price)
+        self.assertEqual(product.get_display_size, '250ml')
+
+
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        make_catalogue(20)
+        self.url = reverse('store:store')
+        self.expected = list(Product.objects.order_by('-created', '-id').values_list('slug', flat=True))
+
+    def slugs(self, response):
+        return [product.slug for product in response.context['products']]
+
+    @mock.patch('store.views.MAX_NUMBERED_PAGES', 2)
+    def test_deep_pages_switch_to_cursors_and_cover_every_product(self):
+        seen = self.slugs(self.client.get(self.url))
+        response = self.client.get(self.url, {'page': 2})
+        seen += self.slugs(response)
+        self.assertEqual(list(response.context['page_links']), [1, 2])
+
+        while response.context['next_cursor']:
+            response = self.client.get(self.url, {'cursor': response.context['next_cursor']})
+            self.assertTrue(response.context['cursor_mode'])
+            seen += self.slugs(response)
+        self.assertEqual(seen, self.expected)
+
+    @mock.patch('store.views.MAX_NUMBERED_PAGES', 2)
+    def test_cursor_page_is_one_query_whatever_the_depth(self):
+        response = self.client.get(self.url, {'page': 2})
+        cursor = response.context['next_cursor']
+        page_cache.bump_catalogue_version()  # make sure the view really runs
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'cursor': cursor})
+        self.assertFalse(response.context['products'].has_previous())  # forward-only: no "Previous" to offer
+        listing = [q['sql'] for q in queries if 'FROM "store_product"' in q['sql'] and 'LIMIT' in q['sql']]
+        self.assertEqual(len(listing), 1)
+        self.assertNotIn('OFFSET', listing[0])
+
+    def test_count_is_cached_between_pages(self):
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'page': 2})
+        self.assertEqual(response.context['product_count'], 20)
+        self.assertFalse([q for q in queries if 'COUNT(' in q['sql']])
+
+    @mock.patch('store.views.MAX_NUMBERED_PAGES', 2)
+    @mock.patch('store.views.LISTING_PAGE_SIZE', 3)
+    def test_page_numbers_past_the_last_numbered_page_are_capped(self):
+        response = self.client.get(self.url, {'page': 100000})
+        self.assertEqual(response.context['products'].number, 2)
+        self.assertEqual(self.slugs(response), self.expected[3:6])
+        self.assertTrue(response.context['next_cursor'])  # the way on is the cursor
+
+    def test_garbled_cursor_falls_back_to_the_first_page(self):
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertFalse(response.context['cursor_mode'])
+        self.assertEqual(self.slugs(response), self.expected[:LISTING_PAGE_SIZE])
+
+
+class FacetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        make_catalogue(6)  # brands rotate 0, 1, 2; cheapest variants 300-305
+        ProductVariant.objects.filter(product__slug='shampoo-0', size_ml_g='250ml').update(price=1500)
+        Product.objects.get(slug='shampoo-0').refresh_variant_summary()  # 550 now
+        ProductVariant.objects.filter(product__slug='shampoo-1').update(price=6000)
+        Product.objects.get(slug='shampoo-1').refresh_variant_summary()
+
+    def test_brand_and_price_counts_in_one_query(self):
+        products = Product.objects.filter(available=True)
+        with CaptureQueriesContext(connection) as queries:
+            result = facets.compute_facets(products)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([(b['name'], b['count']) for b in result['brands']], [('Brand 0', 2), ('Brand 1', 2), ('Brand 2', 2)])
+        self.assertEqual(
+            [(b['label'], b['count']) for b in result['price_buckets']],
+            [('Under KES 500', 4), ('KES 500 - 1,000', 1), ('KES 1,000 - 2,000', 0), ('KES 2,000 - 5,000', 0), ('KES 5,000+', 1)],
+        )
+
+    def test_changing_filters_costs_no_facet_query(self):
+        url = reverse('store:products_by_category', args=['haircare'])
+        self.client.get(url)
+        page_cache.bump_catalogue_version()  # new version: the facets are computed once more...
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'brands': [Brand.objects.get(name='Brand 1').id], 'min_price': 500})
+        self.assertFalse([q for q in queries if 'GROUP BY' in q['sql']])  # ...but not per filter
+        self.assertEqual(len(response.context['all_brands']), 3)
+
+        bucket = response.context['price_buckets'][1]
+        self.assertEqual((bucket['count'], bucket['query']), (1, f"brands={Brand.objects.get(name='Brand 1').id}&min_price=500&max_price=999.99"))
+        self.assertEqual([p.slug for p in self.client.get(url + '?' + bucket['query']).context['products']], [])
+        self.assertEqual([p.slug for p in self.client.get(url + '?min_price=500&max_price=999.99').context['products']], ['shampoo-0'])
+
+    def test_search_lists_only_brands_of_the_matches(self):
+        product = Product.objects.get(slug='shampoo-4')
+        product.name = 'Coconut Curl Cream'
+        product.save()
+        response = self.client.get(reverse('store:search'), {'keyword': 'coconut'})
+        self.assertEqual([(b['name'], b['count']) for b in response.context['all_brands']], [('Brand 1', 1)])
+
+
+class CatalogueSnapshotTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        make_catalogue(15)
+        conditioner = Category.objects.create(name='Conditioner', slug='conditioner', parent=Category.objects.get(slug='haircare'))
+        Product.objects.filter(slug__in=['shampoo-3', 'shampoo-4']).update(category=conditioner)
+        Product.objects.filter(slug='shampoo-5').update(available=False)
+        page_cache.bump_catalogue_version()  # the .update()s above skip the signals
+        self.haircare = Category.objects.get(slug='haircare')
+
+    def listing(self, params, scope):
+        products = Product.objects.filter(available=True).order_by('-created', '-id')
+        if scope['category_id']:
+            products = products.filter(Q(category_id=scope['category_id']) | Q(category__parent_id=scope['category_id']))
+        context = views.build_product_listing(RequestFactory().get('/store/', params), products, keyset=True, snapshot_scope=scope)
+        return context['product_count'], [p.slug for p in context['products']], context['next_cursor']
+
+    @mock.patch('store.views.MAX_NUMBERED_PAGES', 1)
+    def test_same_results_as_sql(self):
+        cases = [
+            ({}, {'category_id': None}),
+            ({'page': 2}, {'category_id': None}),
+            ({'min_price': '303', 'max_price': '310.00'}, {'category_id': None}),
+            ({'brands': [Brand.objects.get(name='Brand 1').id]}, {'category_id': self.haircare.id}),
+            ({}, {'category_id': Category.objects.get(slug='conditioner').id}),
+        ]
+        for params, scope in cases:
+            sql = self.listing(params, scope)
+            with override_settings(CATALOGUE_SNAPSHOT_ENABLED=True):
+                self.assertEqual(self.listing(params, scope), sql, params)
+            if sql[2]:  # and the cursor page after it
+                params = dict(params, cursor=sql[2])
+                sql = self.listing(params, scope)
+                with override_settings(CATALOGUE_SNAPSHOT_ENABLED=True):
+                    self.assertEqual(self.listing(params, scope), sql, params)
+
+    @override_settings(CATALOGUE_SNAPSHOT_ENABLED=True)
+    def test_one_primary_key_query_per_page_once_built(self):
+        self.listing({}, {'category_id': None})
+        with CaptureQueriesContext(connection) as queries:
+            count, slugs, _ = self.listing({'min_price': '305', 'page': 2}, {'category_id': self.haircare.id})
+        self.assertEqual((count, slugs), (9, ['shampoo-8', 'shampoo-7', 'shampoo-6']))
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('COUNT', queries[0]['sql'])
+
+    @override_settings(CATALOGUE_SNAPSHOT_ENABLED=True)
+    def test_rebuilt_after_catalogue_change_and_skipped_when_too_large(self):
+        first = catalogue_snapshot.get_snapshot()
+        self.assertEqual(len(first), 15)
+        Product.objects.get(slug='shampoo-0').delete()
+        self.assertEqual(len(catalogue_snapshot.get_snapshot()), 14)
+
+        with override_settings(CATALOGUE_SNAPSHOT_MAX_PRODUCTS=10):
+            page_cache.bump_catalogue_version()
+            self.assertIsNone(catalogue_snapshot.get_snapshot())
+            self.assertEqual(self.listing({}, {'category_id': None})[0], 13)  # served by SQL
+
+
+class ProductDetailBundleTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        make_catalogue(2)
+        self.product = Product.objects.get(slug='shampoo-0')
+        ProductVariant.objects.create(product=self.product, size_ml_g='1L', price=900, stock=1, is_active=False)
+        user = Account.objects.create_user('Jane', 'Doe', 'jane', 'jane@example.com', 'pass12345')
+        Account.objects.filter(id=user.id).update(is_active=True)
+        self.client.force_login(Account.objects.get(id=user.id))  # logged in: skips the full-page cache
+
+    def test_loader_is_one_query_with_active_variants_only(self):
+        with CaptureQueriesContext(connection) as queries:
+            product, variants = product_bundle.load_product_detail('shampoo', 'shampoo-0')
+            product.category.slug, product.brand.name, [v.product.name for v in variants]
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([v.size_ml_g for v in variants], ['250ml', '500ml'])
+
+        ProductVariant.objects.filter(product=self.product).update(is_active=False)
+        self.assertEqual(product_bundle.load_product_detail('shampoo', 'shampoo-0')[1], [])
+        with self.assertRaises(Http404):
+            product_bundle.load_product_detail('haircare', 'shampoo-0')
+
+    def test_body_is_cached_until_the_product_or_a_variant_changes(self):
+        url = self.product.get_url()
+        self.assertNotContains(self.client.get(url), '1L')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get(url), '250ml')
+        self.assertFalse([q for q in queries if 'store_product' in q['sql']])
+
+        variant = ProductVariant.objects.get(product=self.product, size_ml_g='1L')
+        variant.is_active = True
+        variant.save()
+        self.assertContains(self.client.get(url), '1L')
+
+        self.product.available = False
+        self.product.save()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_cached_body_carries_the_visitors_csrf_token(self):
+        url = self.product.get_url()
+        self.client.get(url)
+        response = self.client.get(url)
+        self.assertNotIn(page_cache.CSRF_PLACEHOLDER, response.content)
+        self.assertIn(b'name="csrfmiddlewaretoken"', response.content)
+
+
+class ProductSearchTests(TestCase):
+
+    def setUp(self):
+        make_catalogue(3)
+
+    def search(self, keyword):
+        response = self.client.get(reverse('store:search'), {'keyword': keyword})
+        return [product.name for product in response.context['products']]
+
+    def test_name_hits_rank_above_description_hits(self):
+        product = Product.objects.get(slug='shampoo-2')
+        product.name = 'Argan Repair Mask'
+        product.description = 'Pairs well with any gentle shampoo'
+        product.save()
+        self.assertEqual(self.search('shampoo')[-1], 'Argan Repair Mask')
+
+    def test_prefix_and_typo_matching(self):
+        self.assertEqual(len(self.search('sham')), 3)
+        self.assertEqual(len(self.search('shampooo')), 3)
+        self.assertEqual(self.search('xylophone'), [])
+
+    def test_index_follows_product_changes(self):
+        product = Product.objects.get(slug='shampoo-0')
+        product.name = 'Coconut Curl Cream'
+        product.save()
+        self.assertEqual(self.search('coconut'), ['Coconut Curl Cream'])
+
+        product.delete()
+        self.assertEqual(self.search('coconut'), [])
+
+
+class CategoryTreeCacheTests(TestCase):
+
+    def setUp(self):
+        make_catalogue(2)
+
+    def category_queries(self, url):
+        page_cache.bump_catalogue_version()  # measure a real render, not a cached page
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        return [q['sql'] for q in queries if 'FROM "store_category"' in q['sql']]
+
+    def test_navigation_costs_no_category_queries_once_warm(self):
+        url = reverse('store:products_by_category', args=['haircare'])
+        self.client.get(url)
+        self.assertEqual(self.category_queries(url), [])
+
+    def test_tree_is_rebuilt_after_category_change(self):
+        url = reverse('store:store')
+        self.client.get(url)
+        Category.objects.create(name='Conditioner', slug='conditioner', parent=Category.objects.get(slug='haircare'))
+
+        response = self.client.get(url)
+        haircare = response.context['category_tree'].get('haircare')
+        self.assertEqual([child.slug for child in haircare.children], ['conditioner', 'shampoo'])
+        self.assertEqual(self.client.get(reverse('store:products_by_category', args=['conditioner'])).status_code, 200)
+
+
+class PageCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        caches['pages'].clear()
+        make_catalogue(2)
+        self.product = Product.objects.get(slug='shampoo-0')
+
+    def count_queries(self, url, client=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = (client or self.client).get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_anonymous_pages_are_served_from_cache(self):
+        for url in (reverse('store:home'), reverse('store:store') + '?brands=1&page=1', self.product.get_url()):
+            self.client.get(url)
+            queries, _ = self.count_queries(url)
+            self.assertEqual(queries, 0, url)
+
+    def test_version_stamps_outlive_the_page_cache_and_are_read_from_memory(self):
+        version = page_cache.get_catalogue_version()
+        cache.clear()
+        caches['pages'].clear()
+        version_stamps._local.clear()
+        self.assertEqual(page_cache.get_catalogue_version(), version)
+
+        with mock.patch.object(caches['stamps'], 'get') as get:
+            self.assertEqual(page_cache.get_catalogue_version(), version)
+        get.assert_not_called()
+
+    def test_query_string_order_does_not_matter(self):
+        url = reverse('store:store')
+        self.client.get(url + '?min_price=100&max_price=900')
+        self.assertEqual(self.count_queries(url + '?max_price=900&min_price=100')[0], 0)
+
+    def test_product_and_variant_changes_invalidate(self):
+        url = reverse('store:products_by_category', args=['haircare'])
+        self.client.get(url)
+        self.product.name = 'Coconut Curl Cream'
+        self.product.save()
+        self.assertContains(self.client.get(url), 'Coconut Curl Cream')
+
+        ProductVariant.objects.filter(product=self.product, size_ml_g='250ml').get().delete()
+        self.assertContains(self.client.get(url), 'KES 550')
+
+    def test_logged_in_users_and_guest_carts_bypass_the_page_cache(self):
+        url = reverse('store:store')
+        self.client.get(url)
+
+        user = Account.objects.create_user('Jane', 'Doe', 'jane', 'jane@example.com', 'pass12345')
+        Account.objects.filter(id=user.id).update(is_active=True)
+        member = self.client_class()
+        member.force_login(Account.objects.get(id=user.id))
+        queries, response = self.count_queries(url, member)
+        self.assertGreater(queries, 0)
+        self.assertContains(response, 'Welcome')
+
+        guest = self.client_class()
+        guest.cookies[settings.SESSION_COOKIE_NAME] = 'some-guest-session'
+        self.assertGreater(self.count_queries(url, guest)[0], 0)
+
+    def test_cached_product_page_gets_each_visitors_own_csrf_token(self):
+        url = self.product.get_url()
+        first = self.client_class(enforce_csrf_checks=True)
+        first.get(url)
+
+        second = self.client_class(enforce_csrf_checks=True)
+        response = second.get(url)
+        self.assertIsNone(response.context)  # served from the cache
+        self.assertNotIn(page_cache.CSRF_PLACEHOLDER, response.content)
+        self.assertIn(settings.CSRF_COOKIE_NAME, response.cookies)
+
+        token = re.search(rb'name="csrfmiddlewaretoken" value="([^"]+)"', response.content).group(1).decode()
+        variant = ProductVariant.objects.filter(product=self.product).first()
+        response = second.post(reverse('carts:add_cart', args=[self.product.id]),
+                               {'csrfmiddlewaretoken': token, 'variant_id': variant.id, 'quantity': 1})
+        self.assertNotEqual(response.status_code, 403)
+
+
+class ShowcaseTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        make_catalogue(3)  # three shampoos, newest is shampoo-2
+        haircare = Category.objects.get(slug='haircare')
+        self.oil = Category.objects.create(name='Hair Oil', slug='hair-oil', parent=haircare)
+        Product.objects.create(category=self.oil, brand=Brand.objects.first(), stock=3, name='Argan Oil',
+                               slug='argan-oil', description='Light oil')
+
+    def test_newest_product_per_child_then_newest_extras(self):
+        showcase.get_category_tree()  # warm: only the showcase queries are counted
+        with CaptureQueriesContext(connection) as queries:
+            products = showcase.build_showcase('haircare')
+            [product.category.slug for product in products]  # cards build their URL from this
+        self.assertEqual([p.slug for p in products], ['argan-oil', 'shampoo-2', 'shampoo-1', 'shampoo-0'])
+        self.assertLessEqual(len(queries), 2)
+        self.assertEqual(showcase.build_showcase('no-such-category'), [])
+
+    def test_snapshot_is_reused_until_the_catalogue_changes(self):
+        showcase.get_showcase()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(showcase.get_showcase()['haircare']), 4)
+        self.assertEqual(len(queries), 0)
+
+        Product.objects.filter(slug='argan-oil').get().delete()
+        self.assertNotIn('argan-oil', [p.slug for p in showcase.get_showcase()['haircare']])
+
+
+class StubDarajaHandler(BaseHTTPRequestHandler):
+    """Local stand-in for Daraja's OAuth, STK push and STK query endpoints (counts every call)."""
+    calls = 0
+    push_calls = 0
+    query_calls = 0
+    expires_in = '3599'
+    push_status = 200
+    query_results = {}  # CheckoutRequestID -> (http status, STK Push Query answer)
+
+    def do_GET(self):
+        type(self).calls += 1
+        self._reply(200, {'access_token': f'token-{self.calls}', 'expires_in': self.expires_in})
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path.startswith('/mpesa/stkpushquery/'):
+            type(self).query_calls += 1
+            self._reply(*self.query_results[payload['CheckoutRequestID']])
+            return
+        type(self).push_calls += 1
+        self._reply(self.push_status, {
+            'ResponseCode': '0', 'CheckoutRequestID': f'ws_CO_{self.push_calls}', 'CustomerMessage': 'Success',
+        })
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubDarajaMixin:
+    """Starts a StubDarajaHandler server per test; new_client() returns a DarajaClient pointed at it."""
+
+    def setUp(self):
+        StubDarajaHandler.calls = 0
+        StubDarajaHandler.push_calls = 0
+        StubDarajaHandler.expires_in = '3599'
+        StubDarajaHandler.push_status = 200
+        StubDarajaHandler.query_calls = 0
+        StubDarajaHandler.query_results = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubDarajaHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        cache.delete(f'mpesa:access_token:{self.base_url}')
+
+    def new_client(self, **kwargs):
+        options = dict(base_url=self.base_url, consumer_key='key', consumer_secret='secret',
+                       passkey='passkey', callback_base_url='http://shop.test', backoff=0)
+        options.update(kwargs)
+        return mpesa_utils.DarajaClient(**options)
+
+
+class AccessTokenManagerTests(StubDarajaMixin, SimpleTestCase):
+
+    def test_token_is_reused_until_it_expires(self):
+        manager = self.new_client().tokens
+        self.assertEqual(manager.get_token(), 'token-1')
+        self.assertEqual(manager.get_token(), 'token-1')
+        self.assertEqual(StubDarajaHandler.calls, 1)
+
+    def test_short_lived_token_is_refreshed(self):
+        StubDarajaHandler.expires_in = '30'  # inside the expiry margin
+        manager = self.new_client().tokens
+        manager.get_token()
+        manager.get_token()
+        self.assertEqual(StubDarajaHandler.calls, 2)
+
+    def test_concurrent_callers_share_one_refresh(self):
+        manager = self.new_client().tokens
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(manager.get_token())) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(tokens, ['token-1'] * 10)
+        self.assertEqual(StubDarajaHandler.calls, 1)
+
+    def test_token_is_shared_across_workers_through_cache(self):
+        self.new_client().tokens.get_token()
+        self.assertEqual(self.new_client().tokens.get_token(), 'token-1')
+        self.assertEqual(StubDarajaHandler.calls, 1)
+
+
+class DarajaClientTests(StubDarajaMixin, SimpleTestCase):
+
+    def test_stk_push_returns_daraja_response(self):
+        response = self.new_client().initiate_stk_push('0712345678', 500, 7)
+        self.assertEqual(response['ResponseCode'], '0')
+        self.assertEqual(response['CheckoutRequestID'], 'ws_CO_1')
+
+    def test_stk_push_is_never_retried(self):
+        StubDarajaHandler.push_status = 503
+        with self.assertLogs('store.mpesa_utils', 'ERROR'):
+            response = self.new_client().initiate_stk_push('0712345678', 500, 7)
+        self.assertEqual(response['ResponseCode'], '1')
+        self.assertEqual(StubDarajaHandler.push_calls, 1)
+
+    def test_open_circuit_fails_fast(self):
+        StubDarajaHandler.push_status = 503
+        client = self.new_client(breaker=mpesa_utils.CircuitBreaker(failure_threshold=2, reset_timeout=60))
+        with self.assertLogs('store.mpesa_utils', 'ERROR'):
+            client.initiate_stk_push('0712345678', 500, 7)
+            client.initiate_stk_push('0712345678', 500, 7)
+
+        response = client.initiate_stk_push('0712345678', 500, 7)
+        self.assertEqual(response['ResponseCode'], '1')
+        self.assertIn('temporarily unavailable', response['CustomerMessage'])
+        self.assertEqual(StubDarajaHandler.push_calls, 2)
+
+    def test_unexpected_error_in_trial_call_does_not_wedge_the_circuit(self):
+        breaker = mpesa_utils.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        client = self.new_client(breaker=breaker)
+        breaker.record_failure()  # open; the next call is the half-open trial
+        with mock.patch.object(client.session, 'request', side_effect=requests.TooManyRedirects('loop')), \
+                self.assertLogs('store.mpesa_utils', 'ERROR'):
+            client.initiate_stk_push('0712345678', 500, 7)
+
+        self.assertFalse(breaker.is_open)  # trial finished: the next call is let through
+        self.assertEqual(client.initiate_stk_push('0712345678', 500, 7)['ResponseCode'], '0')
+
+
+def make_order(**kwargs):
+    if 'user' not in kwargs:
+        username = f'wanjiru{Account.objects.count()}'
+        kwargs['user'] = Account.objects.create_user('Wanjiru', 'K', username, f'{username}@example.com', 'pass12345')
+    fields = dict(order_number=generate_order_number(), first_name='Wanjiru', last_name='K', phone='0712345678',
+                  email='wanjiru@example.com', delivery_fee=0, order_total=500, grand_total=500)
+    fields.update(kwargs)
+    return Order.objects.create(**fields)
+
+
+class StkPushQueueTests(TestCase):
+
+    def setUp(self):
+        self.order = make_order()
+
+    def test_checkout_only_enqueues(self):
+        with mock.patch('store.stk_jobs.initiate_stk_push') as initiate:
+            response = self.client.post(reverse('store:stk_push_request', args=[self.order.id]), {'phone_number': '0712345678'})
+
+        self.assertEqual(response.status_code, 200)
+        initiate.assert_not_called()
+        job = StkPushJob.objects.get(order=self.order)
+        self.assertEqual(job.status, StkPushJob.QUEUED)
+        self.assertContains(response, reverse('store:payment_status_stream', args=[self.order.id]))
+        self.assertFalse(MpesaTransaction.objects.exists())
+
+    def test_fractional_total_is_rounded_up(self):
+        order = make_order(order_total=Decimal('1499.60'), grand_total=Decimal('1499.60'))
+        self.client.post(reverse('store:stk_push_request', args=[order.id]), {'phone_number': '0712345678'})
+        self.assertEqual(StkPushJob.objects.get(order=order).amount, 1500)
+        self.assertEqual(mpesa_utils.charge_amount(Decimal('1500.00')), 1500)
+
+    def test_double_submit_reuses_the_waiting_job(self):
+        first = stk_jobs.enqueue_stk_push(self.order, '0712345678', 500)
+        second = stk_jobs.enqueue_stk_push(self.order, '0712345678', 500)
+        self.assertEqual(first.id, second.id)
+
+    def test_worker_sends_job_and_records_transaction(self):
+        job = stk_jobs.enqueue_stk_push(self.order, '0712345678', 500)
+        daraja_reply = {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_1', 'CustomerMessage': 'Success'}
+        with mock.patch('store.stk_jobs.initiate_stk_push', return_value=daraja_reply):
+            call_command('run_stk_worker', '--once', threads=1, stdout=io.StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, StkPushJob.SENT)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(MpesaTransaction.objects.get(checkout_request_id='ws_CO_1').order, self.order)
+
+        self.assertEqual(payments.get_payment_status(self.order.id)['state'], payments.WAITING)
+
+    def test_failed_push_is_visible_to_waiting_page(self):
+        job = stk_jobs.enqueue_stk_push(self.order, '0712345678', 500)
+        with mock.patch('store.stk_jobs.initiate_stk_push', return_value={'ResponseCode': '1', 'CustomerMessage': 'Invalid phone'}):
+            stk_jobs.run_job(stk_jobs.claim_jobs()[0])
+
+        status = payments.get_payment_status(self.order.id)
+        self.assertEqual((status['state'], status['message']), (payments.FAILED, 'Invalid phone'))
+
+    def test_error_recording_an_accepted_push_fails_the_job_but_keeps_its_id(self):
+        job = stk_jobs.enqueue_stk_push(self.order, '0712345678', 500)
+        daraja_reply = {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_1', 'CustomerMessage': 'Success'}
+        with mock.patch('store.stk_jobs.initiate_stk_push', return_value=daraja_reply), \
+                mock.patch.object(MpesaTransaction.objects, 'create', side_effect=OperationalError('disk I/O error')), \
+                self.assertLogs('store.stk_jobs', 'ERROR'):
+            call_command('run_stk_worker', '--once', threads=1, stdout=io.StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.checkout_request_id), (StkPushJob.FAILED, 'ws_CO_1'))
+        self.assertFalse(MpesaTransaction.objects.exists())
+
+        # Reconciliation gives the accepted push its transaction, once
+        self.assertEqual(reconcile.adopt_orphaned_pushes(), 1)
+        self.assertEqual(reconcile.adopt_orphaned_pushes(), 0)
+        self.assertEqual(MpesaTransaction.objects.get(checkout_request_id='ws_CO_1').status, 'Pending')
+
+    def test_worker_survives_a_job_it_cannot_record(self):
+        stk_jobs.enqueue_stk_push(self.order, '0712345678', 500)
+        stk_jobs.enqueue_stk_push(make_order(), '0712345678', 500)
+        with mock.patch('store.stk_jobs.run_job', side_effect=[OperationalError('database is locked'), StkPushJob.SENT]) as run_job, \
+                self.assertLogs('store.management.commands.run_stk_worker', 'ERROR'):
+            call_command('run_stk_worker', '--once', threads=1, stdout=io.StringIO())
+        self.assertEqual(run_job.call_count, 2)
+
+    def test_claimed_job_is_not_claimed_again(self):
+        stk_jobs.enqueue_stk_push(self.order, '0712345678', 500)
+        self.assertEqual(len(stk_jobs.claim_jobs()), 1)
+        self.assertEqual(stk_jobs.claim_jobs(), [])
+
+
+def stk_callback(checkout_request_id, result_code=0, receipt='RKT1234567'):
+    callback = {'MerchantRequestID': 'm-1', 'CheckoutRequestID': checkout_request_id, 'ResultCode': result_code, 'ResultDesc': 'done'}
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': 1},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'TransactionDate', 'Value': 20260115143012},
+        ]}
+    return {'Body': {'stkCallback': callback}}
+
+
+class StkCallbackTests(TestCase):
+
+    def setUp(self):
+        self.order = make_order()
+        MpesaTransaction.objects.create(order=self.order, checkout_request_id='ws_CO_1', amount=500, phone_number='254712345678')
+
+    def post_callback(self, body):
+        return self.client.post(reverse('store:mpesa_callback'), json.dumps(body), content_type='application/json')
+
+    def test_successful_callback_pays_order_once(self):
+        self.post_callback(stk_callback('ws_CO_1'))
+        self.post_callback(stk_callback('ws_CO_1'))
+        callback_inbox.process_pending()
+
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.is_ordered)
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(MpesaTransaction.objects.get().mpesa_receipt_number, 'RKT1234567')
+        self.assertEqual(
+            list(MpesaCallback.objects.order_by('id').values_list('outcome', flat=True)), [payments.PAID, payments.DUPLICATE]
+        )
+
+    def test_payment_records_the_amount_charged(self):
+        payments.process_stk_callback(stk_callback('ws_CO_1')['Body']['stkCallback'])  # sandbox: 1 KES charged
+        self.assertEqual(Payment.objects.get().amount_paid, 1)
+
+    def test_duplicate_returns_early(self):
+        callback = stk_callback('ws_CO_1')['Body']['stkCallback']
+        payments.process_stk_callback(callback)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(payments.process_stk_callback(callback), payments.DUPLICATE)
+        # Claim attempt + existence check (plus the savepoint around them)
+        self.assertLessEqual(len([q for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]), 2)
+
+    def test_webhook_only_stores_the_body(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.post_callback(stk_callback('ws_CO_1'))
+
+        self.assertEqual(response.json()['ResultCode'], 0)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(MpesaCallback.objects.get().checkout_request_id, 'ws_CO_1')
+        self.assertFalse(Payment.objects.exists())
+
+    def test_failed_processing_is_retried_and_can_be_replayed(self):
+        self.post_callback(stk_callback('ws_CO_1'))
+        with mock.patch('store.callback_inbox.process_stk_callback', side_effect=OperationalError('db down')), \
+                self.assertLogs('store.callback_inbox', 'ERROR'):
+            callback_inbox.process_pending()
+        callback = MpesaCallback.objects.get()
+        self.assertEqual((callback.status, callback.attempts), (MpesaCallback.PENDING, 1))
+        self.assertEqual(callback_inbox.process_pending(), {})  # backing off
+
+        self.assertEqual(callback_inbox.replay([callback.id]), 1)
+        call_command('process_mpesa_callbacks', '--once', stdout=io.StringIO())
+        callback.refresh_from_db()
+        self.assertEqual((callback.status, callback.outcome), (MpesaCallback.PROCESSED, payments.PAID))
+
+    def test_callback_before_its_transaction_is_retried(self):
+        self.post_callback(stk_callback('ws_CO_2'))
+        with self.assertLogs('store.payments', 'WARNING'):
+            self.assertEqual(callback_inbox.process_pending(), {MpesaCallback.PENDING: 1})
+        callback = MpesaCallback.objects.get()
+        self.assertEqual((callback.outcome, callback.attempts), (payments.UNKNOWN, 1))
+        self.assertEqual(callback_inbox.process_pending(), {})  # backing off
+
+        # The STK worker commits the transaction; the retry pays the order
+        MpesaTransaction.objects.create(order=self.order, checkout_request_id='ws_CO_2', amount=500, phone_number='254712345678')
+        MpesaCallback.objects.update(next_attempt_at=timezone.now())
+        callback_inbox.process_pending()
+        callback.refresh_from_db()
+        self.assertEqual((callback.status, callback.outcome), (MpesaCallback.PROCESSED, payments.PAID))
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.is_ordered)
+
+    def test_callback_without_a_transaction_gives_up_after_max_attempts(self):
+        self.post_callback(stk_callback('ws_CO_404'))
+        MpesaCallback.objects.update(attempts=callback_inbox.MAX_ATTEMPTS - 1)
+        with self.assertLogs('store.payments', 'WARNING'):
+            self.assertEqual(callback_inbox.process_pending(), {MpesaCallback.FAILED: 1})
+
+    def test_failed_callback_keeps_order_unpaid(self):
+        self.post_callback(stk_callback('ws_CO_1', result_code=1032))
+        callback_inbox.process_pending()
+        self.assertEqual(MpesaTransaction.objects.get().status, 'Failed')
+        self.order.refresh_from_db()
+        self.assertFalse(self.order.is_ordered)
+
+        # A late success for an already-settled transaction is ignored
+        self.assertEqual(payments.process_stk_callback(stk_callback('ws_CO_1')['Body']['stkCallback']), payments.DUPLICATE)
+        self.assertFalse(Payment.objects.exists())
+
+
+class ConcurrentStkCallbackTests(TransactionTestCase):
+
+    def test_concurrent_duplicates_create_one_payment(self):
+        order = make_order()
+        MpesaTransaction.objects.create(order=order, checkout_request_id='ws_CO_1', amount=500, phone_number='254712345678')
+        callback = stk_callback('ws_CO_1')['Body']['stkCallback']
+        outcomes = []
+        barrier = threading.Barrier(8)
+
+        def deliver():
+            try:
+                barrier.wait()
+                outcomes.append(payments.process_stk_callback(callback))
+            except OperationalError:
+                # SQLite's in-memory test DB refuses (rather than queues) a contending writer;
+                # Safaricom just retries such a delivery. Postgres makes it wait on the row lock.
+                outcomes.append('locked')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=deliver) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(outcomes), 8)
+        self.assertEqual(outcomes.count(payments.PAID), 1)
+        self.assertEqual(set(outcomes) - {payments.PAID, payments.DUPLICATE, 'locked'}, set())
+        self.assertEqual(Payment.objects.count(), 1)
+        order.refresh_from_db()
+        self.assertTrue(order.is_ordered)
+
+
+def cart_line(variant, quantity=1):
+    return CartLine(item=None, product=variant.product, variant=variant, quantity=quantity,
+                    unit_price=variant.price, line_total=variant.price * quantity)
+
+
+class StockReservationTests(TestCase):
+
+    def setUp(self):
+        make_catalogue(1)
+        self.small, self.large = ProductVariant.objects.order_by('id')
+        self.order = make_order()
+        MpesaTransaction.objects.create(order=self.order, checkout_request_id='ws_CO_1', amount=500, phone_number='254712345678')
+
+    def reserve(self, order, *lines):
+        with self.captureOnCommitCallbacks(execute=True):
+            stock.reserve_order_stock(order, lines)
+
+    def stock_levels(self):
+        self.small.refresh_from_db()
+        self.large.refresh_from_db()
+        return self.small.stock, self.large.stock, Product.objects.get().stock
+
+    def test_reserve_takes_units_and_rolls_up_product_stock(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.reserve(self.order, cart_line(self.small, 2), cart_line(self.large, 1))
+        self.assertEqual(self.stock_levels(), (3, 4, 7))
+        self.assertEqual(len([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "store_productvariant"')]), 1)
+        self.assertEqual(set(self.order.stock_reservations.values_list('status', flat=True)), {StockReservation.HELD})
+
+    def test_anonymous_product_page_shows_the_stock_left(self):
+        url = self.small.product.get_url()
+        self.assertContains(self.client.get(url), f'"{self.small.id}": 5')
+        self.assertIsNone(self.client.get(url).context)  # now served from the full-page cache
+
+        self.reserve(self.order, cart_line(self.small, 2))
+        self.assertContains(self.client.get(url), f'"{self.small.id}": 3')
+
+    def test_short_line_takes_nothing(self):
+        with self.assertRaises(stock.OutOfStock) as raised:
+            self.reserve(self.order, cart_line(self.small, 2), cart_line(self.large, 6))
+        self.assertEqual(raised.exception.names, [str(self.large)])
+        self.assertEqual(self.stock_levels()[:2], (5, 5))
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_failed_payment_puts_units_back_once(self):
+        self.reserve(self.order, cart_line(self.small, 2))
+        with self.captureOnCommitCallbacks(execute=True):
+            payments.process_stk_callback(stk_callback('ws_CO_1', result_code=1032)['Body']['stkCallback'])
+        self.assertEqual(self.stock_levels(), (5, 5, 10))
+
+        # The expiry sweep finds nothing left to release
+        StockReservation.objects.update(expires_at=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertEqual(stock.release_expired(), 0)
+        self.assertEqual(self.stock_levels(), (5, 5, 10))
+
+    def test_expired_holds_are_released_by_the_command(self):
+        self.reserve(self.order, cart_line(self.small, 2))
+        StockReservation.objects.update(expires_at=timezone.now() - datetime.timedelta(minutes=1))
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('release_expired_reservations', stdout=io.StringIO())
+        self.assertEqual(self.stock_levels(), (5, 5, 10))
+        self.assertEqual(StockReservation.objects.get().status, StockReservation.RELEASED)
+
+    def test_payment_commits_the_hold(self):
+        self.reserve(self.order, cart_line(self.small, 2))
+        payments.process_stk_callback(stk_callback('ws_CO_1')['Body']['stkCallback'])
+        self.assertEqual(StockReservation.objects.get().status, StockReservation.COMMITTED)
+        StockReservation.objects.update(expires_at=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertEqual(stock.release_expired(), 0)
+        self.assertEqual(self.stock_levels()[0], 3)
+
+    def test_late_payment_takes_lapsed_units_again(self):
+        self.reserve(self.order, cart_line(self.small, 2))
+        stock.release_reservations(self.order.id)
+        self.assertEqual(self.stock_levels()[0], 5)
+
+        payments.process_stk_callback(stk_callback('ws_CO_1')['Body']['stkCallback'])
+        self.assertEqual(self.stock_levels()[0], 3)
+        self.assertEqual(StockReservation.objects.get().status, StockReservation.COMMITTED)
+
+    def test_payment_retry_renews_the_hold(self):
+        self.reserve(self.order, cart_line(self.small, 2))
+        stock.release_reservations(self.order.id)
+        ProductVariant.objects.filter(pk=self.small.pk).update(stock=1)  # sold elsewhere meanwhile
+        with self.assertRaises(stock.OutOfStock):
+            stock.renew_reservations(self.order.id)
+        self.assertEqual(StockReservation.objects.get().status, StockReservation.RELEASED)
+
+        ProductVariant.objects.filter(pk=self.small.pk).update(stock=4)
+        self.client.force_login(self.order.user)
+        self.client.post(reverse('store:stk_push_request', args=[self.order.id]), {'phone_number': '0712345678'})
+        self.assertEqual(self.stock_levels()[0], 2)
+        self.assertEqual(StockReservation.objects.get().status, StockReservation.HELD)
+
+    def test_variant_edit_rolls_up_product_stock(self):
+        self.small.stock = 1
+        self.small.save()
+        self.assertEqual(self.stock_levels()[2], 6)
+
+
+class ConcurrentStockReservationTests(TransactionTestCase):
+
+    def test_last_unit_is_sold_once(self):
+        make_catalogue(1)
+        variant = ProductVariant.objects.order_by('id').first()
+        ProductVariant.objects.filter(pk=variant.pk).update(stock=1)
+        orders = [make_order() for _ in range(8)]
+        outcomes = []
+        barrier = threading.Barrier(8)
+
+        def checkout(order):
+            try:
+                barrier.wait()
+                with transaction.atomic():
+                    stock.reserve_order_stock(order, [cart_line(variant)])
+                outcomes.append('reserved')
+            except stock.OutOfStock:
+                outcomes.append('sold out')
+            except OperationalError:
+                # SQLite refuses a contending writer (the checkout just fails); Postgres queues it
+                outcomes.append('locked')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=[order]) for order in orders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(outcomes), 8)
+        self.assertEqual(set(outcomes) - {'reserved', 'sold out', 'locked'}, set())
+        sold = outcomes.count('reserved')
+        self.assertLessEqual(sold, 1)
+        self.assertEqual(StockReservation.objects.count(), sold)
+        variant.refresh_from_db()
+        self.assertEqual(variant.stock, 1 - sold)
+
+        # Once the contention is over, exactly one unit can still be taken
+        with transaction.atomic():
+            if sold:
+                self.assertRaises(stock.OutOfStock, stock.reserve_order_stock, make_order(), [cart_line(variant)])
+            else:
+                stock.reserve_order_stock(make_order(), [cart_line(variant)])
+        variant.refresh_from_db()
+        self.assertEqual(variant.stock, 0)
+
+
+class PaymentStatusStreamTests(TestCase):
+
+    def setUp(self):
+        self.order = make_order()
+        MpesaTransaction.objects.create(order=self.order, checkout_request_id='ws_CO_1', amount=500, phone_number='254712345678')
+        Account.objects.filter(pk=self.order.user_id).update(is_active=True)
+        self.async_client.force_login(self.order.user)
+
+    async def test_only_the_owner_can_follow_an_order(self):
+        url = reverse('store:payment_status_stream', args=[self.order.id])
+        stranger = await sync_to_async(make_order)()
+        await Account.objects.filter(pk=stranger.user_id).aupdate(is_active=True)
+        await sync_to_async(self.async_client.force_login)(stranger.user)
+        self.assertEqual((await self.async_client.get(url)).status_code, 404)
+        await sync_to_async(self.async_client.logout)()
+        self.assertEqual((await self.async_client.get(url)).status_code, 404)
+
+    async def read_events(self):
+        response = await self.async_client.get(reverse('store:payment_status_stream', args=[self.order.id]))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = [chunk.decode() async for chunk in response.streaming_content]
+        return [json.loads(chunk[len('data: '):]) for chunk in chunks if chunk.startswith('data: ')]
+
+    async def test_stream_ends_once_paid(self):
+        await sync_to_async(payments.process_stk_callback)(stk_callback('ws_CO_1')['Body']['stkCallback'])
+        events = await self.read_events()
+        self.assertEqual([event['state'] for event in events], [payments.PAID])
+        self.assertEqual(events[0]['redirect_url'], reverse('store:order_complete', args=[self.order.id]))
+
+    async def test_stream_pushes_the_change_from_waiting_to_failed(self):
+        async def cancel_soon():
+            await asyncio.sleep(0.2)
+            await sync_to_async(payments.process_stk_callback)(stk_callback('ws_CO_1', result_code=1032)['Body']['stkCallback'])
+
+        with mock.patch('store.views.PAYMENT_STREAM_POLL', 0.1):
+            events, _ = await asyncio.gather(self.read_events(), cancel_soon())
+        self.assertEqual([event['state'] for event in events], [payments.WAITING, payments.FAILED])
+
+    def test_pending_payment_keeps_waiting_instead_of_failing(self):
+        response = self.client.get(reverse('store:order_complete', args=[self.order.id]))
+        self.assertTemplateUsed(response, 'store/stk_push_sent.html')
+
+
+class ReconcileTests(StubDarajaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.order = make_order()
+
+    def pending(self, checkout_request_id, age_minutes=10):
+        MpesaTransaction.objects.create(order=self.order, checkout_request_id=checkout_request_id, amount=500)
+        MpesaTransaction.objects.filter(checkout_request_id=checkout_request_id).update(
+            created_at=timezone.now() - datetime.timedelta(minutes=age_minutes)
+        )
+
+    def test_stale_transactions_are_settled_through_the_callback_path(self):
+        self.pending('ws_CO_paid')
+        self.pending('ws_CO_cancelled')
+        self.pending('ws_CO_waiting')
+        self.pending('ws_CO_fresh', age_minutes=0)
+        StubDarajaHandler.query_results = {
+            'ws_CO_paid': (200, {'ResponseCode': '0', 'ResultCode': '0', 'ResultDesc': 'Processed successfully'}),
+            'ws_CO_cancelled': (200, {'ResponseCode': '0', 'ResultCode': '1032', 'ResultDesc': 'Request cancelled by user'}),
+            'ws_CO_waiting': (500, {'errorCode': reconcile.STILL_PROCESSING, 'errorMessage': 'The transaction is being processed'}),
+        }
+
+        report = reconcile.reconcile_pending(client=self.new_client(), rate_per_second=0)
+
+        self.assertEqual((report.scanned, report.paid, report.failed, report.still_pending, report.errors), (3, 1, 1, 1, 0))
+        self.assertEqual(StubDarajaHandler.query_calls, 3)
+        self.assertEqual(len(report.latencies), 3)
+        statuses = dict(MpesaTransaction.objects.values_list('checkout_request_id', 'status'))
+        self.assertEqual(statuses, {
+            'ws_CO_paid': 'Successful', 'ws_CO_cancelled': 'Failed', 'ws_CO_waiting': 'Pending', 'ws_CO_fresh': 'Pending',
+        })
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.is_ordered)
+        self.assertEqual(Payment.objects.get().payment_id, 'ws_CO_paid')
+
+    def test_unresolved_oldest_rows_do_not_block_newer_ones(self):
+        self.pending('ws_CO_stuck_1', age_minutes=30)
+        self.pending('ws_CO_stuck_2', age_minutes=20)
+        self.pending('ws_CO_paid', age_minutes=10)
+        StubDarajaHandler.query_results = {
+            'ws_CO_stuck_1': (400, {'errorCode': '400.002.02', 'errorMessage': 'Invalid CheckoutRequestID'}),
+            'ws_CO_stuck_2': (500, {'errorCode': reconcile.STILL_PROCESSING, 'errorMessage': 'The transaction is being processed'}),
+            'ws_CO_paid': (200, {'ResponseCode': '0', 'ResultCode': '0', 'ResultDesc': 'Processed successfully'}),
+        }
+
+        with self.assertLogs('store.mpesa_utils', 'ERROR'):
+            report = reconcile.reconcile_pending(client=self.new_client(), batch_size=2, rate_per_second=0)
+
+        self.assertEqual((report.scanned, report.paid), (3, 1))
+        self.assertEqual(MpesaTransaction.objects.get(checkout_request_id='ws_CO_paid').status, 'Successful')
+        # Checked ones are backed off: an immediate re-run has nothing due
+        self.assertEqual(reconcile.stale_pending_ids(), [])
+
+    def test_hopeless_transaction_is_failed_after_max_checks(self):
+        self.pending('ws_CO_stuck')
+        MpesaTransaction.objects.update(check_attempts=reconcile.MAX_CHECKS - 1)
+        StubDarajaHandler.query_results = {
+            'ws_CO_stuck': (500, {'errorCode': reconcile.STILL_PROCESSING, 'errorMessage': 'The transaction is being processed'}),
+        }
+
+        with self.assertLogs('store.reconcile', 'WARNING'):
+            report = reconcile.reconcile_pending(client=self.new_client(), rate_per_second=0)
+
+        self.assertEqual(report.gave_up, 1)
+        stuck = MpesaTransaction.objects.get()
+        self.assertEqual((stuck.status, stuck.check_attempts), ('Failed', reconcile.MAX_CHECKS))
+        self.order.refresh_from_db()
+        self.assertFalse(self.order.is_ordered)
+
+
+class DarajaSimulatorTests(SimpleTestCase):
+
+    def start_simulator(self, **kwargs):
+        self.delivered = []
+        self.done = threading.Event()
+
+        def deliver(url, body):
+            self.delivered.append((url, body))
+            self.done.set()
+
+        simulator = DarajaSimulator(seed=1, deliver=deliver, **kwargs).start()
+        self.addCleanup(simulator.stop)
+        client = mpesa_utils.DarajaClient(base_url=simulator.url, consumer_key='k', consumer_secret='s',
+                                          passkey='p', callback_base_url='http://shop.test', backoff=0)
+        return simulator, client
+
+    def test_push_is_followed_by_a_callback_with_the_real_amount(self):
+        simulator, client = self.start_simulator(callback_delay=(0.2, 0.2))
+        response = client.initiate_stk_push('0712345678', 1250, 9)
+        self.assertEqual(response['ResponseCode'], '0')
+        self.assertEqual(client.query_stk_push(response['CheckoutRequestID'])['errorCode'], reconcile.STILL_PROCESSING)
+
+        self.assertTrue(self.done.wait(5))
+        url, body = self.delivered[0]
+        callback = body['Body']['stkCallback']
+        self.assertEqual(url, 'http://shop.test/mpesa/callback/')
+        self.assertEqual(callback['CheckoutRequestID'], response['CheckoutRequestID'])
+        self.assertEqual(payments.parse_metadata(callback)['Amount'], 1250)
+        self.assertEqual(client.query_stk_push(response['CheckoutRequestID'])['ResultCode'], '0')
+
+    def test_failure_and_duplicate_rates(self):
+        simulator, client = self.start_simulator(callback_delay=(0, 0), failure_rate=1, duplicate_rate=1)
+        client.initiate_stk_push('0712345678', 100, 9)
+        self.assertTrue(self.done.wait(5))
+        time.sleep(0.1)
+
+        self.assertEqual(len(self.delivered), 2)
+        self.assertNotEqual(self.delivered[0][1]['Body']['stkCallback']['ResultCode'], 0)
+
+    def test_sandbox_is_still_charged_one_shilling(self):
+        self.assertEqual(mpesa_utils.DarajaClient(base_url=mpesa_utils.MPESA_SANDBOX_URL).test_amount, 1)
+
+
+@override_settings(PROFILING_ENABLED=True, PROFILING_DUPLICATE_SAMPLE_RATE=1)
+class ProfilingMiddlewareTests(TestCase):
+
+    def setUp(self):
+        make_catalogue(4)
+        profiling.reset()
+
+    def test_listing_is_recorded_per_url_name(self):
+        with self.assertLogs('store.profiling', 'INFO') as logs:
+            self.client.get(reverse('store:store'))
+
+        row = next(row for row in profiling.snapshot() if row['url_name'] == 'store:store')
+        self.assertEqual(row['requests'], 1)
+        self.assertGreater(row['avg_queries'], 0)
+        self.assertGreater(row['avg_template_ms'], 0)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['event'], line['url_name'], line['status']), ('request_profile', 'store:store', 200))
+
+    def test_duplicate_queries_point_at_their_template_line(self):
+        template = engines['django'].from_string("{% for p in products %}{{ p.brand.name }}{% endfor %}")
+
+        def n_plus_one_view(request):
+            return HttpResponse(template.render({'products': Product.objects.all()}))
+
+        with self.assertLogs('store.profiling', 'INFO'):
+            profiling.ProfilingMiddleware(n_plus_one_view)(RequestFactory().get('/'))
+
+        duplicate = profiling.snapshot()[0]['duplicate_queries'][0]
+        self.assertIn('store_brand', duplicate['sql'])
+        self.assertEqual(duplicate['executions'], 4)
+        self.assertIn('<unknown source>:1', duplicate['site'])
+
+    def test_async_chain_stays_async_and_counts_thread_queries(self):
+        async def count_view(request):
+            return HttpResponse(str(await sync_to_async(Product.objects.count)()))
+
+        middleware = profiling.ProfilingMiddleware(count_view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        with self.assertLogs('store.profiling', 'INFO'):
+            response = async_to_sync(middleware)(RequestFactory().get('/'))
+
+        self.assertEqual(response.content, b'4')
+        self.assertEqual(profiling.snapshot()[0]['max_queries'], 1)
+
+    def test_report_is_staff_only(self):
+        with self.assertLogs('store.profiling', 'INFO'):
+            self.assertEqual(self.client.get(reverse('store:profiling_report')).status_code, 302)
+
+        staff = Account.objects.create_user('Staff', 'User', 'staff', 'staff@example.com', 'pass12345')
+        Account.objects.filter(id=staff.id).update(is_active=True, is_staff=True)
+        self.client.force_login(Account.objects.get(id=staff.id))
+        with self.assertLogs('store.profiling', 'INFO'):
+            response = self.client.get(reverse('store:profiling_report'))
+        self.assertTrue(response.json()['enabled'])
+
+
+class BenchmarkToolsTests(TestCase):
+
+    def test_generated_catalogue_is_reproducible_and_consistent(self):
+        call_command('generate_catalogue', products=40, users=3, orders=5, seed=7, stdout=io.StringIO())
+        first = list(Product.objects.order_by('slug').values_list('slug', 'name', 'min_price'))
+        self.assertEqual(len(first), 40)
+
+        # Precomputed summary columns match what the variant signal would store
+        product = Product.objects.filter(slug__startswith='syn-').first()
+        expected = (product.min_price, product.display_size, product.variant_count)
+        product.refresh_variant_summary()
+        self.assertEqual((product.min_price, product.display_size, product.variant_count), expected)
+
+        call_command('generate_catalogue', products=40, users=3, orders=5, seed=7, clear=True, stdout=io.StringIO())
+        self.assertEqual(list(Product.objects.order_by('slug').values_list('slug', 'name', 'min_price')), first)
+        self.assertEqual(Order.objects.count(), 5)
+
+    def test_benchmarks_flag_query_regressions_against_the_baseline(self):
+        call_command('generate_catalogue', products=20, users=2, orders=0, stdout=io.StringIO())
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        baseline = os.path.join(tmp.name, 'baseline.json')
+        call_command('run_benchmarks', repeat=1, only=['view.store'], output=baseline, stdout=io.StringIO())
+
+        with open(baseline) as f:
+            report = json.load(f)
+        self.assertEqual(report['meta']['products'], 20)
+        self.assertGreater(report['results']['view.store']['queries'], 2)  # the view ran, not a page-cache hit
+        report['results']['view.store']['queries'] -= 1
+        with open(baseline, 'w') as f:
+            json.dump(report, f)
+
+        with self.assertRaisesMessage(CommandError, 'view.store'):
+            call_command('run_benchmarks', repeat=1, only=['view.store'], baseline=baseline,
+                         fail_on_regression=True, stdout=io.StringIO())
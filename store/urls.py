@@ -14,6 +14,7 @@ urlpatterns = [
     # --- M-PESA & ORDER URLS ---
     path('mpesa/callback/', views.stk_push_callback, name='mpesa_callback'),
     path('mpesa/stk_push/<int:order_id>/', views.stk_push_request, name='stk_push_request'),
+    path('mpesa/status/<int:order_id>/stream/', views.payment_status_stream, name='payment_status_stream'),
     
     # The Review Page (Payment Entry)
     path('order/review/<int:order_id>/', views.order_detail_view, name='order_review'),
@@ -28,4 +29,7 @@ urlpatterns = [
     path('orders/', views.my_orders_view, name='my_orders'),
 
     path('order_detail/<int:order_id>/', views.order_detail_view, name='order_detail'),
+
+    # Staff-only request profile (PROFILING_ENABLED)
+    path('staff/profiling/', views.profiling_report, name='profiling_report'),
 ]
\ No newline at end of file
@@ -0,0 +1,42 @@
+# store/version_stamps.py
+"""
+Version stamps (catalogue, category tree, one per product) shared by every process.
+
+A stamp is a random token; bumping it re-keys everything cached under it. Stamps live in
+their own cache alias ('stamps' in settings.CACHES), which is never culled, so a full page
+cache can't evict one. Each process keeps the stamps it read for VERSION_STAMP_SECONDS,
+so a request doesn't pay a cache round-trip per stamp: a bump made here is seen at once,
+one made by another process within those few seconds.
+"""
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+_local = {}  # key -> (stamp, read at)
+
+
+def _stamps():
+    return caches['stamps']
+
+
+def get_stamp(key):
+    now = time.monotonic()
+    local = _local.get(key)
+    if local is not None and now - local[1] < settings.VERSION_STAMP_SECONDS:
+        return local[0]
+
+    stamp = _stamps().get(key)
+    if stamp is None:
+        stamp = uuid.uuid4().hex
+        _stamps().add(key, stamp, None)
+        stamp = _stamps().get(key, stamp)
+    _local[key] = (stamp, now)
+    return stamp
+
+
+def bump_stamp(key):
+    stamp = uuid.uuid4().hex
+    _stamps().set(key, stamp, None)
+    _local[key] = (stamp, time.monotonic())
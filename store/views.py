@@ -1,42 +1,42 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.db.models import Q
 from django.core.paginator import Paginator
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, Http404, StreamingHttpResponse
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.utils import timezone
+from django.urls import reverse
+from django.conf import settings
+from asgiref.sync import sync_to_async
+import asyncio
 import json
 import logging
 import datetime
-from .mpesa_utils import initiate_stk_push
-from carts.models import CartItem 
+import time
+from .stk_jobs import enqueue_stk_push
+from .mpesa_utils import charge_amount
+from .stock import OutOfStock, renew_reservations
+from .callback_inbox import record_callback
+from .payments import get_payment_status, FINAL_STATES, SENDING, WAITING
+from .search import search_products
+from .category_tree import get_category_tree
+from .page_cache import CSRF_PLACEHOLDER, cache_anonymous_page, fill_csrf
+from .showcase import get_showcase
+from .facets import get_facets, price_bucket_links
+from .pagination import MAX_NUMBERED_PAGES, CursorPage, count_estimate, decode_cursor, encode_cursor
+from . import catalogue_snapshot, product_bundle, profiling
 
 # --- IMPORTS ---
 from .models import Product, Category, Brand, ProductVariant, MpesaTransaction 
-from orders.models import Order , Payment , OrderProduct
+from orders.models import Order , OrderProduct
 # ---------------
 
 logger = logging.getLogger(__name__)
 
-# --- HELPER FUNCTION: Get Diverse Products ---
-def get_diverse_products(parent_slug):
-    diverse_products = []
-    try:
-        parent_cat = Category.objects.get(slug=parent_slug)
-        children = parent_cat.children.all()
-        for child in children:
-            product = Product.objects.filter(category=child, available=True).order_by('-created').first()
-            if product: diverse_products.append(product)
-            if len(diverse_products) >= 4: break
-        
-        if len(diverse_products) < 4:
-            existing_ids = [p.id for p in diverse_products]
-            needed_count = 4 - len(diverse_products)
-            extras = Product.objects.filter(Q(category=parent_cat) | Q(category__parent=parent_cat), available=True).exclude(id__in=existing_ids).order_by('-created')[:needed_count]
-            diverse_products.extend(extras)
-    except Category.DoesNotExist: pass
-    return diverse_products
-
 # --- HELPER FUNCTION: Apply Filters (Shared by Store & Search) ---
 def apply_product_filters(request, products):
     """
@@ -48,7 +48,7 @@ def apply_product_filters(request, products):
     if selected_brand_ids:
         products = products.filter(brand__id__in=selected_brand_ids)
 
-    # 2. Price Filter (Variant-First Logic)
+    # 2. Price Filter (uses the indexed Product.min_price column, i.e. the displayed price)
     min_price = request.GET.get('min_price')
     max_price = request.GET.get('max_price')
 
@@ -56,138 +56,192 @@ def apply_product_filters(request, products):
     if min_price == '': min_price = None
     if max_price == '': max_price = None
 
-    if min_price or max_price:
-        # Start with all variants (using objects.all() to be safe against inactive ones)
-        variants_query = ProductVariant.objects.all()
-        
-        if min_price:
-            variants_query = variants_query.filter(price__gte=min_price)
-        if max_price:
-            variants_query = variants_query.filter(price__lte=max_price)
-
-        # Get IDs of products that match these specific variant constraints
-        matched_product_ids = variants_query.values_list('product_id', flat=True)
-        products = products.filter(id__in=matched_product_ids)
+    if min_price:
+        products = products.filter(min_price__gte=min_price)
+    if max_price:
+        products = products.filter(min_price__lte=max_price)
 
-    # 3. Deduping
-    products = products.distinct()
-    
+    # No .distinct() needed: every filter above joins along to-one FKs
+    # (category, category__parent, brand), so rows can never be duplicated.
     return products, selected_brand_ids
 
+# --- HELPER FUNCTION: Listing Pipeline (Shared by Store & Search) ---
+LISTING_PAGE_SIZE = 6
+
+def build_product_listing(request, products, keyset=False, snapshot_scope=None):
+    """
+    Filters, eager-loads and paginates a product queryset for the store grid.
+    A page costs a fixed number of queries (a cached COUNT + one SELECT with category
+    and brand joined in), whatever the page size. Price/size come from the
+    denormalized Product columns, so cards trigger no lazy loads.
+    keyset=True (querysets ordered by -created, -id) switches deep pages to cursors.
+    snapshot_scope={'category_id': ...} lets the in-memory catalogue snapshot answer
+    the filters instead of SQL, when it's enabled (see store/catalogue_snapshot.py).
+    Returns: context dict for store/store.html
+    """
+    # 0. In-memory path: same filters and order, only the shown cards come from the DB
+    snapshot = catalogue_snapshot.get_snapshot() if snapshot_scope is not None else None
+    filters = catalogue_snapshot.parse_filters(request) if snapshot else None
+    if filters is not None:
+        return build_snapshot_listing(request, snapshot, snapshot_scope, *filters)
+
+    # 1. Brand & Price filters
+    products, selected_brand_ids = apply_product_filters(request, products)
+
+    # 2. Eager-load what each card touches (get_url -> category.slug, brand.name)
+    products = products.select_related('category', 'brand')
+
+    # 3. Pagination Helper (keeps filters on the page links)
+    current_filters = listing_filters_query(request)
+
+    # 4. Pagination: numbered for the first pages, (created, id) cursors past them (store/pagination.py)
+    product_count = count_estimate(products)
+    after = decode_cursor(request.GET.get('cursor')) if keyset else None
+    if after:
+        paged_products = CursorPage.from_queryset(products, after, LISTING_PAGE_SIZE)
+        next_cursor, page_links = paged_products.next_cursor, []
+    else:
+        paginator = Paginator(products, LISTING_PAGE_SIZE)
+        paginator.count = product_count  # cached estimate instead of a fresh COUNT(*)
+        paged_products = paginator.get_page(numbered_page(request))
+        page_links = range(1, min(paginator.num_pages, MAX_NUMBERED_PAGES) + 1)
+        next_cursor = None
+        if keyset and paged_products.has_next() and paged_products.number >= MAX_NUMBERED_PAGES:
+            next_cursor = encode_cursor(paged_products[len(paged_products) - 1])
+
+    return {
+        'products': paged_products,
+        'product_count': product_count,
+        'page_links': page_links,
+        'cursor_mode': bool(after),
+        'next_cursor': next_cursor,
+        'selected_brand_ids': list(map(int, selected_brand_ids)),
+        'current_filters': current_filters,
+    }
+
+def numbered_page(request):
+    """?page=, capped at MAX_NUMBERED_PAGES: deeper pages are only reachable by cursor (no deep OFFSET scans)."""
+    try:
+        return min(int(request.GET.get('page')), MAX_NUMBERED_PAGES)
+    except (TypeError, ValueError):
+        return 1  # missing or garbled, like Paginator.get_page
+
+def listing_filters_query(request):
+    """The listing's query string without page/cursor (appended to the page links)."""
+    query_params = request.GET.copy()
+    for param in ('page', 'cursor'):
+        if param in query_params:
+            del query_params[param]
+    return query_params.urlencode()
+
+def build_snapshot_listing(request, snapshot, scope, brand_ids, min_price, max_price):
+    """build_product_listing() answered from the catalogue snapshot: one pk SELECT per page."""
+    rows = snapshot.filter(scope['category_id'], brand_ids, min_price, max_price)
+    after = decode_cursor(request.GET.get('cursor'))
+    if after:
+        start = snapshot.position_after(rows, after)
+        page_rows = catalogue_snapshot.load_products(snapshot.product_ids(rows[start:start + LISTING_PAGE_SIZE + 1]))
+        paged_products = CursorPage(page_rows, LISTING_PAGE_SIZE)
+        next_cursor, page_links = paged_products.next_cursor, []
+    else:
+        paginator = Paginator(rows, LISTING_PAGE_SIZE)
+        paged_products = paginator.get_page(numbered_page(request))
+        paged_products.object_list = catalogue_snapshot.load_products(snapshot.product_ids(paged_products.object_list))
+        page_links = range(1, min(paginator.num_pages, MAX_NUMBERED_PAGES) + 1)
+        next_cursor = None
+        if paged_products.has_next() and paged_products.number >= MAX_NUMBERED_PAGES:
+            next_cursor = encode_cursor(paged_products[len(paged_products) - 1])
+
+    return {
+        'products': paged_products,
+        'product_count': len(rows),
+        'page_links': page_links,
+        'cursor_mode': bool(after),
+        'next_cursor': next_cursor,
+        'selected_brand_ids': brand_ids,
+        'current_filters': listing_filters_query(request),
+    }
+
 # 1. STORE VIEW
+@cache_anonymous_page
 def store(request, category_slug=None):
-    categories = Category.objects.all()
     products = None
     current_category = 'All Products' 
+    snapshot_scope = None  # what the in-memory catalogue snapshot should list (None = use SQL)
 
     # --- 1. Base Query (Category Logic) ---
+    # Categories are resolved from the cached tree; a parent slug (e.g. haircare) also covers its children
     if category_slug != None:
-        if category_slug == 'haircare':
-            try:
-                hair_cat = Category.objects.get(slug='haircare')
-                products = Product.objects.filter(Q(category=hair_cat) | Q(category__parent=hair_cat), available=True).order_by('-created')
-                current_category = hair_cat.name
-            except Category.DoesNotExist: 
-                products = Product.objects.none()
-        elif category_slug == 'skincare':
-            try:
-                skin_cat = Category.objects.get(slug='skincare')
-                products = Product.objects.filter(Q(category=skin_cat) | Q(category__parent=skin_cat), available=True).order_by('-created')
-                current_category = skin_cat.name
-            except Category.DoesNotExist: 
-                products = Product.objects.none()
-        else:
-            category = get_object_or_404(Category, slug=category_slug)
-            products = Product.objects.filter(Q(category=category) | Q(category__parent=category), available=True).order_by('-created')
+        category = get_category_tree().get(category_slug)
+        if category is not None:
+            products = Product.objects.filter(Q(category_id=category.id) | Q(category__parent_id=category.id), available=True).order_by('-created', '-id')
             current_category = category.name
+            snapshot_scope = {'category_id': category.id}
+        elif category_slug in ('haircare', 'skincare'):
+            # The home page always links these two, so show an empty page rather than a 404
+            products = Product.objects.none()
+        else:
+            raise Http404("No Category matches the given query.")
     else:
-        products = Product.objects.filter(available=True).order_by('-created')
-
-    # --- 2. DYNAMIC BRANDS ---
-    relevant_brand_ids = products.values_list('brand_id', flat=True).distinct()
-    all_brands = Brand.objects.filter(id__in=relevant_brand_ids).order_by('name')
-
-    # --- 3. Apply Filters (Brand Selection & Price) ---
-    # Now we filter the products based on user selection
-    products, selected_brand_ids = apply_product_filters(request, products)
-
-    # --- 4. Pagination Helper ---
-    query_params = request.GET.copy()
-    if 'page' in query_params:
-        del query_params['page']
-    current_filters = query_params.urlencode()
+        products = Product.objects.filter(available=True).order_by('-created', '-id')
+        snapshot_scope = {'category_id': None}
 
-    # --- 5. Pagination ---
-    paginator = Paginator(products, 6) 
-    page = request.GET.get('page')
-    paged_products = paginator.get_page(page)
-    product_count = products.count()
+    # --- 2. FACETS: brands (with counts) & price buckets of this category, one cached aggregate ---
+    facets = get_facets(products)
 
-    context = {
-        'products': paged_products, 
-        'categories': categories, 
-        'product_count': product_count, 
+    # --- 3. Filters, Eager Loading & Pagination ---
+    context = build_product_listing(request, products, keyset=True, snapshot_scope=snapshot_scope)
+    context.update({
         'current_category': current_category,
-        'all_brands': all_brands, # This is now the filtered list
-        'selected_brand_ids': list(map(int, selected_brand_ids)), 
-        'current_filters': current_filters,
-    }
+        'all_brands': facets['brands'],
+        'price_buckets': price_bucket_links(request, facets),
+    })
     return render(request, 'store/store.html', context)
 
 # 2. HOME VIEW
+@cache_anonymous_page
 def home(request):
-    haircare_products = get_diverse_products('haircare')
-    skincare_products = get_diverse_products('skincare')
-    return render(request, 'home.html', {'haircare_products': haircare_products, 'skincare_products': skincare_products})
+    # Precomputed showcase rows (store/showcase.py), one cache read
+    showcase = get_showcase()
+    return render(request, 'home.html', {'haircare_products': showcase['haircare'], 'skincare_products': showcase['skincare']})
 
 # 3. PRODUCT DETAIL VIEW
+@cache_anonymous_page(version=product_bundle.page_version)
 def product_detail(request, category_slug, product_slug):
-    try:
-        single_product = Product.objects.get(category__slug=category_slug, slug=product_slug, available=True)
-        variants = single_product.variants.filter(is_active=True)
-    except Exception as e: raise e
-    categories = Category.objects.all()
-    return render(request, 'store/product_detail.html', {'single_product': single_product, 'variants': variants, 'categories': categories})
+    # Body cached per product version (store/product_bundle.py); on a miss, one query loads everything
+    body = product_bundle.get_cached_body(category_slug, product_slug)
+    if body is None:
+        single_product, variants = product_bundle.load_product_detail(category_slug, product_slug)
+        # Rendered without the request (no per-user context), with a CSRF placeholder to fill in per visitor
+        body = render_to_string('store/product_detail_body.html', {
+            'single_product': single_product, 'variants': variants, 'csrf_token': CSRF_PLACEHOLDER.decode(),
+        }).encode()
+        product_bundle.cache_body(category_slug, product_slug, single_product.id, body)
+    return render(request, 'store/product_detail.html', {'body': mark_safe(fill_csrf(request, body).decode())})
 
 # 4. SEARCH VIEW
 def search(request): 
     products = Product.objects.none()
-    product_count = 0
-    categories = Category.objects.all() 
     current_category = 'All Products'
     
     # --- 1. Base Search Query ---
     if 'keyword' in request.GET:
         keyword = request.GET['keyword']
         if keyword:
-            products = Product.objects.filter(Q(description__icontains=keyword) | Q(name__icontains=keyword) | Q(category__name__icontains=keyword), available=True).order_by('-created')
+            # Ranked full-text match (name > brand > category > description), see store/search.py
+            products = search_products(Product.objects.filter(available=True), keyword)
             current_category = f"Search results for: '{keyword}'"
     
-    # --- 2. Apply Filters (Brand & Price) ---
-    products, selected_brand_ids = apply_product_filters(request, products)
-    all_brands = Brand.objects.all()
+    # --- 2. Facets of the matches (before brand/price filters) ---
+    facets = get_facets(products)
 
-    # --- 3. Pagination Helper ---
-    query_params = request.GET.copy()
-    if 'page' in query_params:
-        del query_params['page']
-    current_filters = query_params.urlencode()
-
-    # --- 4. Pagination ---
-    paginator = Paginator(products, 6) 
-    page = request.GET.get('page')
-    paged_products = paginator.get_page(page)
-    product_count = products.count()
-
-    context = {
-        'products': paged_products, 
-        'product_count': product_count, 
-        'categories': categories, 
+    # --- 3. Filters, Eager Loading & Pagination ---
+    context = build_product_listing(request, products)
+    context.update({
         'current_category': current_category,
-        'all_brands': all_brands,
-        'selected_brand_ids': list(map(int, selected_brand_ids)),
-        'current_filters': current_filters,
-    }
+        'all_brands': facets['brands'],
+        'price_buckets': price_bucket_links(request, facets),
+    })
     return render(request, 'store/store.html', context)
 
 # --- REAL M-PESA & ORDER LOGIC ---
@@ -216,81 +270,72 @@ def stk_push_request(request, order_id):
     
     if request.method == 'POST':
         phone = request.POST.get('phone_number')
-        amount = int(order.grand_total)
+        amount = charge_amount(order.grand_total)  # rounded up: a 1499.60 order is not charged 1499
+
+        # 0. The payment window starts now: refresh the stock holds (a failed or
+        #    expired earlier attempt has already put the units back)
+        try:
+            renew_reservations(order.id)
+        except OutOfStock as e:
+            messages.error(request, f"Sorry, not enough stock left for: {', '.join(e.names)}. Please update your cart.")
+            return redirect('carts:cart')
         
-        # 1. Initiate M-Pesa
-        response = initiate_stk_push(phone, amount, order.id)
+        # 1. Queue the STK push (the run_stk_worker pool does the Daraja calls,
+        #    so this request never waits on Safaricom)
+        job = enqueue_stk_push(order, phone, amount)
         
-        if response and response.get('ResponseCode') == '0':
-            checkout_req_id = response.get('CheckoutRequestID')
-            
-            # 2. Create Transaction Record
-            MpesaTransaction.objects.create(
-                order=order,
-                checkout_request_id=checkout_req_id,
-                amount=amount,
-                phone_number=phone,
-                status='Pending'
-            )
-            
-            # 3. RENDER THE SENT STK PUSH PAGE
-            return render(request, 'store/stk_push_sent.html', {'order': order})
-            
-        else:
-            # 4. RENDER THE "FAILED" PAGE (Immediate connection error)
-            error = response.get('CustomerMessage', 'Failed to initiate M-Pesa.')
-            return render(request, 'store/stk_push_failed.html', {'error': error})
+        # 2. RENDER THE SENT STK PUSH PAGE (it listens for the payment status)
+        return render(request, 'store/stk_push_sent.html', {'order': order, 'job': job})
 
     return redirect('store:order_detail', order_id=order.id)
 
+# Server-Sent Events settings for the waiting page
+PAYMENT_STREAM_POLL = 1        # seconds between (one small, indexed) status checks
+PAYMENT_STREAM_TIMEOUT = 60    # the browser reconnects by itself after this
+PAYMENT_STREAM_KEEPALIVE = 15  # comment line so proxies don't drop an idle stream
+
+async def payment_status_stream(request, order_id):
+    """
+    Streams the order's payment state (text/event-stream) and ends once it is paid or failed.
+    It is an async view: under ASGI (azara/asgi.py) a waiting customer holds no worker thread.
+    Only the order's owner gets it; anyone else (or a logged-out visitor) gets a 404.
+    """
+    user_id = await sync_to_async(lambda: request.user.pk)()  # the lazy user loads from the session DB
+    if user_id is None or not await Order.objects.filter(id=order_id, user_id=user_id).aexists():
+        raise Http404
+
+    async def events():
+        yield "retry: 3000\n\n"
+        last_status = None
+        last_sent = started = time.monotonic()
+        while time.monotonic() - started < PAYMENT_STREAM_TIMEOUT:
+            status = await sync_to_async(get_payment_status)(order_id)
+            if status != last_status:
+                yield f"data: {json.dumps(status)}\n\n"
+                last_status, last_sent = status, time.monotonic()
+                if status['state'] in FINAL_STATES:
+                    return
+            elif time.monotonic() - last_sent >= PAYMENT_STREAM_KEEPALIVE:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            await asyncio.sleep(PAYMENT_STREAM_POLL)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # don't let nginx-style proxies buffer the stream
+    return response
+
 @csrf_exempt
 def stk_push_callback(request):
     if request.method == 'POST':
+        # Persist-then-process: store the raw body and ack straight away.
+        # process_mpesa_callbacks applies it to the order later (and retries on failure).
         try:
-            data = json.loads(request.body)
-            stk_callback = data.get('Body', {}).get('stkCallback', {})
-            checkout_req_id = stk_callback.get('CheckoutRequestID')
-            result_code = stk_callback.get('ResultCode') # 0 = Success, 1/1032 = Cancelled/Fail
-            
-            transaction = MpesaTransaction.objects.get(checkout_request_id=checkout_req_id)
-            order = transaction.order
-            
-            if result_code == 0:
-                # --- SUCCESS SCENARIO ---
-                metadata = stk_callback.get('CallbackMetadata', {}).get('Item', [])
-                receipt_no = next((item['Value'] for item in metadata if item['Name'] == 'MpesaReceiptNumber'), None)
-                
-                # 1. Update Transaction
-                transaction.status = 'Successful'
-                transaction.mpesa_receipt_number = receipt_no
-                transaction.save()
-                
-                # 2. Update Order
-                order.payment = Payment.objects.create(
-                    user=order.user,
-                    payment_id=receipt_no,
-                    payment_method='M-Pesa',
-                    amount_paid=order.grand_total,
-                    status='Completed'
-                )
-                order.is_ordered = True # Marks it as "Paid"
-                order.status = 'Accepted'
-                order.save()
-                
-                # 3. CLEAR THE CART ITEMS 
-                # Filter by the user attached to the order
-                CartItem.objects.filter(user=order.user).delete()
-                
-            else:
-                # --- FAILURE SCENARIO ---
-                # User cancelled or insufficient funds
-                transaction.status = 'Failed'
-                transaction.save()
-                
-                # The items remain in the cart so the user can try again.
-                
+            record_callback(request.body)
         except Exception as e:
-            logger.error(f"Error processing M-Pesa callback: {e}")
+            # Not stored: a non-zero ResultCode makes Safaricom deliver it again
+            logger.error(f"Could not store M-Pesa callback: {e}")
+            return JsonResponse({"ResultCode": 1, "ResultDesc": "Rejected"}, status=503)
             
     return JsonResponse({"ResultCode": 0, "ResultDesc": "Accepted"})
 
@@ -309,12 +354,16 @@ def order_complete_view(request, order_id):
                 'receipt_number': transaction.mpesa_receipt_number if transaction else "N/A"
             }
             return render(request, 'orders/order_complete.html', context)
+        status = get_payment_status(order.id)
+        if status['state'] in (SENDING, WAITING):
+            # PENDING: the callback just hasn't landed yet. Keep waiting instead of
+            # sending the customer to the retry page (which fires a second STK push).
+            return render(request, 'store/stk_push_sent.html', {'order': order})
         else:
-            # FAILURE/PENDING:
-            # The callback hasn't arrived, or it failed.
-            # Redirect to the Failure page so customer can try again.
+            # FAILURE: cancelled, wrong PIN, insufficient funds...
+            # Show the Failure page so customer can try again.
             return render(request, 'store/stk_push_failed.html', {
-                'error': 'Payment not received yet. You may have cancelled the request or M-Pesa is delayed.'
+                'error': status['message'] or 'Payment not received. You may have cancelled the request.'
             })
             
     except Order.DoesNotExist:
@@ -324,4 +373,12 @@ def order_receipt_view(request, order_id):
     order = get_object_or_404(Order, id=order_id)
     transaction = MpesaTransaction.objects.filter(order=order, status='Successful').first()
     context = {'order': order, 'receipt_number': transaction.mpesa_receipt_number if transaction else "N/A", 'payment_date': transaction.transaction_date if transaction else order.created_at}
-    return render(request, 'store/order_receipt.html', context)
\ No newline at end of file
+    return render(request, 'store/order_receipt.html', context)
+
+@staff_member_required
+def profiling_report(request):
+    """Staff-only JSON of the per-view request profile (?reset=1 clears it after reading)."""
+    report = profiling.snapshot()
+    if request.GET.get('reset'):
+        profiling.reset()
+    return JsonResponse({'enabled': settings.PROFILING_ENABLED, 'views': report})